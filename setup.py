@@ -18,7 +18,6 @@ setup(
         gitoo=gitoo.cli:entry_point
     ''',
     install_requires=[
-        'gitpython',
         'click',
         'click-didyoumean',
         'crayons',
@@ -26,11 +25,17 @@ setup(
         'pyyaml',
         'pystache',
     ],
+    extras_require={
+        'zstd': ['zstandard'],
+        'gitpython': ['gitpython'],
+    },
     tests_require=[
         'pytest',
         'pytest-cov',
         'pytest-random-order',
+        'pytest-benchmark',
         'mock',
+        'gitpython',
     ],
     include_package_data=True,
     license='MIT',
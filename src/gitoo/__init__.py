@@ -0,0 +1 @@
+from .api import install, install_many, sync, plan, modules, InstallResult, EntryResult
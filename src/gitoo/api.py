@@ -0,0 +1,536 @@
+import os
+import logging
+import tempfile
+import contextlib
+
+from . import core
+from . import bytecode
+from . import catalog
+from . import reproducible as reproducing
+from . import metrics
+from . import cache as mirror_cache
+from . import lock as locking
+from . import sync as syncing
+from . import store as file_store
+from . import strip as stripping
+from . import history as run_history
+from . import planner
+
+logger = logging.getLogger('gitoo-api')
+logger.setLevel(logging.INFO)
+
+
+class EntryResult(object):
+    """ What the installation did for an entry of the config. """
+
+    def __init__(self, addon, destination, folders, report_entry=None):
+        """ Init
+
+        :param Addon addon: the installed add-on.
+        :param string destination: the folder where the add-on was installed.
+        :param list folders: the names of the folders installed in the destination.
+        :param dict report_entry: Optional entry of the metrics report of the add-on.
+        """
+        report_entry = report_entry or {}
+        self.url = core.strip_credentials(addon.repo)
+        self.branch = addon.branch
+        self.commit = addon.resolved_commit
+        self.destination = destination
+        self.folders = folders
+        self.modules = [
+            dict(module, path=os.path.join(destination, module['path']))
+            for module in addon.installed_modules
+        ]
+        self.patches = addon.applied_patches
+        self.seconds = report_entry.get('wall_seconds', 0.0)
+        self.phases = report_entry.get('phases', {})
+        self.counters = report_entry.get('counters', {})
+
+    @property
+    def result_cache_hit(self):
+        """ Whether the modules were restored from the result cache, without using git. """
+        return bool(self.counters.get('result_cache_hits'))
+
+    @property
+    def mirror_hits(self):
+        """ The number of repositories of the entry (with its patches) found in the mirror cache. """
+        return self.counters.get('mirror_hits', 0) + self.counters.get('mirror_reuses', 0)
+
+    def to_dict(self):
+        """ Describe the result with JSON serializable values.
+
+        :rtype: dict
+        """
+        return {
+            'url': self.url,
+            'branch': self.branch,
+            'commit': self.commit,
+            'destination': self.destination,
+            'folders': self.folders,
+            'modules': self.modules,
+            'patches': self.patches,
+            'seconds': self.seconds,
+            'phases': self.phases,
+            'counters': self.counters,
+            'result_cache_hit': self.result_cache_hit,
+            'mirror_hits': self.mirror_hits,
+        }
+
+
+class InstallResult(object):
+    """ What an installation did, entry by entry. """
+
+    def __init__(self, entries, seconds=0.0, digest=None):
+        """ Init
+
+        :param list entries: the EntryResult of each entry, in the order of the config.
+        :param float seconds: the duration of the installation.
+        :param string digest: Optional digest of the content of the destination (see reproducible.tree_digest).
+        """
+        self.entries = entries
+        self.seconds = seconds
+        self.digest = digest
+
+    @property
+    def modules(self):
+        """ The installed modules, by name. When two entries contain the same module, the last one wins.
+
+        :rtype: dict
+        """
+        return {module['name']: module['path'] for entry in self.entries for module in entry.modules}
+
+    def to_dict(self):
+        """ Describe the result with JSON serializable values.
+
+        :rtype: dict
+        """
+        return {
+            'seconds': self.seconds,
+            'digest': self.digest,
+            'entries': [entry.to_dict() for entry in self.entries],
+        }
+
+
+def install(config, destination, work_directory=None, **kwargs):
+    """ Install the add-ons of a config inside the destination folder.
+
+    This is what gitoo install_all does, from the content of a conf file already parsed.
+    It can be called many times from the same process: nothing is kept between the calls,
+    except the caches and the history that are given as folders.
+
+    :param list config: the entries of the conf file (dicts with url, branch, commit, patches...).
+    :param string destination: the folder where the add-ons should end up at.
+    :param string work_directory: Optional folder of the patch files. Default: the current folder.
+    :param kwargs: the options of install_many.
+    :rtype: InstallResult
+    """
+    return install_many([(config, destination, work_directory)], **kwargs)[0]
+
+
+def install_many(
+    targets, lang='', jobs=1, cache_dir=None, shallow=False, sparse=False, result_cache=None,
+    export=core.CHECKOUT, store_dir=None, store_link=file_store.HARDLINK, strip='', history_file=None,
+    metrics_file=None, trace_file=None, output=None, mirrors=None,
+    byte_compile=False, compile_optimize=0, compile_invalidation=bytecode.CHECKED_HASH, modules_index=None,
+    on_shadow=planner.SHADOW_WARN, reproducible=False,
+):
+    """ Install the add-ons of many configs, each one in its own destination, in a single run.
+
+    The repositories are planned across every config, so that each one is fetched once
+    and the forks borrow the objects of the repositories they patch. The add-ons of each config
+    start the longest first, according to the history of the past runs.
+
+    :param list targets: the config, the destination and the folder of the patch files (or None) of each target.
+    :param string lang: the languages (i.e. fr,fr_CA,es) to include in i18n folders. Default: all of them.
+    :param int jobs: the number of add-ons to prepare concurrently, or auto.
+    :param string cache_dir: Optional folder where the git mirrors are cached.
+    :param bool shallow: fetch only the commits to install instead of the whole history.
+    :param bool sparse: checkout only the included modules.
+    :param string result_cache: Optional folder where installed modules are cached.
+    :param string export: checkout the repositories or stream the modules with git archive.
+    :param string store_dir: Optional folder of a store where the files of the modules are deduplicated.
+    :param string store_link: link the files to the store with hard links or reflinks.
+    :param strip: the strip profiles and globs of the files to remove from the modules,
+                  separated by commas or as a list.
+    :param string history_file: Optional file where the durations of the past runs are kept.
+                                Default: inside the cache folder, if given.
+    :param string metrics_file: Optional path of a JSON report with the duration of each phase.
+    :param string trace_file: Optional path of a timeline of the phases, in the Chrome trace format.
+    :param TarOutput output: Optional archive where the add-ons are written instead of the destinations.
+    :param MirrorCache mirrors: Optional cache of mirrors shared with other calls (i.e. by the server),
+                                used instead of cache_dir.
+    :param bool byte_compile: byte-compile the python files of the modules with a pool of processes.
+    :param int compile_optimize: the optimization level of the compiled files (0, 1 or 2).
+    :param string compile_invalidation: how python checks the compiled files: checked-hash (reproducible),
+                                        unchecked-hash or timestamp.
+    :param string modules_index: Optional format of the index of the installed modules written in each destination:
+                                 json, or sqlite for a SQLite database next to the JSON file.
+    :param string on_shadow: what to do with the modules of an entry replaced by a later entry,
+                             which are never prepared: warn, error or last-wins (see planner.plan_precedence).
+    :param bool reproducible: normalize the times and the permissions of the files, to SOURCE_DATE_EPOCH
+                              or the time of the commits, and compute the digest of each destination.
+    :return: the result of each target.
+    :rtype: list
+    """
+    strip = stripping.parse_rules(strip)
+    targets = [
+        (config, os.path.abspath(destination), work_directory or os.getcwd())
+        for config, destination, work_directory in targets
+    ]
+    if output is None:
+        for _, destination, _ in targets:
+            core.check_destination(destination)
+    normalizer = reproducing.Normalizer.from_environment() if reproducible else None
+    runs = _open_history(history_file, cache_dir)
+    recorder = metrics.Recorder()
+    files = file_store.FileStore(store_dir, link=store_link) if store_dir else None
+    installed = []
+    with _plan_mirrors(
+        [config for config, _, _ in targets], cache_dir, shallow=shallow,
+        work_dir=targets[0][1] if output is None else None, mirrors=mirrors,
+    ) as mirrors, _compiling(byte_compile, compile_optimize, compile_invalidation) as compiler:
+        results = mirror_cache.ResultCache(result_cache) if result_cache else None
+        try:
+            for config, destination, work_directory in targets:
+                addons = make_addons(
+                    config, work_directory, lang, mirrors=mirrors, shallow=shallow, sparse=sparse,
+                    results=results, export=export, metrics_recorder=recorder, files=files, strip=strip,
+                    compiler=compiler, normalizer=normalizer)
+                work_dir = destination if output is None else None
+                planner.plan_precedence(addons, on_shadow, jobs)
+                order, target_jobs = _schedule(addons, jobs, runs, work_dir)
+                folders = core.install_addons(
+                    addons, destination, jobs=target_jobs, output=output, order=order, on_shadow=on_shadow)
+                installed.append((addons, destination, folders))
+        finally:
+            _write_metrics(recorder, metrics_file, trace_file)
+        if files:
+            files.save_roots()
+        _save_history(runs, [addon for addons, _, _ in installed for addon in addons], recorder)
+        _log_cache_stats([mirrors, results])
+
+    report = recorder.report()
+    report_entries = {entry['id']: entry for entry in report['entries']}
+    install_results = [
+        InstallResult([
+            EntryResult(addon, destination, addon_folders, report_entries.get(addon.metrics_id))
+            for addon, addon_folders in zip(addons, folders)
+        ], seconds=report['total_seconds'])
+        for addons, destination, folders in installed
+    ]
+    if modules_index:
+        _write_catalogs(
+            [(destination, result) for (_, destination, _), result in zip(installed, install_results)],
+            output, sqlite=modules_index == catalog.SQLITE)
+    if normalizer is not None and output is None:
+        for (_, destination, _), result in zip(installed, install_results):
+            result.digest = _finish_reproducible(normalizer, destination)
+    return install_results
+
+
+def sync(
+    config, destination, work_directory=None, lang='', jobs=1, cache_dir=None, shallow=False, sparse=False,
+    result_cache=None, export=core.CHECKOUT, store_dir=None, store_link=file_store.HARDLINK, strip='',
+    history_file=None, metrics_file=None, trace_file=None,
+    byte_compile=False, compile_optimize=0, compile_invalidation=bytecode.CHECKED_HASH, modules_index=None,
+    on_shadow=planner.SHADOW_WARN, reproducible=False,
+):
+    """ Install the add-ons of a config whose inputs changed since the last sync of the destination.
+
+    The branches without commit are resolved with git ls-remote. The modules of the add-ons installed
+    are updated in the index of the destination, the modules of the add-ons up to date are kept.
+    The parameters are the same as for install_many.
+
+    :param list config: the entries of the conf file.
+    :param string destination: the folder where the add-ons should end up at.
+    :param string work_directory: Optional folder of the patch files. Default: the current folder.
+    :return: the number of add-ons installed and skipped.
+    :rtype: Tuple[int, int]
+    """
+    destination = os.path.abspath(destination)
+    normalizer = reproducing.Normalizer.from_environment() if reproducible else None
+    config = locking.apply_lock(config, locking.lock(config))
+    runs = _open_history(history_file, cache_dir)
+    recorder = metrics.Recorder() if metrics_file or trace_file or runs is not None else None
+    files = file_store.FileStore(store_dir, link=store_link) if store_dir else None
+    core.check_destination(destination)
+    with _plan_mirrors([config], cache_dir, shallow=shallow, work_dir=destination) as mirrors, \
+            _compiling(byte_compile, compile_optimize, compile_invalidation) as compiler:
+        results = mirror_cache.ResultCache(result_cache) if result_cache else None
+        addons = make_addons(
+            config, work_directory or os.getcwd(), lang, mirrors=mirrors, shallow=shallow, sparse=sparse,
+            results=results, export=export, metrics_recorder=recorder, files=files,
+            strip=stripping.parse_rules(strip), compiler=compiler, normalizer=normalizer)
+        planner.plan_precedence(addons, on_shadow, jobs)
+        order, jobs = _schedule(addons, jobs, runs, destination)
+        try:
+            result = syncing.sync_addons(addons, destination, jobs=jobs, order=order)
+        finally:
+            _write_metrics(recorder, metrics_file, trace_file)
+        if files:
+            files.save_roots()
+        _save_history(runs, addons, recorder)
+        _log_cache_stats([mirrors, results])
+    if modules_index:
+        catalog.write_catalog(
+            destination, [EntryResult(addon, destination, []) for addon in addons if addon.installed_modules],
+            destination=destination, sqlite=modules_index == catalog.SQLITE)
+    if normalizer is not None:
+        _finish_reproducible(normalizer, destination)
+    return result
+
+
+def plan(
+    config, destination=None, work_directory=None, lang='', jobs=1, cache_dir=None, shallow=False, sparse=False,
+    result_cache=None, export=core.CHECKOUT, strip='', history_file=None,
+    byte_compile=False, compile_optimize=0, compile_invalidation=bytecode.CHECKED_HASH, reproducible=False,
+):
+    """ Estimate the schedule of the installation of a config, without cloning anything.
+
+    The caches are only read. The parameters are the same as for install_many.
+
+    :param list config: the entries of the conf file.
+    :param string destination: Optional folder where the add-ons would be installed.
+    :param string work_directory: Optional folder of the patch files. Default: the current folder.
+    :return: the job and the start time of each planned entry, in the order they start,
+             the estimated duration and the number of jobs.
+    :rtype: Tuple[list, float, int]
+    """
+    runs = _open_history(history_file, cache_dir)
+    mirrors = mirror_cache.MirrorCache(cache_dir) if cache_dir and os.path.isdir(cache_dir) else None
+    results = mirror_cache.ResultCache(result_cache) if result_cache and os.path.isdir(result_cache) else None
+    addons = make_addons(
+        config, work_directory or os.getcwd(), lang, mirrors=mirrors, shallow=shallow, sparse=sparse,
+        results=results, export=export, strip=stripping.parse_rules(strip),
+        compiler=bytecode.Compiler(compile_optimize, compile_invalidation) if byte_compile else None,
+        normalizer=reproducing.Normalizer.from_environment() if reproducible else None)
+
+    entries = planner.plan_addons(addons, runs)
+    work_dir = destination if destination and os.path.isdir(destination) else None
+    jobs = planner.auto_jobs(entries, work_dir) if jobs == planner.AUTO_JOBS else jobs
+    starts, total = planner.schedule(entries, jobs)
+    return starts, total, jobs
+
+
+def modules(destination, where=()):
+    """ Find the modules installed in a destination, from its catalog only.
+
+    :param string destination: the folder where the add-ons were installed.
+    :param list where: the conditions on the modules, as field=pattern (i.e. depends=hr, name=hr_*).
+    :return: the matching modules (name, path, version, depends, installable, url, branch, commit and patches),
+             sorted by name. The paths are relative to the destination.
+    :rtype: list
+    """
+    return catalog.read_catalog(destination).query(catalog.parse_conditions(where))
+
+
+def make_addons(
+    config, work_directory, lang='', mirrors=None, shallow=False, sparse=False, results=None,
+    export=core.CHECKOUT, metrics_recorder=None, files=None, strip=(), compiler=None, normalizer=None,
+):
+    """ Build the Addon objects of the entries of a config.
+
+    The strip rules of an entry are added to the given ones.
+
+    :param list config: the entries of the conf file.
+    :param string work_directory: the folder of the patch files.
+    :param string lang: the languages to include in i18n folders.
+    :param MirrorCache mirrors: Optional cache of mirrors to clone the add-ons from.
+    :param bool shallow: fetch only the commit to install instead of the whole history.
+    :param bool sparse: checkout only the included modules.
+    :param ResultCache results: Optional cache of installed modules.
+    :param string export: checkout the repository or stream the modules with git archive.
+    :param metrics.Recorder metrics_recorder: Optional recorder of the duration of each phase.
+    :param FileStore files: Optional store where the files of the modules are deduplicated.
+    :param list strip: the strip profiles and globs applied to every entry.
+    :param Compiler compiler: Optional compiler of the python files of the modules.
+    :param Normalizer normalizer: Optional normalizer of the times and permissions of the files.
+    :rtype: list
+    """
+    return [
+        make_addon(
+            entry['url'],
+            entry['branch'],
+            commit=entry.get('commit'),
+            patches=entry.get('patches'),
+            exclude_modules=entry.get('excludes'),
+            include_modules=entry.get('includes'),
+            include_dependencies=bool(entry.get('includes_with_depends')),
+            base=entry.get('base'),
+            work_directory=work_directory,
+            lang=lang,
+            cache=mirrors,
+            shallow=shallow,
+            sparse=sparse,
+            result_cache=results,
+            export=export,
+            metrics_recorder=metrics_recorder,
+            files=files,
+            compiler=compiler,
+            normalizer=normalizer,
+            strip=list(strip) + stripping.parse_rules(entry.get('strip')),
+        )
+        for entry in config
+    ]
+
+
+def make_addon(
+    repo_url, branch, commit='', patches=None,
+    exclude_modules=None, include_modules=None, base=False, work_directory='',
+    lang='', cache=None, shallow=False, sparse=False, result_cache=None, export=core.CHECKOUT,
+    include_dependencies=False, metrics_recorder=None, files=None, strip=None, compiler=None, normalizer=None,
+):
+    """ Build the Addon object of a third party odoo add-on
+
+    :param string repo_url: url of the repo that contains the add-on.
+    :param string branch: name of the branch to checkout.
+    :param string commit: Optional commit rev to checkout to. If mentioned, that take over the branch
+    :param list patches: Optional list of patches to apply.
+    :param list exclude_modules: Optional names of the modules to exclude.
+    :param list include_modules: Optional names of the modules to include.
+    :param bool base: whether the add-on is the source code of Odoo.
+    :param string work_directory: the folder of the patch files.
+    :param string lang: languages to include
+    :param MirrorCache cache: Optional cache of mirrors to clone the add-on from.
+    :param bool shallow: fetch only the commit to install instead of the whole history.
+    :param bool sparse: checkout only the included modules.
+    :param ResultCache result_cache: Optional cache of installed modules.
+    :param string export: checkout the repository or stream the modules with git archive.
+    :param bool include_dependencies: also include the dependencies of the included modules.
+    :param metrics.Recorder metrics_recorder: Optional recorder of the duration of each phase.
+    :param FileStore files: Optional store where the files of the modules are deduplicated.
+    :param list strip: the strip profiles and globs of the files to remove from the modules.
+    :param Compiler compiler: Optional compiler of the python files of the modules.
+    :param Normalizer normalizer: Optional normalizer of the times and permissions of the files.
+    :rtype: core.Addon
+    """
+    patches = patches or []
+    patches = [
+        core.FilePatch(file=patch['file'], work_directory=work_directory)
+        if 'file' in patch else core.Patch(**patch)
+        for patch in patches
+    ]
+    addon_cls = core.Base if base else core.Addon
+    return addon_cls(
+        repo_url, branch, commit=commit, patches=patches,
+        exclude_modules=exclude_modules, include_modules=include_modules,
+        lang=lang, cache=cache, shallow=shallow, sparse=sparse, result_cache=result_cache,
+        export=export, include_dependencies=include_dependencies, metrics_recorder=metrics_recorder,
+        file_store=files, strip=stripping.StripRules(strip or []), compiler=compiler, normalizer=normalizer)
+
+
+@contextlib.contextmanager
+def _compiling(byte_compile, optimize=0, invalidation=bytecode.CHECKED_HASH):
+    """Yield the compiler of the run, or None, then stop its processes and log what it compiled."""
+    if not byte_compile:
+        yield None
+        return
+    with bytecode.Compiler(optimize, invalidation) as compiler:
+        yield compiler
+    compiler.log_stats()
+
+
+def _finish_reproducible(normalizer, destination):
+    """ Normalize the destination folder itself, then compute and log the digest of its content. """
+    normalizer.normalize_root(destination)
+    digest = reproducing.tree_digest(destination)
+    logger.info("Tree digest of %s: %s", destination, digest)
+    return digest
+
+
+def _write_catalogs(installed, output=None, sqlite=False):
+    """ Record the installed modules in the catalog of each destination, or in the archive.
+
+    :param list installed: the destination and the InstallResult of each target.
+    """
+    if output is None:
+        for destination, result in installed:
+            catalog.write_catalog(destination, result.entries, destination=destination, sqlite=sqlite)
+        return
+
+    with tempfile.TemporaryDirectory(prefix='gitoo-catalog-') as folder:
+        catalog.write_catalog(folder, [entry for _, result in installed for entry in result.entries], sqlite=sqlite)
+        output.add(folder)
+
+
+def _open_history(history_file=None, cache_dir=None):
+    """Open the history of the past runs, kept inside the cache folder by default.
+
+    :return: the history, or None if neither a history file nor a cache folder is given.
+    :rtype: History
+    """
+    history_file = history_file or (os.path.join(cache_dir, run_history.HISTORY_FILE) if cache_dir else None)
+    return run_history.History(history_file) if history_file else None
+
+
+def _schedule(addons, jobs, runs=None, work_dir=None):
+    """Order the add-ons longest first and choose the number of jobs if it is auto.
+
+    :return: the order in which the add-ons start and the number of jobs.
+    :rtype: Tuple[list, int]
+    """
+    entries = planner.plan_addons(addons, runs)
+    if jobs == planner.AUTO_JOBS:
+        jobs = planner.auto_jobs(entries, work_dir)
+    return [entry.addon for entry in entries], jobs
+
+
+def _save_history(runs, addons, recorder):
+    if runs is not None:
+        runs.record_report(addons, recorder.report())
+        runs.save()
+
+
+def _write_metrics(recorder, metrics_file, trace_file):
+    """Write the metrics of the installation, even if it failed."""
+    if recorder is not None and (metrics_file or trace_file):
+        recorder.write(metrics_file, trace_file)
+        logger.info("Metrics written to %s", ', '.join(path for path in (metrics_file, trace_file) if path))
+
+
+@contextlib.contextmanager
+def _plan_mirrors(configs, cache_dir=None, shallow=False, work_dir=None, mirrors=None):
+    """Plan the repositories to fetch for the given configs, so that each one is fetched once.
+
+    Without a cache folder, the mirrors are kept in a temporary folder for the run
+    when a repository is used more than once (by many entries or by the patches from a fork),
+    unless only the commits to install are fetched.
+
+    :param list configs: the entries of each conf file.
+    :param string cache_dir: Optional folder where the git mirrors are cached.
+    :param bool shallow: fetch only the commits to install instead of the whole history.
+    :param string work_dir: Optional folder where the temporary mirrors are kept,
+                            on the file system of the destination so that the clones use hard links.
+    :param MirrorCache mirrors: Optional cache of mirrors to use as is.
+    :return: yield the cache of mirrors, or None
+    """
+    urls = [url for config in configs for url in iter_config_urls(config)]
+    shared = mirror_cache.shared_urls(urls)
+    logger.info(
+        "Plan: %s entr(ies), %s repositor(ies), %s used more than once",
+        sum(len(config) for config in configs), len({core.strip_credentials(url) for url in urls}), len(shared))
+
+    if mirrors is not None:
+        yield mirrors
+    elif cache_dir:
+        yield mirror_cache.MirrorCache(cache_dir, fetch_once=True)
+    elif shared and not shallow:
+        with core.temp_folder(work_dir) as folder:
+            yield mirror_cache.MirrorCache(folder, fetch_once=True)
+    else:
+        yield None
+
+
+def iter_config_urls(config):
+    """Yield the url of every repository used by a config (by the entries and the patches), once per use."""
+    for entry in config:
+        yield entry['url']
+        for patch in entry.get('patches') or []:
+            if 'url' in patch:
+                yield patch['url']
+
+
+def _log_cache_stats(caches):
+    for used_cache in caches:
+        if used_cache is not None:
+            used_cache.log_stats()
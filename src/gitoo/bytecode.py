@@ -0,0 +1,163 @@
+import os
+import time
+import logging
+import threading
+import py_compile
+import importlib.util
+import multiprocessing
+from concurrent import futures
+
+from . import metrics
+from .strip import StripRules
+
+logger = logging.getLogger('gitoo-bytecode')
+logger.setLevel(logging.INFO)
+
+CHECKED_HASH = 'checked-hash'
+UNCHECKED_HASH = 'unchecked-hash'
+TIMESTAMP = 'timestamp'
+INVALIDATION_MODES = (CHECKED_HASH, UNCHECKED_HASH, TIMESTAMP)
+OPTIMIZE_LEVELS = (0, 1, 2)
+
+# The files of a module that are never imported: the manifest is read as a literal
+# and the static folder is served to the browser.
+NOT_COMPILED = StripRules(['static/**', '__manifest__.py', '__openerp__.py'])
+
+# The number of files compiled by a task of the process pool
+_CHUNK_SIZE = 200
+
+
+class Compiler(object):
+    """ Byte-compile the python files of the staging folders with a pool of processes.
+
+    The pool is shared by the add-ons prepared at the same time, and started with spawn
+    since the add-ons are prepared by threads. The path recorded in a compiled file
+    is the path of the source relative to the staging folder, so that the same sources
+    always give the same compiled files.
+    """
+
+    def __init__(self, optimize=0, invalidation=CHECKED_HASH, jobs=None):
+        """ Init
+
+        :param int optimize: the optimization level (0, 1 or 2, as python -O and -OO).
+        :param string invalidation: how python checks that a compiled file is up to date:
+            checked-hash, unchecked-hash or timestamp. With the hashes, the compiled files are reproducible.
+        :param int jobs: the number of processes. Default: the number of processors.
+        """
+        if invalidation not in INVALIDATION_MODES:
+            raise RuntimeError("The invalidation mode should be one of {}.".format(', '.join(INVALIDATION_MODES)))
+        if optimize not in OPTIMIZE_LEVELS:
+            raise RuntimeError("The optimization level should be one of {}.".format(OPTIMIZE_LEVELS))
+        self.optimize = optimize
+        self.invalidation = invalidation
+        self.jobs = jobs or os.cpu_count() or 1
+        self.files = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """ Stop the processes of the pool. """
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown()
+
+    def signature(self):
+        """ Describe the compiled files for the result cache. They depend on the version of python.
+
+        :rtype: dict
+        """
+        return {
+            'optimize': self.optimize,
+            'invalidation': self.invalidation,
+            'magic': importlib.util.MAGIC_NUMBER.hex(),
+        }
+
+    def compile_folder(self, folder, is_skipped=None):
+        """ Byte-compile the python files of a folder.
+
+        A file that can not be compiled (i.e. a syntax error) is reported in the logs,
+        the other files are still compiled.
+
+        :param string folder: the folder, i.e. a staging folder.
+        :param is_skipped: Optional function that tells if a file must not be compiled,
+                           given its path relative to the folder.
+        :return: the number of files compiled.
+        :rtype: int
+        """
+        start = time.perf_counter()
+        paths = sorted(
+            path for path in _iter_python_files(folder)
+            if is_skipped is None or not is_skipped(path)
+        )
+        chunks = [paths[index:index + _CHUNK_SIZE] for index in range(0, len(paths), _CHUNK_SIZE)]
+        if self.jobs > 1 and len(chunks) > 1:
+            executor = self._get_executor()
+            results = [
+                future.result() for future in [
+                    executor.submit(_compile_files, folder, chunk, self.optimize, self.invalidation)
+                    for chunk in chunks
+                ]
+            ]
+        else:
+            results = [_compile_files(folder, chunk, self.optimize, self.invalidation) for chunk in chunks]
+
+        files = sum(compiled for compiled, _ in results)
+        errors = [error for _, chunk_errors in results for error in chunk_errors]
+        for error in errors:
+            logger.warning("Could not compile %s", error)
+        with self._lock:
+            self.files += files
+            self.errors += len(errors)
+            self.seconds += time.perf_counter() - start
+        metrics.count('files_compiled', files)
+        metrics.count('compile_errors', len(errors))
+        return files
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = futures.ProcessPoolExecutor(
+                    max_workers=self.jobs, mp_context=multiprocessing.get_context('spawn'))
+            return self._executor
+
+    def log_stats(self):
+        logger.info(
+            "Compile: %s file(s) compiled in %.1fs (optimization %s, %s), %s error(s)",
+            self.files, self.seconds, self.optimize, self.invalidation, self.errors)
+
+
+def _iter_python_files(folder):
+    for directory, directories, file_names in os.walk(folder):
+        directories[:] = [name for name in directories if name != '__pycache__']
+        relative_directory = os.path.relpath(directory, folder)
+        for file_name in file_names:
+            if file_name.endswith('.py'):
+                yield file_name if relative_directory == '.' else os.path.join(relative_directory, file_name)
+
+
+def _compile_files(folder, paths, optimize, invalidation):
+    """ Compile the given files, inside a process of the pool.
+
+    :return: the number of files compiled and the errors.
+    :rtype: Tuple[int, list]
+    """
+    mode = py_compile.PycInvalidationMode[invalidation.upper().replace('-', '_')]
+    compiled = 0
+    errors = []
+    for path in paths:
+        try:
+            py_compile.compile(
+                os.path.join(folder, path), dfile=path, doraise=True, optimize=optimize, invalidation_mode=mode)
+            compiled += 1
+        except (py_compile.PyCompileError, OSError, ValueError) as error:
+            errors.append('{}: {}'.format(path, error))
+    return compiled, errors
@@ -0,0 +1,379 @@
+import os
+import fcntl
+import shutil
+import hashlib
+import logging
+import threading
+import tarfile
+import tempfile
+import contextlib
+import collections
+
+from . import metrics
+from .core import is_commit_sha, run_git, run_git_command, signature_key, strip_credentials
+
+logger = logging.getLogger('gitoo-cache')
+logger.setLevel(logging.INFO)
+
+
+class MirrorCache(object):
+    """ A folder of bare git mirrors, one per repository url, shared between gitoo runs.
+
+    Each mirror is protected by a lock file, so that parallel jobs can share the same cache folder.
+    The mirror is locked exclusively while it is fetched and shared while it is cloned from.
+    The exclusive lock is only taken when the mirror must be fetched, so that the clones
+    of a mirror already fetched run at the same time.
+
+    The mirror of a fork can borrow the objects of the mirror of its upstream repository
+    (git alternates), so that only the commits of the fork are fetched.
+    """
+
+    def __init__(self, path, fetch_once=False):
+        """ Init
+
+        :param string path: the folder where the mirrors are kept.
+        :param bool fetch_once: fetch each mirror only the first time it is used by this object,
+                                i.e. once per run of gitoo.
+        """
+        self.path = os.path.abspath(path)
+        os.makedirs(self.path, exist_ok=True)
+        self.fetch_once = fetch_once
+        self.hits = 0
+        self.misses = 0
+        self.reused = 0
+        self._fetched = set()
+        # The number of fetches of each mirror done by this object, and the fetches in progress
+        self._fetches = {}
+        self._in_flight = {}
+        self._stats_lock = threading.Lock()
+
+    def mirror_path(self, url):
+        """ Get the path of the mirror of the given url.
+
+        The credentials contained in the url are ignored, so that a token change
+        does not create a new mirror.
+
+        :param string url: the url of the repository.
+        :rtype: string
+        """
+        digest = hashlib.sha1(strip_credentials(url).encode()).hexdigest()
+        return os.path.join(self.path, digest + '.git')
+
+    @contextlib.contextmanager
+    def mirror(self, url, reference=None, commit=None):
+        """ Update the mirror of the given url, then yield its path.
+
+        The mirror can not be fetched or evicted by another process until the context is exited.
+
+        The fetch is skipped when the mirror already contains the given commit, and when another thread
+        of this process was fetching the mirror at the time of the call: the call waits for that fetch
+        instead of fetching again.
+
+        :param string url: the url of the repository.
+        :param string reference: Optional url of a repository that shares most of its objects
+                                 with the given one (i.e. the upstream of a fork). If its mirror exists,
+                                 a new mirror borrows its objects instead of fetching them.
+        :param string commit: Optional commit sha required from the repository.
+        :return: yield the path to the mirror
+        :rtype: string
+        """
+        path = self.mirror_path(url)
+        with self._stats_lock:
+            # The fetch in progress when the call starts, awaited instead of fetching again
+            in_flight = self._in_flight.get(path)
+
+        # Most calls only read the mirror, so they do not wait for each other
+        with _file_lock(path + '.lock', fcntl.LOCK_SH):
+            if self._is_up_to_date(url, path, commit, in_flight):
+                self._count_reused()
+                self._mark_used(path)
+                yield path
+                return
+
+        with _file_lock(path + '.lock', fcntl.LOCK_EX) as lock_file:
+            # The mirror may have been fetched by another call while it was not locked
+            if self._is_up_to_date(url, path, commit, in_flight):
+                self._count_reused()
+            else:
+                self._fetch(url, path, reference)
+                if self.fetch_once:
+                    with self._stats_lock:
+                        self._fetched.add(path)
+            self._mark_used(path)
+            fcntl.flock(lock_file, fcntl.LOCK_SH)
+            yield path
+
+    def _is_up_to_date(self, url, path, commit=None, in_flight=None):
+        """ Evaluate if the mirror can be used without being fetched. The mirror must be locked.
+
+        :param string url: the url of the repository.
+        :param string path: the path of the mirror.
+        :param string commit: Optional commit sha required from the repository.
+        :param int in_flight: Optional number of the fetch that was in progress when the mirror was asked for.
+        :rtype: bool
+        """
+        with self._stats_lock:
+            if path in self._fetched:
+                return True
+            if in_flight is not None and self._fetches.get(path, 0) >= in_flight:
+                logger.info("Mirror of %s fetched by a concurrent request", strip_credentials(url))
+                return True
+        if commit and self._has_commit(path, commit):
+            logger.info("Mirror of %s already contains %s", strip_credentials(url), commit)
+            return True
+        return False
+
+    def _count_reused(self):
+        with self._stats_lock:
+            self.reused += 1
+        metrics.count('mirror_reuses')
+
+    @staticmethod
+    def _mark_used(path):
+        """ Touch the lock file of the mirror, so that gc evicts the mirrors used the least recently first. """
+        os.utime(path + '.lock')
+
+    @staticmethod
+    def _has_commit(path, commit):
+        if not os.path.isdir(path) or not is_commit_sha(commit):
+            return False
+        return_code, _ = run_git_command(path, 'cat-file', '-e', commit + '^{commit}', capture=False)
+        return not return_code
+
+    def _fetch(self, url, path, reference=None):
+        """ Update the mirror, letting the concurrent calls of mirror know that it is being fetched. """
+        with self._stats_lock:
+            self._in_flight[path] = self._fetches.get(path, 0) + 1
+        try:
+            self._update(url, path, reference)
+            with self._stats_lock:
+                self._fetches[path] = self._in_flight[path]
+        finally:
+            with self._stats_lock:
+                del self._in_flight[path]
+
+    def _update(self, url, path, reference=None):
+        is_hit = os.path.isdir(path)
+        if not is_hit:
+            run_git(self.path, 'init', '--quiet', '--bare', path)
+            reference_path = self.mirror_path(reference) if reference else None
+            if reference_path and reference_path != path and os.path.isdir(reference_path):
+                logger.info(
+                    "Mirror of %s borrows the objects of %s", strip_credentials(url), strip_credentials(reference))
+                with open(os.path.join(path, 'objects', 'info', 'alternates'), 'w') as alternates:
+                    alternates.write(os.path.join(reference_path, 'objects') + '\n')
+
+        logger.info("Mirror cache %s for %s", 'hit' if is_hit else 'miss', strip_credentials(url))
+        try:
+            run_git(path, 'fetch', '--quiet', '--prune', url, '+refs/heads/*:refs/heads/*', '+refs/tags/*:refs/tags/*')
+        except RuntimeError:
+            if not is_hit:
+                shutil.rmtree(path, ignore_errors=True)
+            raise
+
+        with self._stats_lock:
+            if is_hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        metrics.count('mirror_hits' if is_hit else 'mirror_misses')
+
+    def log_stats(self):
+        logger.info(
+            "Mirror cache: %s hit(s), %s miss(es), %s fetch(es) saved", self.hits, self.misses, self.reused)
+
+    def gc(self, max_size):
+        """ Evict the least recently used mirrors until the cache fits in the given size.
+
+        The mirrors in use by another process are skipped, as well as the mirrors
+        whose objects are borrowed by the mirror of a fork.
+
+        :param int max_size: the maximum size of the cache in bytes.
+        :return: the paths of the evicted mirrors.
+        :rtype: list
+        """
+        mirrors = [
+            (os.path.getmtime(path + '.lock'), path, _folder_size(path))
+            for path in self._iter_mirrors()
+        ]
+        total_size = sum(size for _, _, size in mirrors)
+        evicted = []
+        for _, path, size in sorted(mirrors):
+            if total_size <= max_size:
+                break
+            if path in self._borrowed_mirrors(exclude=evicted):
+                logger.info("Mirror %s is borrowed by the mirror of a fork, it is not evicted.", path)
+                continue
+            if self._evict(path):
+                evicted.append(path)
+                total_size -= size
+
+        logger.info(
+            "Mirror cache: %s mirror(s) evicted, %s byte(s) remaining", len(evicted), total_size)
+        return evicted
+
+    def _iter_mirrors(self):
+        for file_name in os.listdir(self.path):
+            path = os.path.join(self.path, file_name)
+            if file_name.endswith('.git') and os.path.isdir(path) and os.path.exists(path + '.lock'):
+                yield path
+
+    def _borrowed_mirrors(self, exclude=()):
+        """ List the mirrors whose objects are borrowed by another mirror.
+
+        :param list exclude: the mirrors that do not borrow anything anymore (i.e. evicted).
+        :rtype: set
+        """
+        borrowed = set()
+        for path in self._iter_mirrors():
+            alternates_path = os.path.join(path, 'objects', 'info', 'alternates')
+            if path in exclude or not os.path.exists(alternates_path):
+                continue
+            with open(alternates_path, 'r') as alternates:
+                borrowed.update(os.path.dirname(line.strip()) for line in alternates if line.strip())
+        return borrowed
+
+    @staticmethod
+    def _evict(path):
+        try:
+            with _file_lock(path + '.lock', fcntl.LOCK_EX | fcntl.LOCK_NB):
+                shutil.rmtree(path)
+                return True
+        except BlockingIOError:
+            logger.info("Mirror %s is in use, it is not evicted.", path)
+            return False
+
+
+class ResultCache(object):
+    """ A folder of compressed archives of installed modules, keyed by the inputs of the installation.
+
+    An archive contains the staging folder of an add-on, as laid out in the destination.
+    """
+
+    def __init__(self, path):
+        """ Init
+
+        :param string path: the folder where the archives are kept.
+        """
+        self.path = os.path.abspath(path)
+        os.makedirs(self.path, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self._stats_lock = threading.Lock()
+
+    @staticmethod
+    def key(signature):
+        """ Compute the key of an add-on in the cache.
+
+        :param dict signature: the inputs of the installation (see Addon.signature).
+        :rtype: string
+        """
+        return signature_key(signature)
+
+    def archive_path(self, key):
+        return os.path.join(self.path, key[:2], key + '.tar.gz')
+
+    def restore(self, key, folder):
+        """ Extract the archive of the given key inside the folder.
+
+        :param string key: the key of the add-on.
+        :param string folder: the folder where the archive is extracted.
+        :return: False if the cache does not contain the key.
+        :rtype: bool
+        """
+        path = self.archive_path(key)
+        is_hit = os.path.exists(path)
+        if is_hit:
+            with tarfile.open(path, 'r:gz') as archive:
+                _extract_all(archive, folder)
+            os.utime(path)
+
+        with self._stats_lock:
+            if is_hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return is_hit
+
+    def store(self, key, folder):
+        """ Store the content of the folder in the cache under the given key.
+
+        The archive is written to a temporary file, then renamed, so that concurrent
+        processes never read a partial archive.
+
+        :param string key: the key of the add-on.
+        :param string folder: the folder to store.
+        """
+        path = self.archive_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        file_descriptor, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(file_descriptor, 'wb') as tmp_file:
+                with tarfile.open(fileobj=tmp_file, mode='w:gz', compresslevel=6) as archive:
+                    for name in sorted(os.listdir(folder)):
+                        archive.add(os.path.join(folder, name), arcname=name)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def log_stats(self):
+        logger.info("Result cache: %s hit(s), %s miss(es)", self.hits, self.misses)
+
+
+def shared_urls(urls):
+    """ Find the repositories used more than once, i.e. by many entries or by the patches of an entry.
+
+    :param iterable urls: the urls of the repositories, one per use.
+    :return: the urls, without credentials, used more than once.
+    :rtype: set
+    """
+    counts = collections.Counter(strip_credentials(url) for url in urls)
+    return {url for url, count in counts.items() if count > 1}
+
+
+def _extract_all(archive, folder):
+    if hasattr(tarfile, 'data_filter'):
+        archive.extractall(folder, filter='data')
+    else:
+        archive.extractall(folder)
+
+
+@contextlib.contextmanager
+def _file_lock(path, operation):
+    """ Lock the given file (created if missing) for the duration of the context.
+
+    :param string path: the path of the lock file.
+    :param int operation: the fcntl.flock operation.
+    :return: yield the opened lock file
+    """
+    with open(path, 'a') as lock_file:
+        fcntl.flock(lock_file, operation)
+        try:
+            yield lock_file
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _folder_size(path):
+    size = 0
+    for directory, _, files in os.walk(path):
+        for file_name in files:
+            file_path = os.path.join(directory, file_name)
+            if not os.path.islink(file_path):
+                size += os.path.getsize(file_path)
+    return size
+
+
+def parse_size(size):
+    """ Parse a size like 500M or 10G into a number of bytes.
+
+    :param string size: the size with an optional K, M, G or T suffix.
+    :rtype: int
+    :raise: ValueError if the size is not valid.
+    """
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    size = size.strip().upper().rstrip('B')
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
@@ -0,0 +1,210 @@
+import os
+import json
+import logging
+import fnmatch
+import tempfile
+import contextlib
+
+logger = logging.getLogger('gitoo-catalog')
+logger.setLevel(logging.INFO)
+
+CATALOG_FILE = '.gitoo-modules.json'
+SQLITE_FILE = '.gitoo-modules.sqlite'
+CATALOG_VERSION = 1
+
+JSON = 'json'
+SQLITE = 'sqlite'
+INDEX_FORMATS = (JSON, SQLITE)
+
+# The fields of a module that can be queried
+FIELDS = ('name', 'path', 'version', 'depends', 'installable', 'url', 'branch', 'commit')
+TRUE_VALUES = ('1', 'true', 'yes')
+
+
+class ModuleCatalog(object):
+    """ The modules installed inside a destination folder, kept in a file next to them.
+
+    For each module, the catalog contains the values of its manifest (version, depends, installable),
+    its folder relative to the destination, and the repository, the commit and the patches it comes from.
+    The tools that need to know the installed modules read the catalog instead of scanning the destination.
+    """
+
+    def __init__(self, path):
+        """ Init
+
+        :param string path: the path of the catalog file.
+        """
+        self.path = path
+        self.modules = {}
+        if os.path.exists(path):
+            with open(path, 'r') as catalog_file:
+                data = json.load(catalog_file)
+            if data.get('version') == CATALOG_VERSION:
+                self.modules = data['modules']
+            else:
+                logger.warning("The catalog %s has an unknown version, it is ignored.", path)
+
+    def update(self, entries):
+        """ Add the modules installed from the given entries, which replace the modules with the same name.
+
+        :param list entries: the api.EntryResult of the installed entries, in the order they were installed.
+        """
+        for entry in entries:
+            for module in entry.modules:
+                self.modules[module['name']] = {
+                    'name': module['name'],
+                    'path': os.path.relpath(module['path'], entry.destination),
+                    'version': module['version'],
+                    'depends': module['depends'],
+                    'installable': module['installable'],
+                    'url': entry.url,
+                    'branch': entry.branch,
+                    'commit': entry.commit,
+                    'patches': entry.patches,
+                }
+
+    def prune(self, destination):
+        """ Forget the modules whose folder is not in the destination anymore.
+
+        :param string destination: the folder where the modules are installed.
+        :return: the names of the forgotten modules.
+        :rtype: list
+        """
+        removed = sorted(
+            name for name, module in self.modules.items()
+            if not os.path.isdir(os.path.join(destination, module['path']))
+        )
+        for name in removed:
+            del self.modules[name]
+        return removed
+
+    def query(self, conditions=()):
+        """ Find the modules that match every condition.
+
+        :param list conditions: the (field, pattern) conditions (see parse_conditions).
+        :return: the matching modules, sorted by name.
+        :rtype: list
+        """
+        return [
+            module for _, module in sorted(self.modules.items())
+            if all(_matches(module, field, pattern) for field, pattern in conditions)
+        ]
+
+    def save(self, sqlite=False):
+        """ Write the catalog file atomically, with its SQLite version next to it if asked.
+
+        :param bool sqlite: also write the catalog as a SQLite database.
+        """
+        data = {'version': CATALOG_VERSION, 'modules': self.modules}
+        with _atomic_file(self.path) as tmp_path:
+            with open(tmp_path, 'w') as tmp_file:
+                json.dump(data, tmp_file, sort_keys=True, separators=(',', ':'))
+        if sqlite:
+            with _atomic_file(os.path.join(os.path.dirname(self.path), SQLITE_FILE)) as tmp_path:
+                _write_sqlite(tmp_path, self.modules)
+
+
+def write_catalog(folder, entries, destination=None, sqlite=False):
+    """ Record the modules installed from the given entries in the catalog of a folder.
+
+    :param string folder: the folder of the catalog file.
+    :param list entries: the api.EntryResult of the installed entries.
+    :param string destination: Optional folder of the modules, to forget the modules not installed anymore.
+    :param bool sqlite: also write the catalog as a SQLite database.
+    :rtype: ModuleCatalog
+    """
+    catalog = ModuleCatalog(os.path.join(folder, CATALOG_FILE))
+    catalog.update(entries)
+    if destination:
+        removed = catalog.prune(destination)
+        if removed:
+            logger.info("Catalog: %s module(s) not installed anymore: %s", len(removed), ', '.join(removed))
+    catalog.save(sqlite=sqlite)
+    return catalog
+
+
+def read_catalog(destination):
+    """ Read the catalog of the modules installed in a destination folder.
+
+    :param string destination: the folder where the modules are installed.
+    :raise: RuntimeError if the folder has no catalog.
+    :rtype: ModuleCatalog
+    """
+    path = os.path.join(destination, CATALOG_FILE)
+    if not os.path.exists(path):
+        msg = "No index of modules in {}, the add-ons must be installed with --modules-index first.".format(destination)
+        logger.error(msg)
+        raise RuntimeError(msg)
+    return ModuleCatalog(path)
+
+
+def parse_conditions(conditions):
+    """ Parse the conditions of a query, given as field=pattern.
+
+    The pattern may contain shell wildcards (i.e. name=hr_*). A list field (depends) matches
+    when one of its values matches. A boolean field (installable) is given as true or false.
+
+    :param list conditions: the conditions, i.e. ['depends=hr', 'installable=true'].
+    :rtype: list
+    """
+    parsed = []
+    for condition in conditions:
+        field, separator, pattern = condition.partition('=')
+        field = field.strip()
+        if not separator or field not in FIELDS:
+            msg = "Invalid condition {}, it should be field=value with a field among {}.".format(
+                condition, ', '.join(FIELDS))
+            logger.error(msg)
+            raise RuntimeError(msg)
+        parsed.append((field, pattern.strip()))
+    return parsed
+
+
+def _matches(module, field, pattern):
+    value = module.get(field)
+    if isinstance(value, bool):
+        return value == (pattern.lower() in TRUE_VALUES)
+    if isinstance(value, list):
+        return any(fnmatch.fnmatchcase(item, pattern) for item in value)
+    return fnmatch.fnmatchcase('' if value is None else str(value), pattern)
+
+
+@contextlib.contextmanager
+def _atomic_file(path):
+    """ Yield a temporary path next to the given path, moved over it if no error is raised. """
+    file_descriptor, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path) or '.', prefix='.gitoo-modules-', suffix='.tmp')
+    os.close(file_descriptor)
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _write_sqlite(path, modules):
+    """ Write the modules in a SQLite database, with a table of their dependencies. """
+    import sqlite3
+
+    os.remove(path)
+    connection = sqlite3.connect(path)
+    try:
+        with connection:
+            connection.execute(
+                'CREATE TABLE modules (name TEXT PRIMARY KEY, path TEXT, version TEXT, installable INTEGER, '
+                'url TEXT, branch TEXT, "commit" TEXT, patches TEXT)')
+            connection.execute('CREATE TABLE depends (module TEXT, name TEXT)')
+            connection.execute('CREATE INDEX depends_name ON depends (name)')
+            connection.executemany('INSERT INTO modules VALUES (?, ?, ?, ?, ?, ?, ?, ?)', [
+                (
+                    module['name'], module['path'], module['version'], int(module['installable']),
+                    module['url'], module['branch'], module['commit'], json.dumps(module['patches']),
+                )
+                for _, module in sorted(modules.items())
+            ])
+            connection.executemany('INSERT INTO depends VALUES (?, ?)', [
+                (module['name'], depend) for _, module in sorted(modules.items()) for depend in module['depends']
+            ])
+    finally:
+        connection.close()
@@ -1,14 +1,32 @@
-import yaml
+import json
 import logging
 import os
+import signal
+import threading
+import contextlib
 
 import click
 from click_didyoumean import DYMMixin
 from click_help_colors import HelpColorsGroup
 
+from . import api
 from . import core
+from . import cache as mirror_cache
+from . import lock as locking
+from . import store as file_store
+from . import output as tar_output
+from . import strip as stripping
+from . import bytecode
+from . import catalog
+from . import planner
+from . import server as serving
 
 logger = logging.getLogger('gitoo')
+DEFAULT_LOCK_FILE = 'gitoo.lock'
+MODULES_NAMES = 'names'
+MODULES_TABLE = 'table'
+MODULES_JSON = 'json'
+MODULES_FORMATS = (MODULES_NAMES, MODULES_TABLE, MODULES_JSON)
 logging.basicConfig()
 logger.setLevel(logging.INFO)
 
@@ -23,16 +41,257 @@ class AllGroup(DYMMixin, HelpColorsGroup, click.Group):  # pylint: disable=too-m
     help_options_color='green'
     )
 @click.version_option()
-def entry_point():
-    pass
+@click.option('--git-backend', default=None, envvar=core.GIT_BACKEND_ENV,
+              type=click.Choice(sorted(core.GIT_BACKENDS)),
+              help='The way git is run. Default: subprocess, which needs no other package.')
+def entry_point(git_backend=None):
+    if git_backend:
+        core.set_git_backend(git_backend)
+
+
+class JobsType(click.ParamType):
+    """A number of jobs, or auto."""
+
+    name = 'jobs'
+
+    def convert(self, value, param, ctx):
+        if value == planner.AUTO_JOBS or isinstance(value, int):
+            return value
+        try:
+            jobs = int(value)
+        except ValueError:
+            jobs = 0
+        if jobs < 1:
+            self.fail('{} is not a positive number of jobs nor {}.'.format(value, planner.AUTO_JOBS), param, ctx)
+        return jobs
+
+
+def install_options(command):
+    """Add the options shared by the commands that install the add-ons of a conf file."""
+    options = [
+        click.option('--conf_file', default=None, type=click.Path(), help='The path where the conf file is.'),
+        click.option('--destination', default='', type=click.Path(),
+                     help='The path where the add-ons should be installed to.'),
+        click.option('--lock-file', default=None, type=click.Path(), help='The path of the lock file.'),
+    ]
+    for option in reversed(options):
+        command = option(command)
+    return build_options(command)
+
+
+def build_options(command):
+    """Add the options shared by the commands that install add-ons."""
+    options = [
+        click.option('--lang', default='', type=str,
+                     help='The languages (i.e. fr,fr_CA,es) to include in i18n folders.'),
+        click.option('--jobs', default='1', type=JobsType(),
+                     help='The number of add-ons to prepare concurrently, or auto to choose it from the history.'),
+        click.option('--history-file', default=None, type=click.Path(),
+                     help='The file where the durations of the past runs are kept. Default: inside --cache-dir.'),
+        click.option('--cache-dir', default=None, type=click.Path(),
+                     help='The folder where the git mirrors are cached.'),
+        click.option('--shallow', is_flag=True, help='Fetch only the commit to install instead of the whole history.'),
+        click.option('--sparse', is_flag=True, help='Checkout only the included modules.'),
+        click.option('--result-cache', default=None, type=click.Path(),
+                     help='The folder where installed modules are cached.'),
+        click.option('--locked', is_flag=True, help='Use the commits of the lock file for the refs without commit.'),
+        click.option('--export', default=core.CHECKOUT, type=click.Choice(core.EXPORT_MODES),
+                     help='Checkout the repositories or stream the modules with git archive.'),
+        click.option('--metrics-file', default=None, type=click.Path(),
+                     help='The path of a JSON report with the duration of each phase.'),
+        click.option('--trace-file', default=None, type=click.Path(),
+                     help='The path of a timeline of the phases, in the Chrome trace format.'),
+        click.option('--store-dir', default=None, type=click.Path(),
+                     help='The folder of a store where the files of the modules are deduplicated.'),
+        click.option('--store-link', default=file_store.HARDLINK, type=click.Choice(file_store.LINK_MODES),
+                     help='Link the files of the destination to the store with hard links or reflinks.'),
+        click.option('--strip', default='', type=str,
+                     help='The files to remove from the modules: profiles ({}) or globs, '
+                          'separated by commas.'.format(', '.join(sorted(stripping.PROFILES)))),
+        click.option('--compile', 'byte_compile', is_flag=True,
+                     help='Byte-compile the python files of the modules with a pool of processes.'),
+        click.option('--compile-optimize', default=0, type=click.IntRange(min=0, max=2),
+                     help='The optimization level of the compiled files, as python -O (1) and -OO (2).'),
+        click.option('--compile-invalidation', default=bytecode.CHECKED_HASH,
+                     type=click.Choice(bytecode.INVALIDATION_MODES),
+                     help='How python checks the compiled files. The hashes give reproducible files.'),
+        click.option('--modules-index', default=None, type=click.Choice(catalog.INDEX_FORMATS),
+                     help='Write the index of the installed modules in the destination (sqlite: also as a database).'),
+        click.option('--on-shadow', default=planner.SHADOW_WARN, type=click.Choice(planner.SHADOW_POLICIES),
+                     help='What to do when a module is replaced by a later entry: warn, error or last-wins. '
+                          'The replaced copy is never prepared.'),
+        click.option('--reproducible', is_flag=True,
+                     help='Normalize the times (SOURCE_DATE_EPOCH or the commit time) and the permissions '
+                          'of the files, then print the digest of the destination.'),
+    ]
+    for option in reversed(options):
+        command = option(command)
+    return command
+
+
+@entry_point.command()
+@install_options
+@click.option('--output-tar', default=None, type=click.Path(allow_dash=True),
+              help='Stream the add-ons as a tar archive to the given file (- for stdout) instead of the destination.')
+@click.option('--output-compression', default=None, type=click.Choice(tar_output.COMPRESSIONS),
+              help='The compression of the tar archive. Default: guessed from the extension of the file.')
+@click.option('--server', default=None, type=click.Path(),
+              help='Install through the gitoo server listening on the given Unix socket (see gitoo serve).')
+def install_all(
+    destination='', conf_file=None, lang=None, jobs=1, cache_dir=None, shallow=False, sparse=False,
+    result_cache=None, locked=False, lock_file=None, export=core.CHECKOUT, metrics_file=None, trace_file=None,
+    store_dir=None, store_link=file_store.HARDLINK, strip='', history_file=None, output_tar=None,
+    output_compression=None, server=None,
+    byte_compile=False, compile_optimize=0, compile_invalidation=bytecode.CHECKED_HASH, modules_index=None,
+    on_shadow=planner.SHADOW_WARN, reproducible=False,
+):
+    return _install_all(
+        destination, conf_file, lang, jobs=jobs, cache_dir=cache_dir, shallow=shallow, sparse=sparse,
+        result_cache=result_cache, locked=locked, lock_path=lock_file, export=export,
+        metrics_file=metrics_file, trace_file=trace_file, store_dir=store_dir, store_link=store_link,
+        strip=strip, history_file=history_file, output_tar=output_tar, output_compression=output_compression,
+        server=server, byte_compile=byte_compile, compile_optimize=compile_optimize,
+        compile_invalidation=compile_invalidation, modules_index=modules_index, on_shadow=on_shadow,
+        reproducible=reproducible)
+
+
+@entry_point.command()
+@install_options
+def sync(
+    destination='', conf_file=None, lang=None, jobs=1, cache_dir=None, shallow=False, sparse=False,
+    result_cache=None, locked=False, lock_file=None, export=core.CHECKOUT, metrics_file=None, trace_file=None,
+    store_dir=None, store_link=file_store.HARDLINK, strip='', history_file=None,
+    byte_compile=False, compile_optimize=0, compile_invalidation=bytecode.CHECKED_HASH, modules_index=None,
+    on_shadow=planner.SHADOW_WARN, reproducible=False,
+):
+    """Install only the add-ons that changed since the last sync."""
+    return _sync(
+        destination, conf_file, lang, jobs=jobs, cache_dir=cache_dir, shallow=shallow, sparse=sparse,
+        result_cache=result_cache, locked=locked, lock_path=lock_file, export=export,
+        metrics_file=metrics_file, trace_file=trace_file, store_dir=store_dir, store_link=store_link, strip=strip,
+        history_file=history_file, byte_compile=byte_compile, compile_optimize=compile_optimize,
+        compile_invalidation=compile_invalidation, modules_index=modules_index, on_shadow=on_shadow,
+        reproducible=reproducible)
+
+
+@entry_point.command(name='install-many')
+@click.option('--target', 'targets', required=True, multiple=True, nargs=2, type=click.Path(),
+              help='A conf file and the destination of its add-ons. Repeat the option for each destination.')
+@build_options
+def install_many(
+    targets, lang=None, jobs=1, cache_dir=None, shallow=False, sparse=False, result_cache=None, locked=False,
+    export=core.CHECKOUT, metrics_file=None, trace_file=None, store_dir=None, store_link=file_store.HARDLINK,
+    strip='', history_file=None,
+    byte_compile=False, compile_optimize=0, compile_invalidation=bytecode.CHECKED_HASH, modules_index=None,
+    on_shadow=planner.SHADOW_WARN, reproducible=False,
+):
+    """Install the add-ons of many conf files, each one in its own destination.
+
+    The repositories used by many conf files are fetched once.
+    """
+    return _install_many(
+        targets, lang, jobs=jobs, cache_dir=cache_dir, shallow=shallow, sparse=sparse,
+        result_cache=result_cache, locked=locked, export=export,
+        metrics_file=metrics_file, trace_file=trace_file, store_dir=store_dir, store_link=store_link, strip=strip,
+        history_file=history_file, byte_compile=byte_compile, compile_optimize=compile_optimize,
+        compile_invalidation=compile_invalidation, modules_index=modules_index, on_shadow=on_shadow,
+        reproducible=reproducible)
+
+
+@entry_point.command()
+@install_options
+def plan(
+    destination='', conf_file=None, lang=None, jobs=1, cache_dir=None, shallow=False, sparse=False,
+    result_cache=None, locked=False, lock_file=None, export=core.CHECKOUT, metrics_file=None, trace_file=None,
+    store_dir=None, store_link=file_store.HARDLINK, strip='', history_file=None,
+    byte_compile=False, compile_optimize=0, compile_invalidation=bytecode.CHECKED_HASH, modules_index=None,
+    on_shadow=planner.SHADOW_WARN, reproducible=False,
+):
+    """Print the expected schedule of install_all, without installing anything."""
+    return _plan(
+        destination, conf_file, lang, jobs=jobs, cache_dir=cache_dir, shallow=shallow, sparse=sparse,
+        result_cache=result_cache, locked=locked, lock_path=lock_file, export=export, strip=strip,
+        history_file=history_file, byte_compile=byte_compile, compile_optimize=compile_optimize,
+        compile_invalidation=compile_invalidation, reproducible=reproducible)
+
+
+@entry_point.command()
+@click.option('--destination', default='', type=click.Path(), help='The path where the add-ons are installed.')
+@click.option('--where', 'conditions', multiple=True, type=str,
+              help='A condition on the modules, as field=value (i.e. depends=hr, name=hr_*). Repeat it to combine.')
+@click.option('--format', 'output_format', default=MODULES_NAMES, type=click.Choice(MODULES_FORMATS),
+              help='Print the names of the modules, a table or the JSON of the index.')
+def modules(destination='', conditions=(), output_format=MODULES_NAMES):
+    """List the installed modules from the index written with --modules-index."""
+    return _modules(destination, conditions, output_format)
 
 
 @entry_point.command()
 @click.option('--conf_file', default=None, type=click.Path(), help='The path where the conf file is.')
-@click.option('--destination', default='', type=click.Path(), help='The path where the add-ons should be installed to.')
-@click.option('--lang', default='', type=str, help='The languages (i.e. fr,fr_CA,es) to include in i18n folders.')
-def install_all(destination='', conf_file=None, lang=None):
-    return _install_all(destination, conf_file, lang)
+@click.option('--lock-file', default=None, type=click.Path(), help='The path of the lock file.')
+@click.option('--jobs', default=locking.MAX_JOBS, type=click.IntRange(min=1),
+              help='The number of refs to resolve concurrently.')
+def lock(conf_file=None, lock_file=None, jobs=locking.MAX_JOBS):
+    """Pin every branch of the conf file to a commit inside a lock file."""
+    return _lock(conf_file, lock_file, jobs=jobs)
+
+
+@entry_point.command()
+@click.option('--socket', 'socket_path', required=True, type=click.Path(), help='The path of the Unix socket.')
+@click.option('--cache-dir', required=True, type=click.Path(), help='The folder where the git mirrors are cached.')
+@click.option('--prefetch', 'prefetch_files', multiple=True, type=click.Path(exists=True),
+              help='A conf file whose repositories are kept warm. Repeat the option for each conf file.')
+@click.option('--prefetch-interval', default=None, type=click.FloatRange(min=1),
+              help='The number of seconds between two prefetches. Default: only at start.')
+@click.option('--max-requests', default=serving.DEFAULT_MAX_REQUESTS, type=click.IntRange(min=1),
+              help='The number of installations served at the same time.')
+def serve(socket_path, cache_dir, prefetch_files=(), prefetch_interval=None, max_requests=serving.DEFAULT_MAX_REQUESTS):
+    """Serve the installations of install_all --server, with the mirrors kept warm."""
+    return _serve(socket_path, cache_dir, prefetch_files, prefetch_interval, max_requests)
+
+
+@entry_point.group()
+def cache():
+    """Manage the cache of git mirrors."""
+
+
+@cache.command()
+@click.option('--cache-dir', required=True, type=click.Path(), help='The folder where the git mirrors are cached.')
+@click.option('--max-size', required=True, type=str, help='The maximum size of the cache (i.e. 500M, 10G).')
+def gc(cache_dir, max_size):
+    """Evict the least recently used mirrors."""
+    mirror_cache.MirrorCache(cache_dir).gc(mirror_cache.parse_size(max_size))
+
+
+@entry_point.group()
+def store():
+    """Manage the store of deduplicated files."""
+
+
+@store.command(name='gc')
+@click.option('--store-dir', required=True, type=click.Path(), help='The folder of the store.')
+def store_gc(store_dir):
+    """Remove the files that are not used by any destination."""
+    file_store.FileStore(store_dir).gc()
+
+
+def _lock(conf_file='', lock_path=None, jobs=locking.MAX_JOBS):
+    """Resolve every branch of the conf file to a commit and write them to the lock file.
+
+    :param string conf_file: path to a conf file that describe the add-ons to install.
+                             Default: pwd/third_party_addons.yaml
+    :param string lock_path: path to the lock file. Default: gitoo.lock next to the conf file.
+    :param int jobs: the number of refs to resolve concurrently.
+    """
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+    conf_file = conf_file or os.path.join(dir_path, '..', "third_party_addons.yaml")
+    lock_path = lock_path or os.path.join(os.path.dirname(os.path.realpath(conf_file)), DEFAULT_LOCK_FILE)
+
+    data = _load_yaml(conf_file)
+
+    refs = locking.lock(data, jobs=jobs)
+    locking.write_lock_file(lock_path, refs)
+    logger.info("%s ref(s) locked in %s", len(refs), lock_path)
 
 
 def _install_one(
@@ -50,21 +309,21 @@ def _install_one(
     :param string lang: languages to include
     :param list patches: Optional list of patches to apply.
     """
-    patches = patches or []
-    patches = [
-        core.FilePatch(file=patch['file'], work_directory=work_directory)
-        if 'file' in patch else core.Patch(**patch)
-        for patch in patches
-    ]
-    addon_cls = core.Base if base else core.Addon
-    addon = addon_cls(
+    addon = api.make_addon(
         repo_url, branch, commit=commit, patches=patches,
         exclude_modules=exclude_modules, include_modules=include_modules,
-        lang=lang)
+        base=base, work_directory=work_directory, lang=lang)
     addon.install(destination)
 
 
-def _install_all(destination='', conf_file='', lang=''):
+def _install_all(
+    destination='', conf_file='', lang='', jobs=1, cache_dir=None, shallow=False, sparse=False,
+    result_cache=None, locked=False, lock_path=None, export=core.CHECKOUT, metrics_file=None, trace_file=None,
+    store_dir=None, store_link=file_store.HARDLINK, strip='', history_file=None, output_tar=None,
+    output_compression=None, server=None,
+    byte_compile=False, compile_optimize=0, compile_invalidation=bytecode.CHECKED_HASH, modules_index=None,
+    on_shadow=planner.SHADOW_WARN, reproducible=False,
+):
     """Use the conf file to list all the third party Odoo add-ons that will be installed
     and the patches that should be applied.
 
@@ -72,24 +331,235 @@ def _install_all(destination='', conf_file='', lang=''):
                                Default: pwd/3rd
     :param string conf_file: path to a conf file that describe the add-ons to install.
                              Default: pwd/third_party_addons.yaml
+    :param int jobs: the number of add-ons to prepare concurrently, or auto.
+    :param string cache_dir: Optional folder where the git mirrors are cached.
+    :param bool shallow: fetch only the commits to install instead of the whole history.
+    :param bool sparse: checkout only the included modules.
+    :param string result_cache: Optional folder where installed modules are cached.
+    :param bool locked: use the commits of the lock file for the refs without commit.
+    :param string lock_path: path to the lock file. Default: gitoo.lock next to the conf file.
+    :param string export: checkout the repositories or stream the modules with git archive.
+    :param string metrics_file: Optional path of a JSON report with the duration of each phase.
+    :param string trace_file: Optional path of a timeline of the phases, in the Chrome trace format.
+    :param string store_dir: Optional folder of a store where the files of the modules are deduplicated.
+    :param string store_link: link the files to the store with hard links or reflinks.
+    :param string strip: the strip profiles and globs of the files to remove from the modules, separated by commas.
+    :param string history_file: Optional file where the durations of the past runs are kept.
+                                Default: inside the cache folder, if given.
+    :param string output_tar: Optional path of a tar archive (- for stdout) where the add-ons are streamed
+                              instead of the destination folder.
+    :param string output_compression: the compression of the tar archive, none, gzip or zstd.
+                                      Default: guessed from the extension of the path.
+    :param string server: Optional Unix socket of a gitoo server that installs the add-ons.
+                          The mirrors and the history of the server are used.
+    :param bool byte_compile: byte-compile the python files of the modules.
+    :param int compile_optimize: the optimization level of the compiled files (0, 1 or 2).
+    :param string compile_invalidation: how python checks the compiled files (see bytecode.INVALIDATION_MODES).
+    :param string modules_index: Optional format of the index of the installed modules (json or sqlite).
+    :param string on_shadow: what to do when a module is replaced by a later entry: warn, error or last-wins.
+    :param bool reproducible: normalize the times and the permissions of the files and print the digest
+                              of the destination.
+    :return: the result of the installation (as a dict when installed through a server).
+    :rtype: api.InstallResult
+    """
+    if server:
+        if output_tar:
+            msg = "--output-tar can not be used with --server."
+            logger.error(msg)
+            raise RuntimeError(msg)
+        if cache_dir or shallow or history_file:
+            logger.warning("--cache-dir, --shallow and --history-file are ignored, the server uses its own mirrors.")
+        data, work_directory = _read_conf_file(conf_file, locked=locked, lock_path=lock_path)
+        result = serving.install(
+            server, data, _default_destination(destination), work_directory, lang=lang, jobs=jobs,
+            sparse=sparse, result_cache=result_cache, export=export, store_dir=store_dir, store_link=store_link,
+            strip=strip, metrics_file=metrics_file, trace_file=trace_file, byte_compile=byte_compile,
+            compile_optimize=compile_optimize, compile_invalidation=compile_invalidation,
+            modules_index=modules_index, on_shadow=on_shadow, reproducible=reproducible)
+        logger.info("%s entr(ies) installed by the server in %.1fs", len(result['entries']), result['seconds'])
+        _echo_digest(result.get('digest'), _default_destination(destination))
+        return result
+
+    with contextlib.ExitStack() as stack:
+        output = stack.enter_context(
+            tar_output.open_tar_output(output_tar, output_compression, reproducible)) if output_tar else None
+        return _install_many(
+            [(conf_file, destination)], lang, jobs=jobs, cache_dir=cache_dir, shallow=shallow, sparse=sparse,
+            result_cache=result_cache, locked=locked, lock_path=lock_path, export=export,
+            metrics_file=metrics_file, trace_file=trace_file, store_dir=store_dir, store_link=store_link,
+            strip=strip, history_file=history_file, output=output, byte_compile=byte_compile,
+            compile_optimize=compile_optimize, compile_invalidation=compile_invalidation,
+            modules_index=modules_index, on_shadow=on_shadow, reproducible=reproducible)[0]
+
+
+def _install_many(
+    targets, lang='', jobs=1, cache_dir=None, shallow=False, sparse=False,
+    result_cache=None, locked=False, lock_path=None, export=core.CHECKOUT, metrics_file=None, trace_file=None,
+    store_dir=None, store_link=file_store.HARDLINK, strip='', history_file=None, output=None,
+    byte_compile=False, compile_optimize=0, compile_invalidation=bytecode.CHECKED_HASH, modules_index=None,
+    on_shadow=planner.SHADOW_WARN, reproducible=False,
+):
+    """Install the add-ons of many conf files, each one in its own destination, in a single run.
+
+    The other parameters are the same as for _install_all (see api.install_many).
+
+    :param list targets: the path of each conf file, with the folder where its add-ons should end up at.
+    :param TarOutput output: Optional archive where the add-ons are written instead of the destinations.
+    :return: the result of each conf file.
+    :rtype: list
+    """
+    confs = [
+        _read_conf_file(conf_file, locked=locked, lock_path=lock_path) + (_default_destination(destination),)
+        for conf_file, destination in targets
+    ]
+    results = api.install_many(
+        [(data, destination, work_directory) for data, work_directory, destination in confs],
+        lang, jobs=jobs, cache_dir=cache_dir, shallow=shallow, sparse=sparse, result_cache=result_cache,
+        export=export, store_dir=store_dir, store_link=store_link, strip=strip, history_file=history_file,
+        metrics_file=metrics_file, trace_file=trace_file, output=output, byte_compile=byte_compile,
+        compile_optimize=compile_optimize, compile_invalidation=compile_invalidation,
+        modules_index=modules_index, on_shadow=on_shadow, reproducible=reproducible)
+    for (_, _, destination), result in zip(confs, results):
+        _echo_digest(result.digest, destination)
+    return results
+
+
+def _sync(
+    destination='', conf_file='', lang='', jobs=1, cache_dir=None, shallow=False, sparse=False,
+    result_cache=None, locked=False, lock_path=None, export=core.CHECKOUT, metrics_file=None, trace_file=None,
+    store_dir=None, store_link=file_store.HARDLINK, strip='', history_file=None,
+    byte_compile=False, compile_optimize=0, compile_invalidation=bytecode.CHECKED_HASH, modules_index=None,
+    on_shadow=planner.SHADOW_WARN, reproducible=False,
+):
+    """Install the add-ons of the conf file whose inputs changed since the last sync.
+
+    The branches without commit are resolved with git ls-remote, unless the lock file is used.
+    The parameters are the same as for _install_all.
+
+    :return: the number of add-ons installed and skipped.
+    :rtype: Tuple[int, int]
+    """
+    data, work_directory = _read_conf_file(conf_file, locked=locked, lock_path=lock_path)
+    return api.sync(
+        data, _default_destination(destination), work_directory, lang, jobs=jobs, cache_dir=cache_dir,
+        shallow=shallow, sparse=sparse, result_cache=result_cache, export=export, store_dir=store_dir,
+        store_link=store_link, strip=strip, history_file=history_file,
+        metrics_file=metrics_file, trace_file=trace_file, byte_compile=byte_compile,
+        compile_optimize=compile_optimize, compile_invalidation=compile_invalidation,
+        modules_index=modules_index, on_shadow=on_shadow, reproducible=reproducible)
+
+
+def _plan(
+    destination='', conf_file='', lang='', jobs=1, cache_dir=None, shallow=False, sparse=False,
+    result_cache=None, locked=False, lock_path=None, export=core.CHECKOUT, strip='', history_file=None,
+    byte_compile=False, compile_optimize=0, compile_invalidation=bytecode.CHECKED_HASH, reproducible=False,
+):
+    """Print the expected schedule of the add-ons of the conf file, without cloning anything.
+
+    The caches are only read. The parameters are the same as for _install_all.
+
+    :return: the planned entries, in the order they start.
+    :rtype: list
+    """
+    data, work_directory = _read_conf_file(conf_file, locked=locked, lock_path=lock_path)
+    starts, total, jobs = api.plan(
+        data, _default_destination(destination), work_directory, lang, jobs=jobs, cache_dir=cache_dir,
+        shallow=shallow, sparse=sparse, result_cache=result_cache, export=export, strip=strip,
+        history_file=history_file, byte_compile=byte_compile, compile_optimize=compile_optimize,
+        compile_invalidation=compile_invalidation, reproducible=reproducible)
+    entries = [entry for entry, _, _ in starts]
+
+    click.echo("{} entr(ies), {} job(s), estimated duration {:.1f}s".format(len(entries), jobs, total))
+    click.echo("{:>4} {:>8} {:>8} {:>10} {:>10}  {:<16} {}".format(
+        'job', 'start', 'seconds', 'fetched', 'written', 'status', 'entry'))
+    for entry, job, start in starts:
+        click.echo("{:>4} {:>7.1f}s {:>7}s {:>10} {:>10}  {:<16} {}".format(
+            job + 1, start, '{:.1f}'.format(entry.seconds) if entry.known else '?',
+            planner.format_size(entry.bytes_fetched), planner.format_size(entry.bytes_written),
+            entry.status, entry.addon.metrics_entry()))
+    click.echo("Estimated bytes: {} fetched, {} written".format(
+        planner.format_size(sum(entry.bytes_fetched for entry in entries)),
+        planner.format_size(sum(entry.bytes_written for entry in entries))))
+    return entries
+
+
+def _modules(destination='', conditions=(), output_format=MODULES_NAMES):
+    """Print the modules of the index of the destination that match the conditions.
+
+    Only the index is read, the modules are not scanned.
+
+    :param string destination: the folder where the add-ons are installed. Default: pwd/3rd
+    :param list conditions: the conditions on the modules, as field=value.
+    :param string output_format: names, table or json.
+    :return: the matching modules.
+    :rtype: list
+    """
+    found = api.modules(_default_destination(destination), conditions)
+    if output_format == MODULES_JSON:
+        click.echo(json.dumps(found, indent=2, sort_keys=True))
+    elif output_format == MODULES_TABLE:
+        click.echo("{:<40} {:<14} {:<11} {}".format('module', 'version', 'installable', 'source'))
+        for module in found:
+            click.echo("{:<40} {:<14} {:<11} {}@{}".format(
+                module['name'], module['version'], 'yes' if module['installable'] else 'no',
+                module['url'], (module['commit'] or module['branch'])[:12]))
+    else:
+        for module in found:
+            click.echo(module['name'])
+    return found
+
+
+def _serve(socket_path, cache_dir, prefetch_files=(), prefetch_interval=None,
+           max_requests=serving.DEFAULT_MAX_REQUESTS):
+    """Run the server until it is interrupted.
+
+    :param string socket_path: the path of the Unix socket.
+    :param string cache_dir: the folder where the git mirrors are cached.
+    :param list prefetch_files: the conf files whose repositories are kept warm.
+    :param float prefetch_interval: Optional number of seconds between two prefetches.
+    :param int max_requests: the number of installations served at the same time.
+    """
+    urls = [url for conf_file in prefetch_files for url in api.iter_config_urls(_read_conf_file(conf_file)[0])]
+    server = serving.Server(
+        socket_path, cache_dir, prefetch_urls=urls, interval=prefetch_interval, max_requests=max_requests)
+    signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown).start())
+    try:
+        server.serve()
+    except KeyboardInterrupt:
+        logger.info("Server stopped")
+
+
+def _echo_digest(digest, destination):
+    """Print the digest of a destination installed with --reproducible, as sha256sum does."""
+    if digest:
+        click.echo("{}  {}".format(digest, destination))
+
+
+def _default_destination(destination):
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+    return os.path.abspath(destination or os.path.join(dir_path, '..', '3rd'))
+
+
+def _load_yaml(path):
+    # yaml is imported only when a conf file is read, since it slows down the start of gitoo
+    import yaml  # pylint: disable=import-outside-toplevel
+    with open(path, "r") as conf_data:
+        return yaml.safe_load(conf_data)
+
+
+def _read_conf_file(conf_file, locked=False, lock_path=None):
+    """Read the conf file, with the commits of the lock file if required.
+
+    :return: the content of the conf file and the directory of the conf file.
+    :rtype: Tuple[list, str]
     """
     dir_path = os.path.dirname(os.path.realpath(__file__))
-    destination = destination or os.path.join(dir_path, '..', '3rd')
     conf_file = conf_file or os.path.join(dir_path, '..', "third_party_addons.yaml")
     work_directory = os.path.dirname(os.path.realpath(conf_file))
 
-    with open(conf_file, "r") as conf_data:
-        data = yaml.safe_load(conf_data)
-        for addons in data:
-            _install_one(
-                addons['url'],
-                addons['branch'],
-                os.path.abspath(destination),
-                commit=addons.get('commit'),
-                patches=addons.get('patches'),
-                exclude_modules=addons.get('excludes'),
-                include_modules=addons.get('includes'),
-                base=addons.get('base'),
-                work_directory=work_directory,
-                lang=lang,
-            )
+    data = _load_yaml(conf_file)
+
+    if locked:
+        lock_path = lock_path or os.path.join(work_directory, DEFAULT_LOCK_FILE)
+        data = locking.apply_lock(data, locking.read_lock_file(lock_path))
+    return data, work_directory
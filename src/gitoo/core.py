@@ -1,65 +1,363 @@
 import os
+import json
+import errno
+import ctypes
+import string
+import hashlib
 import logging
 import subprocess
 import tempfile
+import threading
+import time
 import shutil
+import tarfile
+import functools
 import contextlib
+import collections
+from concurrent import futures
+from urllib.parse import urlsplit, urlunsplit
 
-import pystache
-from pystache.parser import _EscapeNode  # pylint: disable=protected-access
-import git
+from . import metrics
+from . import planner
+from .index import ModuleIndex, iter_folder_modules
+from .strip import StripRules
+from .bytecode import NOT_COMPILED, TIMESTAMP
 
 logger = logging.getLogger('gitoo-definition')
 logger.setLevel(logging.INFO)
 
+CHECKOUT = 'checkout'
+ARCHIVE = 'archive'
+EXPORT_MODES = (CHECKOUT, ARCHIVE)
+
+# The hidden folders created inside the destination while the add-ons are installed
+TEMP_PREFIX = '.gitoo-tmp-'
+TRASH_PREFIX = '.gitoo-trash-'
+
+# The author of the commits of the patches (patch files and merges), which do not depend on the git config of the host
+_PATCH_IDENTITY = ('-c', 'user.name=gitoo', '-c', 'user.email=gitoo@localhost')
+
 
 @contextlib.contextmanager
-def temp_repo(url, branch, commit=''):
+def temp_repo(url, branch, commit='', cache=None, shallow=False, checkout=True, work_dir=None):
     """ Clone a git repository inside a temporary folder, yield the folder then delete the folder.
 
     :param string url: url of the repo to clone.
     :param string branch: name of the branch to checkout to.
     :param string commit: Optional commit rev to checkout to. If mentioned, that take over the branch
+    :param MirrorCache cache: Optional cache of mirrors. If given, the repo is cloned from its local mirror.
+    :param bool shallow: Fetch only the commit (or the tip of the branch) instead of the whole history.
+        Ignored when a cache is given.
+    :param bool checkout: If False, the working tree is left empty. The revision can be checked out
+        later with checkout_revision.
+    :param string work_dir: Optional folder where the temporary folder is created. Default: the system temp folder.
+    :return: yield the path to the temporary folder
+    :rtype: string
+    """
+    with temp_folder(work_dir) as tmp_folder:
+        with metrics.phase('clone'):
+            if cache is not None:
+                with cache.mirror(url, commit=commit) as mirror:
+                    _clone(mirror, tmp_folder, branch)
+            elif not shallow or not _shallow_fetch(url, tmp_folder, branch, commit):
+                _clone(url, tmp_folder, branch)
+        if metrics.is_recording():
+            metrics.count('bytes_fetched', metrics.folder_size(os.path.join(tmp_folder, '.git'))[1])
+        if checkout:
+            with metrics.phase('checkout'):
+                checkout_revision(tmp_folder, branch, commit)
+        yield tmp_folder
+
+
+@contextlib.contextmanager
+def temp_folder(work_dir=None):
+    """ Create a temporary folder, yield the folder then delete the folder, even if an error occurred.
+
+    :param string work_dir: Optional folder where the temporary folder is created. Default: the system temp folder.
+        Inside another folder, the temporary folder is hidden.
     :return: yield the path to the temporary folder
     :rtype: string
     """
-    tmp_folder = tempfile.mkdtemp()
-    git.Repo.clone_from(
-        url, tmp_folder, branch=branch
-    )
+    folder = _make_temp_folder(work_dir, TEMP_PREFIX if work_dir else 'tmp')
+    try:
+        yield folder
+    finally:
+        _delete_folder(folder)
+
+
+# The temporary folders of this process that are not deleted yet, not removed by remove_stale_temp_folders
+_live_folders = set()
+_live_folders_lock = threading.Lock()
+
+
+def _make_temp_folder(work_dir, prefix):
+    with _live_folders_lock:
+        folder = tempfile.mkdtemp(dir=work_dir, prefix=prefix)
+        _live_folders.add(os.path.abspath(folder))
+    return folder
+
+
+def _delete_folder(folder):
+    shutil.rmtree(folder, ignore_errors=True)
+    with _live_folders_lock:
+        _live_folders.discard(os.path.abspath(folder))
+
+
+def _clone(url, folder, branch):
+    get_git_backend().clone(url, folder, branch)
+
+
+def _shallow_fetch(url, folder, branch, commit):
+    """ Fetch only the pinned commit (or the tip of the branch) inside an empty repository.
+
+    The fetched revision is kept in the git config of the repository,
+    so that the history can be deepened later if a patch requires it.
+
+    :return: False if the server refused the shallow fetch. In that case, the folder is emptied.
+    :rtype: bool
+    """
+    revision = commit or '+refs/heads/{0}:refs/remotes/origin/{0}'.format(branch)
+    run_git(folder, 'init', '--quiet')
+    run_git(folder, 'remote', 'add', 'origin', url)
+    return_code, _ = run_git_command(folder, 'fetch', '--quiet', '--depth', '1', 'origin', revision, capture=False)
+    if return_code:
+        logger.info("Shallow fetch refused by %s, falling back to a full clone.", url)
+        shutil.rmtree(folder)
+        os.makedirs(folder)
+        return False
+
+    run_git(folder, 'config', 'gitoo.shallowrevision', commit or branch)
+    return True
+
+
+def tree_revision(branch, commit=''):
+    """ Get the revision of a repository cloned by temp_repo, usable before the checkout.
+
+    :param string branch: name of the branch given to temp_repo.
+    :param string commit: Optional commit rev given to temp_repo.
+    :rtype: string
+    """
+    return commit or 'refs/remotes/origin/' + branch
+
+
+def checkout_revision(folder, branch, commit=''):
+    """ Checkout the commit or else the branch of a repository cloned by temp_repo.
+
+    :param string folder: path of the folder where is the git repo cloned at.
+    :param string branch: name of the branch to checkout to.
+    :param string commit: Optional commit rev to checkout to. If mentioned, that take over the branch
+    """
     if commit:
-        git_cmd = git.Git(tmp_folder)
-        git_cmd.checkout(commit)
-    yield tmp_folder
-    shutil.rmtree(tmp_folder)
+        run_git(folder, 'checkout', '--quiet', '--detach', commit)
+    else:
+        run_git(folder, 'checkout', '--quiet', '-B', branch, tree_revision(branch))
+
+
+_DEEPEN_STEPS = (16, 256, 4096)
+
+
+def _is_shallow(folder):
+    return run_git(folder, 'rev-parse', '--is-shallow-repository').strip() == 'true'
+
+
+def _has_merge_base(folder, revision):
+    return_code, _ = run_git_command(folder, 'merge-base', 'HEAD', revision, capture=False)
+    return not return_code
+
+
+def _deepen_until_merge_base(folder, revision, remote, branch):
+    """ Deepen a shallow repository until HEAD and the given revision have a merge base.
+
+    Both the history of the origin and of the given remote branch are deepened.
+    When the merge base is still missing after the last step, the whole history is fetched.
+
+    :param string folder: path of the folder where is the git repo cloned at.
+    :param string revision: the revision to merge into HEAD.
+    :param string remote: the name of the remote that contains the revision.
+    :param string branch: the branch of the remote that contains the revision.
+    """
+    origin_revision = run_git(folder, 'config', 'gitoo.shallowrevision').strip()
+    for depth in _DEEPEN_STEPS:
+        if _has_merge_base(folder, revision):
+            return
+        logger.info("Deepening the history by %s commits to find a merge base with %s", depth, revision)
+        run_git(folder, 'fetch', '--quiet', '--deepen', str(depth), 'origin', origin_revision)
+        run_git(folder, 'fetch', '--quiet', '--deepen', str(depth), remote, branch)
+
+    if not _has_merge_base(folder, revision):
+        logger.info("Fetching the whole history to find a merge base with %s", revision)
+        run_git(folder, 'fetch', '--quiet', '--unshallow', 'origin', origin_revision)
+        if _is_shallow(folder):
+            run_git(folder, 'fetch', '--quiet', '--unshallow', remote, branch)
+
+
+def check_destination(destination):
+    """ Raise an error if the destination folder does not exist.
+
+    :param string destination: path of the folder where the code is moved to.
+    :raise: RuntimeError if the folder does not exist.
+    """
+    if not os.path.exists(destination):
+        raise RuntimeError(
+            'The code could not be moved to {destination} '
+            'because the folder does not exist'.format(destination=destination))
+
+
+def remove_stale_temp_folders(destination):
+    """ Delete the temporary folders left inside the destination by an installation that was interrupted.
+
+    The folders are deleted in the background (see wait_background_deletions).
+    The folders still used by this process are kept, but the other processes
+    must not install add-ons inside the same destination at the same time.
+
+    :param string destination: the folder where the add-ons are installed.
+    :return: the names of the folders deleted.
+    :rtype: list
+    """
+    destination = os.path.abspath(destination)
+    with _live_folders_lock:
+        names = sorted(
+            name for name in os.listdir(destination)
+            if name.startswith((TEMP_PREFIX, TRASH_PREFIX)) and os.path.isdir(os.path.join(destination, name))
+            and os.path.join(destination, name) not in _live_folders
+        )
+        for name in names:
+            # Hidden from the next calls while they are deleted
+            _live_folders.add(os.path.join(destination, name))
+    if names:
+        logger.info("%s temporary folder(s) left by a previous installation removed: %s", len(names), ', '.join(names))
+        for name in names:
+            delete_in_background(os.path.join(destination, name))
+    return names
 
 
 def force_move(source, destination):
     """ Force the move of the source inside the destination even if the destination has already a folder with the
     name inside. In the case, the folder will be replaced.
 
+    The existing folder is swapped with the source (atomically when the system supports it),
+    so that there is no moment where the folder is missing. The old folder is then deleted
+    in the background (see wait_background_deletions).
+
     :param string source: path of the source to move.
     :param string destination: path of the folder to move the source to.
     """
-    if not os.path.exists(destination):
-        raise RuntimeError(
-            'The code could not be moved to {destination} '
-            'because the folder does not exist'.format(destination=destination))
+    check_destination(destination)
 
     destination_folder = os.path.join(destination, os.path.split(source)[-1])
 
-    if os.path.exists(destination_folder):
-        shutil.rmtree(destination_folder)
-    shutil.move(source, destination)
+    if not os.path.lexists(destination_folder):
+        shutil.move(source, destination)
+        metrics.count('folders_moved')
+        return
+
+    trash = _make_temp_folder(destination, TRASH_PREFIX)
+    if os.stat(source).st_dev != os.stat(destination).st_dev:
+        incoming = os.path.join(trash, 'incoming')
+        shutil.move(source, incoming)
+        source = incoming
+
+    old_folder = os.path.join(trash, 'old')
+    if _rename_exchange(source, destination_folder):
+        os.rename(source, old_folder)
+    else:
+        os.rename(destination_folder, old_folder)
+        os.rename(source, destination_folder)
+    delete_in_background(trash)
+    metrics.count('folders_moved')
+    metrics.count('folders_replaced')
+
+
+def _rename_exchange(first, second):
+    """ Swap two paths of the same file system atomically, with renameat2(RENAME_EXCHANGE).
+
+    :return: False if the system does not support it.
+    :rtype: bool
+    """
+    renameat2 = getattr(_libc(), 'renameat2', None)
+    if renameat2 is None:
+        return False
+    result = renameat2(_AT_FDCWD, os.fsencode(first), _AT_FDCWD, os.fsencode(second), _RENAME_EXCHANGE)
+    if result != 0:
+        error = ctypes.get_errno()
+        if error in (errno.EINVAL, errno.ENOSYS, errno.EXDEV, errno.ENOTSUP):
+            return False
+        raise OSError(error, os.strerror(error), second)
+    return True
+
+
+_AT_FDCWD = -100
+_RENAME_EXCHANGE = 2
+
+
+@functools.lru_cache(maxsize=None)
+def _libc():
+    try:
+        return ctypes.CDLL(None, use_errno=True)
+    except OSError:
+        return None
+
+
+_background_deletions = []
+_background_deletions_lock = threading.Lock()
+
+
+def delete_in_background(path):
+    """ Delete a folder inside a background thread.
+
+    The thread is not a daemon, so that the folder is deleted before the program exits.
+
+    :param string path: the folder to delete.
+    """
+    thread = threading.Thread(target=_delete_folder, args=(path,))
+    thread.start()
+    with _background_deletions_lock:
+        _background_deletions.append(thread)
+
+
+def wait_background_deletions():
+    """ Wait until the folders given to delete_in_background are deleted. """
+    with _background_deletions_lock:
+        threads = list(_background_deletions)
+        del _background_deletions[:]
+    for thread in threads:
+        thread.join()
+
+
+def install_staged(staging, destination):
+    """ Move the content of a staging folder inside the destination.
+
+    Each folder of the staging folder replaces the folder with the same name in the destination.
+
+    :param string staging: the folder prepared by Addon.prepare.
+    :param string destination: the folder where the add-on should end up at.
+    :return: the names of the folders installed in the destination.
+    :rtype: list
+    """
+    check_destination(destination)
+
+    names = sorted(os.listdir(staging))
+    with metrics.phase('install'):
+        for name in names:
+            force_move(os.path.join(staging, name), destination)
+    return names
 
 
 class Addon(object):
     """ Struct define the requirements of an add-on for src."""
 
+    # The folders of the repository that contain modules
+    _module_directories = ('',)
+
+    # The folder of the staging folder that contains the modules
+    _staging_modules_directory = ''
+
     def __init__(
         self, url, branch, commit='', patches=None,
         exclude_modules=None, include_modules=None,
-        lang='',
+        lang='', cache=None, shallow=False, sparse=False, result_cache=None, export=CHECKOUT,
+        include_dependencies=False, metrics_recorder=None, file_store=None, strip=None, compiler=None,
+        normalizer=None,
     ):
         """ Init
 
@@ -69,6 +367,19 @@ class Addon(object):
         :param list patches: list of PatchDefinition
         :param list exclude_modules: list of name of modules to exclude.
         :param list include_modules: list of name of modules to include.
+        :param MirrorCache cache: Optional cache of mirrors to clone the add-on from.
+        :param bool shallow: fetch only the commit to install instead of the whole history.
+        :param bool sparse: checkout only the included modules and the paths touched by patches.
+        :param ResultCache result_cache: Optional cache of installed modules.
+        :param string export: how the modules are exported from the repository, checkout or archive.
+        :param bool include_dependencies: also include the dependencies of the included modules,
+                                          found in any add-on installed with install_addons.
+        :param metrics.Recorder metrics_recorder: Optional recorder of the duration of each phase.
+        :param FileStore file_store: Optional store where the files of the modules are deduplicated.
+        :param StripRules strip: Optional rules of the files to remove from the modules.
+        :param Compiler compiler: Optional compiler of the python files of the modules.
+        :param Normalizer normalizer: Optional normalizer of the times and permissions of the files, for reproducible
+                                      installations.
         """
         self.repo = parse_url(url)
         self.branch = branch
@@ -78,70 +389,451 @@ class Addon(object):
             raise RuntimeError("Patches should be defined using Patch or FilePatch object.")
         self.exclude_modules = exclude_modules or []
         self.include_modules = include_modules
+        self._excludes = frozenset(self.exclude_modules)
+        self._includes = frozenset(include_modules) if include_modules is not None else None
+        self.include_dependencies = include_dependencies
+        self.metrics_recorder = metrics_recorder
+        self.metrics_id = metrics_recorder.register(self.metrics_entry()) if metrics_recorder is not None else None
+        self.file_store = file_store
+        self.strip = strip or StripRules()
+        self.compiler = compiler
+        self.normalizer = normalizer
+        self.commit_time = None
         self.languages = lang.split(',') if lang else []
+        self.cache = cache
+        self.shallow = shallow
+        self.sparse = sparse
+        self.result_cache = result_cache
+        if export not in EXPORT_MODES:
+            raise RuntimeError("The export mode should be one of {}.".format(', '.join(EXPORT_MODES)))
+        self.export = export
+        # The modules listed from the git tree, if they could be (see planner.plan_precedence),
+        # and the modules replaced by a later add-on, which are not prepared
+        self.listed_modules = None
+        self.shadowed_modules = set()
+        # What the last installation of the add-on used, see the api module
+        self.resolved_commit = None
+        self.applied_patches = []
+        self.installed_modules = []
 
     def install(self, destination):
         """ Install a third party odoo add-on
 
         :param string destination: the folder where the add-on should end up at.
+        :return: the names of the folders installed in the destination.
+        :rtype: list
         """
-        logger.info(
-            "Installing %s@%s to %s",
-            self.repo, self.commit if self.commit else self.branch, destination
-        )
-        with temp_repo(self.repo, self.branch, self.commit) as tmp:
-            self._apply_patches(tmp)
-            self._delete_unrequired_languages(tmp)
-            self._move_modules(tmp, destination)
+        check_destination(destination)
+        try:
+            remove_stale_temp_folders(destination)
+            with self.prepare(destination) as staging:
+                return install_prepared(self, staging, functools.partial(install_staged, destination=destination))
+        finally:
+            wait_background_deletions()
+
+    def recording(self):
+        """ Record the metrics of the current thread for this add-on. """
+        return metrics.recording(self.metrics_recorder, self.metrics_id)
+
+    def metrics_entry(self):
+        """ The name of the add-on in the metrics report and the logs. It is not unique, see metrics_id. """
+        return '{}@{}'.format(strip_credentials(self.repo), self.commit or self.branch)
+
+    @contextlib.contextmanager
+    def prepare(self, work_dir=None):
+        """ Clone the add-on, apply the patches and delete the unrequired languages.
+
+        The modules are left in a temporary staging folder, laid out as they should be
+        in the destination, ready to be moved. The folder is deleted when the context is exited.
+
+        The repository is cloned and staged inside the work directory. When it is on the same
+        file system as the destination, the modules are moved with renames instead of copies.
+
+        When a result cache is given and the add-on is pinned to a commit sha,
+        the staging folder is restored from the cache without using git at all.
 
-    def _apply_patches(self, temp_repo):
-        """Apply patches to the repository.
+        :param string work_dir: Optional folder where the temporary folders are created.
+                                Default: the system temp folder.
+        :return: yield the path to the staging folder
+        :rtype: string
+        """
+        signature = self.signature() if self.result_cache is not None else None
+        key = self.result_cache.key(signature) if signature else None
+        with temp_folder(work_dir) as staging:
+            with self.recording(), metrics.phase('prepare'):
+                self._prepare_staging(staging, key, work_dir)
+            yield staging
+
+    def _prepare_staging(self, staging, key, work_dir):
+        with metrics.phase('result_cache'):
+            is_restored = key and self.result_cache.restore(key, staging)
+
+        if is_restored:
+            logger.info("Installing %s@%s from the result cache", self.repo, self.commit)
+            metrics.count('result_cache_hits')
+            self.resolved_commit = self.commit
+            self.applied_patches = [patch.describe() for patch in self.patches]
+        else:
+            self._build(staging, work_dir)
+            if self.compiler is not None:
+                if self.normalizer is not None and self.compiler.invalidation == TIMESTAMP:
+                    # The compiled files record the modification time of their source
+                    self._normalize(staging)
+                with metrics.phase('compile'):
+                    self._compile_modules(staging)
+            if self.normalizer is not None:
+                self._normalize(staging)
+            if key:
+                with metrics.phase('result_cache'):
+                    self.result_cache.store(key, staging)
+
+        if self.file_store is not None:
+            with metrics.phase('store'):
+                self.file_store.link_folder(staging, root=work_dir)
+
+        if metrics.is_recording():
+            metrics.count('modules_moved', len(list(self.staging_index(staging))))
+            files, size = metrics.folder_size(staging)
+            metrics.count('files_written', files)
+            metrics.count('bytes_written', size)
+
+    def signature(self):
+        """ Describe every input that the installed modules depend on.
+
+        :return: the signature, or None if the add-on or one of its patches is not pinned to a commit sha.
+        :rtype: dict
+        """
+        patches = [patch.signature() for patch in self.patches]
+        if not is_commit_sha(self.commit) or None in patches:
+            return None
+
+        signature = {
+            'type': type(self).__name__,
+            'url': strip_credentials(self.repo),
+            'commit': self.commit,
+            'patches': patches,
+            'includes': sorted(self._includes) if self._filters_includes() else None,
+            'excludes': sorted(self.exclude_modules),
+            'languages': sorted(self.languages),
+        }
+        if self.strip:
+            signature['strip'] = self.strip.signature()
+        if self.compiler is not None:
+            signature['compile'] = self.compiler.signature()
+        if self.shadowed_modules:
+            signature['shadowed'] = sorted(self.shadowed_modules)
+        if self.normalizer is not None:
+            signature['reproducible'] = self.normalizer.signature()
+        return signature
+
+    def tree_modules(self):
+        """List the modules that the add-on would install at the root of the destination, from the git tree.
+
+        The tree is read from the mirror of the repository, so nothing is checked out.
+        The includes and excludes are applied. The modules added by the patches are not listed.
+
+        With include_dependencies, the modules installed are only known once the dependencies
+        of every add-on are resolved, so they are not listed.
+
+        :return: the names of the modules, or None if they can not be listed before the add-on is cloned.
+        :rtype: set
+        """
+        pinned = is_commit_sha(self.commit)
+        # Without fetch_once, the mirror of a branch would be fetched again by the clone
+        if self.cache is None or self._staging_modules_directory or not (pinned or self.cache.fetch_once):
+            return None
+        if self.include_dependencies:
+            return None
+
+        with self.recording(), metrics.phase('precedence'):
+            with self.cache.mirror(self.repo, commit=self.commit if pinned else None) as mirror:
+                files = list_tree_files(mirror, self.commit or 'refs/heads/' + self.branch)
+        return {module for module, _ in self._iter_tree_modules(files) if self._is_module_included(module)}
+
+    def _build(self, staging, work_dir=None):
+        """ Clone the add-on, apply the patches and move the modules to the staging folder.
+
+        :param string staging: the folder where the modules are moved to.
+        """
+        logger.info("Installing %s@%s", self.repo, self.commit if self.commit else self.branch)
+        archive = self.export == ARCHIVE
+        with temp_repo(
+            self.repo, self.branch, self.commit, cache=self.cache, shallow=self.shallow,
+            checkout=not (self.sparse or archive), work_dir=work_dir,
+        ) as tmp:
+            self.resolved_commit = self.commit if is_commit_sha(self.commit) else run_git(
+                tmp, 'rev-parse', tree_revision(self.branch, self.commit)).strip()
+            if self.normalizer is not None:
+                self.commit_time = int(run_git(tmp, 'show', '-s', '--format=%ct', self.resolved_commit).strip())
+            patches = PatchPipeline(self.patches, cache=self.cache, reference=self.repo)
+            patches.fetch(tmp)
+            if self.sparse or archive:
+                with metrics.phase('checkout'):
+                    self._sparse_checkout(tmp, patches, with_modules=not archive)
+            patches.apply(tmp)
+            self.applied_patches = [patch.describe(patches.revision(patch)) for patch in self.patches]
+            if archive:
+                with metrics.phase('export'):
+                    if self._export(tmp, staging):
+                        return
+            index = self._index_modules(tmp)
+            with metrics.phase('languages'):
+                self._delete_unrequired_languages(tmp, index)
+            if self.strip:
+                with metrics.phase('strip'):
+                    self._strip_modules(index)
+            with metrics.phase('stage'):
+                self._move_modules(tmp, staging, index)
+
+    def _index_modules(self, temp_repo):
+        """Scan the modules of the repository once, for every stage of the installation.
 
         :param string temp_repo: the folder containing the code.
+        :rtype: ModuleIndex
         """
-        for patch in self.patches:
-            patch.apply(temp_repo)
+        return ModuleIndex.scan(temp_repo, self._module_directories)
+
+    def staging_index(self, staging):
+        """Scan the modules of a staging folder prepared for this add-on.
+
+        :param string staging: the staging folder.
+        :rtype: ModuleIndex
+        """
+        return ModuleIndex.scan(os.path.join(staging, self._staging_modules_directory))
+
+    def remove_unrequired_modules(self, staging, required):
+        """Delete the modules of the staging folder that are neither included nor required.
+
+        This is used with include_dependencies, once the dependencies of every add-on are known.
+
+        :param string staging: the staging folder.
+        :param set required: the names of the modules required by the included modules.
+        """
+        kept = 0
+        for module in self.staging_index(staging):
+            if module.name in required or (self._includes is not None and module.name in self._includes):
+                kept += 1
+            else:
+                shutil.rmtree(module.path)
+        logger.info("%s module(s) kept from %s with their dependencies", kept, self.repo)
 
-    def _delete_unrequired_languages(self, temp_repo):
+    def _export(self, temp_repo, staging):
+        """Stream the included modules from the patched tree to the staging folder with git archive.
+
+        The unrequired languages are filtered while streaming, so they are never written to the disk.
+        If git archive fails, the staging folder is emptied and the whole tree is checked out instead.
+
+        :param string temp_repo: the folder containing the repository, with the patches committed.
+        :param string staging: the folder where the modules are written to.
+        :return: False if the export failed.
+        :rtype: bool
+        """
+        files = list_tree_files(temp_repo, 'HEAD')
+        paths = sorted(set(self._iter_export_paths(files)))
+        try:
+            if paths:
+                self._extract_archive(temp_repo, staging, paths)
+            return True
+        except (RuntimeError, tarfile.TarError) as error:
+            logger.warning("Could not export %s with git archive, checking out the tree instead: %s", self.repo, error)
+            for name in os.listdir(staging):
+                shutil.rmtree(os.path.join(staging, name))
+            run_git(temp_repo, 'sparse-checkout', 'disable')
+            return False
+
+    def _extract_archive(self, temp_repo, staging, paths):
+        process = get_git_backend().spawn(temp_repo, ['archive', '--format=tar', 'HEAD', '--'] + paths)
+        stripped_files = 0
+        stripped_size = 0
+        try:
+            with tarfile.open(fileobj=process.stdout, mode='r|') as archive:
+                for member in archive:
+                    path = self._export_path(member.name.rstrip('/'))
+                    if path is None:
+                        continue
+                    if self._is_unrequired_language_file(path):
+                        metrics.count('po_files_removed')
+                        continue
+                    if self._is_stripped_file(path, member.isdir()):
+                        if not member.isdir():
+                            stripped_files += 1
+                            stripped_size += member.size
+                        continue
+                    member.name = path
+                    extract_member(archive, member, staging)
+        finally:
+            process.stdout.close()
+            return_code = process.wait()
+        if return_code:
+            raise RuntimeError("git archive failed with the return code {}".format(return_code))
+        if self.strip:
+            metrics.count('files_stripped', stripped_files)
+            metrics.count('bytes_stripped', stripped_size)
+            self._log_stripped(stripped_files, stripped_size)
+
+    def _iter_export_paths(self, files):
+        """Iterate over the paths to export, given the files of the patched git tree."""
+        yield from self._iter_sparse_paths(files)
+
+    @staticmethod
+    def _export_path(path):
+        """Get the path of a file of the git tree, relative to the staging folder.
+
+        :param string path: the path of the file in the git tree.
+        :return: the path in the staging folder, or None if the file is not exported.
+        """
+        return path
+
+    def _is_unrequired_language_file(self, path):
+        """Evaluate if a file of the staging folder is the translation of an unrequired language.
+
+        :param string path: the path of the file, relative to the staging folder.
+        :rtype: bool
+        """
+        if not self.languages:
+            return False
+        directory, file_name = os.path.split(path)
+        module_folder, i18n = os.path.split(directory)
+        return (
+            i18n == 'i18n' and
+            os.path.dirname(module_folder) == self._staging_modules_directory and
+            file_name.split('.')[0] not in self.languages
+        )
+
+    def _is_stripped_file(self, path, is_folder=False):
+        """Evaluate if a file of the staging folder is removed by the strip rules.
+
+        :param string path: the path of the file, relative to the staging folder.
+        :param bool is_folder: whether the path is a folder.
+        :rtype: bool
+        """
+        if not self.strip:
+            return False
+        prefix = self._staging_modules_directory + '/' if self._staging_modules_directory else ''
+        if not path.startswith(prefix):
+            return False
+        _, _, module_path = path[len(prefix):].partition('/')
+        return bool(module_path) and self.strip.matches(module_path + '/' if is_folder else module_path)
+
+    def _strip_modules(self, index):
+        """Remove the files selected by the strip rules from the included modules.
+
+        :param ModuleIndex index: the modules of the repository.
+        """
+        stripped_files = 0
+        stripped_size = 0
+        for module in self._iter_included_modules(index):
+            files, size = self.strip.strip_module(module.path)
+            stripped_files += files
+            stripped_size += size
+        self._log_stripped(stripped_files, stripped_size)
+
+    def _log_stripped(self, files, size):
+        logger.info(
+            "Strip (%s): %s file(s) removed from %s, %.1f MB saved",
+            ', '.join(self.strip.rules), files, self.repo, size / 1024 / 1024)
+
+    def _normalize(self, staging):
+        """ Normalize the times and the permissions of the files of the staging folder. """
+        with metrics.phase('normalize'):
+            files = self.normalizer.normalize_folder(staging, self.commit_time)
+        logger.info("Normalized %s file(s) of %s", files, self.repo)
+
+    def _compile_modules(self, staging):
+        """ Byte-compile the python files of the staging folder.
+
+        The files of the modules that are never imported or that match the strip rules are skipped.
+        """
+        prefixes = [os.path.relpath(module.path, staging) + '/' for module in self.staging_index(staging)]
+
+        def is_skipped(path):
+            for prefix in prefixes:
+                if path.startswith(prefix):
+                    module_path = path[len(prefix):]
+                    return NOT_COMPILED.matches(module_path) or self.strip.matches(module_path)
+            return False
+
+        files = self.compiler.compile_folder(staging, is_skipped)
+        logger.info("Compiled %s python file(s) of %s", files, self.repo)
+
+    def _sparse_checkout(self, temp_repo, patches, with_modules=True):
+        """Checkout only the included modules and the folders touched by the patches.
+
+        The modules are found from the git tree, before anything is written to the disk.
+
+        :param string temp_repo: the folder containing the repository, not checked out yet.
+        :param PatchPipeline patches: the patches to apply, already fetched.
+        :param bool with_modules: if False, only the folders touched by the patches are checked out.
+        """
+        revision = tree_revision(self.branch, self.commit)
+        files = list_tree_files(temp_repo, revision) if with_modules else []
+        paths = set(self._iter_sparse_paths(files))
+        paths.update(os.path.dirname(path) for path in patches.touched_paths(temp_repo, revision))
+        paths.discard('')
+
+        logger.info("Sparse checkout of %s folder(s)", len(paths))
+        run_git(temp_repo, 'sparse-checkout', 'set', '--cone', *sorted(paths))
+        checkout_revision(temp_repo, self.branch, self.commit)
+
+    def _iter_sparse_paths(self, files):
+        """Iterate over the folders to checkout, given the files of the git tree.
+
+        :param list files: the paths of the files in the git tree.
+        """
+        for module, path in self._iter_tree_modules(files):
+            if self._is_module_included(module):
+                yield path
+
+    @staticmethod
+    def _iter_tree_modules(files):
+        yield from iter_tree_modules(files, ('',))
+
+    def _delete_unrequired_languages(self, temp_repo, index=None):
         if not self.languages:
             return
 
-        for directory, file_name in self._iter_po_files(temp_repo):
+        index = index or self._index_modules(temp_repo)
+        for directory, file_name in self._iter_po_files(index):
             lang = file_name.split('.')[0]
             if lang not in self.languages:
                 file_path = os.path.join(directory, file_name)
                 os.remove(file_path)
+                metrics.count('po_files_removed')
 
-    def _iter_po_files(self, temp_repo):
-        for i18n_folder in self._iter_i18n_folders(temp_repo):
+    def _iter_po_files(self, index):
+        for i18n_folder in self._iter_i18n_folders(index):
             po_files = os.listdir(i18n_folder)
             for file_name in po_files:
                 yield i18n_folder, file_name
 
-    def _iter_i18n_folders(self, temp_repo):
-        for folder in self._iter_included_modules(temp_repo):
-            i18n_folder = folder + '/i18n'
+    def _iter_i18n_folders(self, index):
+        for module in self._iter_included_modules(index):
+            i18n_folder = module.path + '/i18n'
             if os.path.isdir(i18n_folder):
                 yield i18n_folder
 
-    def _move_modules(self, temp_repo, destination):
+    def _move_modules(self, temp_repo, destination, index=None):
         """Move modules from the temp directory to the destination.
 
         :param string temp_repo: the folder containing the code.
         :param string destination: the folder where the add-on should end up at.
+        :param ModuleIndex index: the modules of the temp directory, scanned if not given.
         """
-        for folder in self._iter_included_modules(temp_repo):
-            force_move(folder, destination)
+        index = index or self._index_modules(temp_repo)
+        for module in self._iter_included_modules(index):
+            force_move(module.path, destination)
 
-    def _iter_included_modules(self, temp_repo):
-        for path in self._iter_modules(temp_repo):
-            module_name = path.split("/")[-1]
-            if self._is_module_included(module_name):
-                yield path
+    def _iter_included_modules(self, index):
+        for module in index:
+            if self._is_module_included(module.name):
+                yield module
 
-    @staticmethod
-    def _iter_modules(temp_repo):
-        yield from iter_module_folders(temp_repo)
+    def _filters_includes(self):
+        """Evaluate if the modules are filtered by the includes when the add-on is prepared.
+
+        With include_dependencies, every module is kept until the dependencies are known.
+        """
+        return self._includes is not None and not self.include_dependencies
 
     def _is_module_included(self, module):
         """Evaluate if the module must be included in the Odoo addons.
@@ -149,19 +841,24 @@ class Addon(object):
         :param string module: the name of the module
         :rtype: bool
         """
-        if module in self.exclude_modules:
+        if module in self._excludes or module in self.shadowed_modules:
             return False
 
-        if self.include_modules is None:
+        if not self._filters_includes():
             return True
 
-        return module in self.include_modules
+        return module in self._includes
 
 
 class Base(Addon):
     """ Struct define the odoo base repository for src."""
 
-    def _move_modules(self, temp_repo, destination):
+    # odoo/addons is scanned first, because the modules of addons are moved over it
+    _module_directories = ('odoo/addons', 'addons')
+
+    _staging_modules_directory = 'odoo/addons'
+
+    def _move_modules(self, temp_repo, destination, index=None):
         """Move odoo modules from the temp directory to the destination.
 
         This step is different from a standard repository. In the base code
@@ -170,49 +867,586 @@ class Base(Addon):
         those modules are placed inside the folder odoo/addons.
 
         1- Move modules from addons/ to odoo/addons/ (with the base module).
-        2- Move the whole odoo folder to the destination location.
+        2- Delete the modules that are not included.
+        3- Move the whole odoo folder to the destination location.
         """
-        tmp_addons = os.path.join(temp_repo, 'addons')
+        index = index or self._index_modules(temp_repo)
         tmp_odoo_addons = os.path.join(temp_repo, 'odoo/addons')
 
-        for folder in iter_module_folders(tmp_addons):
-            force_move(folder, tmp_odoo_addons)
+        for module in index:
+            is_included = self._is_module_included(module.name)
+            directory = os.path.relpath(os.path.dirname(module.path), temp_repo)
+            if directory == 'odoo/addons' and not is_included:
+                shutil.rmtree(module.path)
+            elif directory == 'addons' and is_included:
+                target = os.path.join(tmp_odoo_addons, module.name)
+                if os.path.exists(target):
+                    shutil.rmtree(target)
+                os.rename(module.path, target)
 
         tmp_odoo = os.path.join(temp_repo, 'odoo')
         force_move(tmp_odoo, destination)
 
+    def _iter_sparse_paths(self, files):
+        """Iterate over the folders to checkout, given the files of the git tree.
+
+        Besides the included modules, the whole odoo package is required,
+        except for the modules of odoo/addons.
+        """
+        yield from super(Base, self)._iter_sparse_paths(files)
+        for path in files:
+            parts = path.split('/')
+            if len(parts) > 2 and parts[0] == 'odoo' and parts[1] != 'addons':
+                yield '/'.join(parts[:2])
+
+    @staticmethod
+    def _iter_tree_modules(files):
+        yield from iter_tree_modules(files, ('addons', 'odoo/addons'))
+
+    def _iter_export_paths(self, files):
+        """Iterate over the paths to export, given the files of the patched git tree.
+
+        As with a checkout, the whole odoo folder is exported, except for the modules
+        of odoo/addons that are not included. The included modules of the addons folder
+        are exported as well.
+        """
+        yield 'odoo'
+        for module, path in self._iter_tree_modules(files):
+            is_included = self._is_module_included(module)
+            if path.startswith('addons/') and is_included:
+                yield path
+            elif path.startswith('odoo/') and not is_included:
+                yield ':(exclude){}'.format(path)
+
     @staticmethod
-    def _iter_modules(temp_repo):
-        for directory in ('addons', 'odoo/addons'):
-            directory_path = os.path.join(temp_repo, directory)
-            yield from iter_module_folders(directory_path)
+    def _export_path(path):
+        """Get the path of a file of the git tree, relative to the staging folder.
+
+        The modules of the addons folder are exported to odoo/addons.
+        """
+        if path == 'addons':
+            return None
+        if path.startswith('addons/'):
+            return 'odoo/' + path
+        return path
+
+
+def install_addons(addons, destination, jobs=1, output=None, order=None, on_shadow=planner.SHADOW_LAST_WINS):
+    """ Install the given add-ons inside the destination folder.
+
+    With more than one job, the add-ons are cloned, patched and pruned concurrently.
+    The modules are still moved to the destination in the order of the given add-ons,
+    so that the last add-on wins when two of them contain a module with the same name.
+
+    When an add-on includes the dependencies of its modules, every add-on is prepared
+    before any module is moved, so that the dependencies can be found in the other add-ons.
+
+    With an output archive, only the last version of a folder is written (see _write_prepared).
+
+    :param list addons: the Addon objects to install.
+    :param string destination: the folder where the add-ons should end up at.
+    :param int jobs: the number of add-ons to prepare at the same time.
+    :param TarOutput output: Optional archive where the add-ons are written instead of the destination folder.
+                             The destination is then not used.
+    :param list order: Optional order in which the add-ons start to be prepared (see prepare_addons).
+    :param string on_shadow: what to do when a folder installed by an add-on is replaced by a later one,
+                             although it was not planned (see planner.plan_precedence): warn, error or last-wins.
+    :return: the names of the folders installed by each add-on.
+    :rtype: list
+    """
+    if output is None:
+        check_destination(destination)
+        install = functools.partial(install_staged, destination=destination)
+        work_dir = destination
+    else:
+        install = output.add
+        work_dir = None
+
+    installed = []
+    owners = {}
+    include_dependencies = any(addon.include_dependencies for addon in addons)
+    try:
+        if output is None:
+            remove_stale_temp_folders(destination)
+        with prepare_addons(addons, jobs, work_dir=work_dir, order=order) as wait_prepared:
+            if include_dependencies:
+                with contextlib.ExitStack() as stack:
+                    stagings = [stack.enter_context(wait_prepared(addon)) for addon in addons]
+                    resolve_dependencies(addons, stagings)
+                    if output is not None:
+                        _remove_shadowed_folders(addons, stagings, on_shadow)
+                    for addon, staging in zip(addons, stagings):
+                        _check_shadowing(addon, staging, owners, on_shadow)
+                        installed.append(install_prepared(addon, staging, install))
+                return installed
+
+            if output is not None:
+                return _write_prepared(addons, wait_prepared, install, on_shadow)
+
+            for addon in addons:
+                with wait_prepared(addon) as staging:
+                    _check_shadowing(addon, staging, owners, on_shadow)
+                    installed.append(install_prepared(addon, staging, install))
+    finally:
+        wait_background_deletions()
+    return installed
 
 
-def _run_command_inside_folder(command, folder):
+def _write_prepared(addons, wait_prepared, install, on_shadow):
+    """Write each add-on to an output archive as soon as the folders it may share with a later add-on are known.
+
+    A folder written to a tar archive can not be replaced. The modules of the add-ons listed
+    by planner.plan_precedence are known in advance, and the modules they shadow are not prepared,
+    so an add-on followed only by listed add-ons is written as soon as it is prepared.
+    An add-on followed by an add-on that could not be listed is kept until that one is prepared.
+
+    :param list addons: the Addon objects, in the order they are installed.
+    :param wait_prepared: the function that waits for an add-on (see prepare_addons).
+    :param install: the function that writes a staging folder to the archive.
+    :param string on_shadow: the policy (see planner.report_shadowed).
+    :return: the names of the folders written by each add-on.
+    :rtype: list
+    """
+    # For each add-on, the owner of the listed modules of the later add-ons
+    later_owners = []
+    listed = {}
+    for addon in reversed(addons):
+        later_owners.append(dict(listed))
+        listed.update((name, addon) for name in addon.listed_modules or () if name not in listed)
+    later_owners.reverse()
+
+    installed = []
+    owners = {}
+    with contextlib.ExitStack() as buffered_stack:
+        buffered = []
+        for index, addon in enumerate(addons):
+            with contextlib.ExitStack() as stack:
+                buffered.append((addon, stack.enter_context(wait_prepared(addon))))
+                if any(later.listed_modules is None for later in addons[index + 1:]):
+                    buffered_stack.push(stack.pop_all())
+                    continue
+
+                _remove_shadowed_folders(
+                    [entry for entry, _ in buffered], [staging for _, staging in buffered], on_shadow,
+                    later_owners[index])
+                for buffered_addon, staging in buffered:
+                    _check_shadowing(buffered_addon, staging, owners, on_shadow)
+                    installed.append(install_prepared(buffered_addon, staging, install))
+                buffered = []
+                buffered_stack.close()
+    return installed
+
+
+def _remove_shadowed_folders(addons, stagings, on_shadow, later_owners=None):
+    """Delete the folders of the staging folders that are replaced by the folder of a later add-on.
+
+    A folder written to a tar archive can not be replaced, so only the last version of each folder is kept.
+
+    :param list addons: the Addon objects, in the order they are installed.
+    :param list stagings: the staging folder of each add-on.
+    :param string on_shadow: the policy (see planner.report_shadowed).
+    :param dict later_owners: Optional add-on that installs each folder after the given add-ons.
+    """
+    winners = dict(later_owners or {})
+    shadowed = []
+    for addon, staging in reversed(list(zip(addons, stagings))):
+        for name in sorted(os.listdir(staging), reverse=True):
+            if name in winners:
+                shadowed.append((name, addon, winners[name], os.path.join(staging, name)))
+            else:
+                winners[name] = addon
+    shadowed.reverse()
+    planner.report_shadowed([(name, addon, winner) for name, addon, winner, _ in shadowed], on_shadow)
+    for _, _, _, path in shadowed:
+        shutil.rmtree(path)
+
+
+def _check_shadowing(addon, staging, owners, on_shadow):
+    """Report the folders of a staging folder that replace the folders installed by a previous add-on.
+
+    :param Addon addon: the add-on about to be installed.
+    :param string staging: its staging folder.
+    :param dict owners: the add-on that installed each folder so far, updated with the folders of the add-on.
+    :param string on_shadow: the policy (see planner.report_shadowed).
+    """
+    names = sorted(os.listdir(staging))
+    planner.report_shadowed(
+        [(name, owners[name], addon) for name in names if name in owners], on_shadow, planned=False)
+    owners.update((name, addon) for name in names)
+
+
+def install_prepared(addon, staging, install):
+    """ Install the staging folder of a prepared add-on.
+
+    The modules of the staging folder are kept in Addon.installed_modules,
+    with their paths relative to the destination and the values of their manifest.
+
+    :param Addon addon: the add-on.
+    :param string staging: the folder prepared by Addon.prepare.
+    :param install: the function that moves the staging folder to the destination (i.e. install_staged).
+    :return: the names of the folders installed.
+    :rtype: list
+    """
+    addon.installed_modules = [
+        {
+            'name': module.name,
+            'path': os.path.relpath(module.path, staging),
+            'version': module.version,
+            'depends': module.depends,
+            'installable': module.installable,
+        }
+        for module in addon.staging_index(staging)
+    ]
+    with addon.recording():
+        return install(staging)
+
+
+@contextlib.contextmanager
+def prepare_addons(addons, jobs=1, work_dir=None, order=None):
+    """ Prepare the given add-ons, concurrently when more than one job is given.
+
+    Yield a function that waits for an add-on to be prepared and returns a context manager,
+    which yields the staging folder of the add-on and deletes it when exited.
+    With a single job, the add-on is only prepared when the function is called.
+
+    With many jobs, the add-ons start in the given order (i.e. the longest first),
+    whatever the order in which they are awaited.
+
+    If an add-on fails, the add-ons not started yet are cancelled right away, and waiting for a cancelled add-on
+    raises the error of the failed one. When the context is exited,
+    the workers are awaited and the staging folders that were not used are deleted.
+
+    :param list addons: the Addon objects to prepare.
+    :param int jobs: the number of add-ons to prepare at the same time.
+    :param string work_dir: Optional folder where the temporary folders are created.
+    :param list order: Optional order in which the add-ons start. Default: the order of the add-ons.
+    :return: yield the function that waits for an add-on
+    """
+    if jobs <= 1:
+        yield lambda addon: addon.prepare(work_dir)
+        return
+
+    cancelled = threading.Event()
+    with futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = {
+            addon: executor.submit(_prepare_addon, addon, cancelled, work_dir)
+            for addon in _ordered(addons, order)
+        }
+
+        def wait_prepared(addon):
+            prepared = pending[addon].result()
+            if prepared is None:
+                # The add-on was cancelled because another one failed
+                _raise_first_error(pending.values())
+            stack, staging = prepared
+            return _staging_context(stack, staging)
+
+        try:
+            yield wait_prepared
+        except BaseException:
+            cancelled.set()
+            for future in pending.values():
+                future.cancel()
+            raise
+        finally:
+            _release_prepared_addons(list(pending.values()))
+
+
+def _ordered(addons, order=None):
+    """ Sort the add-ons in the given order, the add-ons missing from the order last. """
+    if order is None:
+        return list(addons)
+    position = {addon: index for index, addon in enumerate(order)}
+    return sorted(addons, key=lambda addon: position.get(addon, len(position)))
+
+
+@contextlib.contextmanager
+def _staging_context(stack, staging):
+    with stack:
+        yield staging
+
+
+def resolve_dependencies(addons, stagings):
+    """Keep the modules required by the add-ons that include the dependencies of their modules.
+
+    The dependencies are searched in the modules of every add-on. When two add-ons contain
+    a module with the same name, the manifest of the last one is used.
+    The modules installed from the other add-ons are also required with their dependencies.
+
+    :param list addons: the Addon objects.
+    :param list stagings: the staging folder of each add-on.
+    """
+    index = ModuleIndex()
+    roots = set()
+    for addon, staging in zip(addons, stagings):
+        staging_index = addon.staging_index(staging)
+        index.update(staging_index)
+        if addon.include_dependencies and addon.include_modules is not None:
+            roots.update(addon.include_modules)
+        else:
+            roots.update(staging_index.names())
+
+    required, missing = index.dependency_closure(roots)
+    if missing:
+        logger.warning("Modules required but not found in the add-ons: %s", ', '.join(sorted(missing)))
+
+    for addon, staging in zip(addons, stagings):
+        if addon.include_dependencies:
+            addon.remove_unrequired_modules(staging, required)
+
+
+def _prepare_addon(addon, cancelled, work_dir=None):
+    """Prepare an add-on inside a worker thread.
+
+    :param Addon addon: the add-on to prepare.
+    :param threading.Event cancelled: set when another add-on failed.
+    :param string work_dir: Optional folder where the temporary folders are created.
+    :return: the context stack that owns the staging folder and the folder itself.
+    :rtype: Tuple[contextlib.ExitStack, str]
+    """
+    if cancelled.is_set():
+        return None
+    stack = contextlib.ExitStack()
+    try:
+        staging = stack.enter_context(addon.prepare(work_dir))
+    except BaseException:
+        # The add-ons not started yet are cancelled without waiting for the failed one to be awaited
+        cancelled.set()
+        raise
+    if cancelled.is_set():
+        stack.close()
+        return None
+    return stack, staging
+
+
+def _raise_first_error(pending):
+    """Wait for a worker to fail and raise its error.
+
+    :param list pending: the futures returned by the executor.
+    """
+    done, _ = futures.wait(pending, return_when=futures.FIRST_EXCEPTION)
+    for future in done:
+        if not future.cancelled() and future.exception() is not None:
+            raise future.exception()
+    msg = "An add-on was cancelled, but no add-on failed."
+    logger.error(msg)
+    raise RuntimeError(msg)
+
+
+def _release_prepared_addons(pending):
+    """Wait for the workers and delete the temporary folders that were not consumed.
+
+    :param list pending: the futures returned by the executor.
+    """
+    futures.wait(pending)
+    for future in pending:
+        if future.cancelled() or future.exception() is not None or future.result() is None:
+            continue
+        stack = future.result()[0]
+        stack.close()
+
+
+# The number of lines of the error output of a command kept for the error messages
+_STDERR_TAIL = 20
+
+
+def _run_command_inside_folder(command, folder, capture=True):
     """Run a command inside the given folder.
 
-    :param string command: the command to execute.
+    The output of the command is read line by line while it runs. The error output is logged
+    and only its last lines are kept, to be added to the returned data if the command fails.
+
+    :param string command: the command to execute. It may also be given as a list of arguments.
     :param string folder: the folder where to execute the command.
-    :return: the return code of the process.
-    :rtype: Tuple[int, str]
+    :param bool capture: If False, the standard output is logged and discarded instead of returned.
+    :return: the return code of the process and its standard output.
+    :rtype: Tuple[int, bytes]
     """
     logger.debug("command: %s", command)
     # avoid usage of shell = True
     # see https://docs.openstack.org/bandit/latest/plugins/subprocess_popen_with_shell_equals_true.html
-    process = subprocess.Popen(command.split(), stdout=subprocess.PIPE, cwd=folder)
-    stream_data = process.communicate()[0]
-    logger.debug("%s stdout: %s (RC %s)", command, stream_data, process.returncode)
-    return process.returncode, stream_data
+    args = command.split() if isinstance(command, str) else command
+    process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=folder)
+    errors = collections.deque(maxlen=_STDERR_TAIL)
+    error_reader = threading.Thread(target=_read_error_output, args=(process.stderr, command, errors), daemon=True)
+    error_reader.start()
+
+    output = []
+    with process.stdout:
+        for line in process.stdout:
+            logger.debug("%s stdout: %s", command, line)
+            if capture:
+                output.append(line)
+    error_reader.join()
+    return_code = process.wait()
+    logger.debug("%s (RC %s)", command, return_code)
+
+    stream_data = b''.join(output)
+    if return_code:
+        stream_data += b''.join(errors)
+    return return_code, stream_data
+
+
+def _read_error_output(stream, command, errors):
+    with stream:
+        for line in stream:
+            logger.debug("%s stderr: %s", command, line)
+            errors.append(line)
+
+
+class GitBackend(object):
+    """ The way gitoo runs git.
+
+    Every git command goes through the backend selected with set_git_backend,
+    so that the number of git processes spawned by an installation is counted in the metrics.
+    """
+
+    name = None
+
+    def clone(self, url, folder, branch):
+        """ Clone a repository without checking out its working tree.
+
+        :param string url: url of the repo to clone.
+        :param string folder: the empty folder where the repo is cloned.
+        :param string branch: name of the branch of the repo.
+        :raise: RuntimeError if the repo could not be cloned.
+        """
+        raise NotImplementedError()
+
+    def run(self, folder, args, capture=True):
+        """ Run a git command inside the given folder.
+
+        :param string folder: the folder where to execute the command.
+        :param list args: the arguments given to git.
+        :param bool capture: If False, the standard output is discarded.
+        :return: the return code of the command, and its standard output (followed by its error output if it failed).
+        :rtype: Tuple[int, bytes]
+        """
+        raise NotImplementedError()
+
+    def spawn(self, folder, args):
+        """ Start a git command whose standard output is read as a stream (i.e. git archive).
+
+        :param string folder: the folder where to execute the command.
+        :param list args: the arguments given to git.
+        :rtype: subprocess.Popen
+        """
+        metrics.count('git_processes')
+        return subprocess.Popen(['git'] + list(args), stdout=subprocess.PIPE, cwd=folder)
+
+
+class SubprocessBackend(GitBackend):
+    """ Run the git executable directly. This is the default backend, it needs no other package. """
+
+    name = 'subprocess'
+
+    def clone(self, url, folder, branch):
+        return_code, stream_data = self.run(
+            None, ['clone', '--quiet', '--no-checkout', '--branch', branch, url, folder], capture=False)
+        if return_code:
+            msg = "Could not clone {}@{}. Error: {}".format(strip_credentials(url), branch, stream_data)
+            logger.error(msg)
+            raise RuntimeError(msg)
+
+    def run(self, folder, args, capture=True):
+        metrics.count('git_processes')
+        return _run_command_inside_folder(['git'] + list(args), folder, capture=capture)
+
+
+class GitPythonBackend(GitBackend):
+    """ Run git through GitPython, which is imported only when the backend is used. """
+
+    name = 'gitpython'
+
+    def clone(self, url, folder, branch):
+        import git  # pylint: disable=import-outside-toplevel
+        metrics.count('git_processes')
+        try:
+            git.Repo.clone_from(url, folder, branch=branch, no_checkout=True)
+        except git.GitCommandError as error:
+            msg = "Could not clone {}@{}. Error: {}".format(strip_credentials(url), branch, error.stderr)
+            logger.error(msg)
+            raise RuntimeError(msg)
+
+    def run(self, folder, args, capture=True):
+        import git  # pylint: disable=import-outside-toplevel
+        metrics.count('git_processes')
+        return_code, stdout, stderr = git.Git(folder).execute(
+            ['git'] + list(args), with_extended_output=True, with_exceptions=False, with_stdout=capture,
+            stdout_as_string=False, strip_newline_in_stdout=False)
+        stdout = stdout or b''
+        if return_code:
+            stdout += stderr.encode() if isinstance(stderr, str) else stderr
+        return return_code, stdout
+
+
+GIT_BACKENDS = {backend.name: backend for backend in (SubprocessBackend, GitPythonBackend)}
+GIT_BACKEND_ENV = 'GITOO_GIT_BACKEND'
+
+_git_backend = None
+
+
+def get_git_backend():
+    """ Get the backend that runs git. Default: the one named by GITOO_GIT_BACKEND, else subprocess.
+
+    :rtype: GitBackend
+    """
+    if _git_backend is None:
+        set_git_backend(os.environ.get(GIT_BACKEND_ENV) or SubprocessBackend.name)
+    return _git_backend
+
+
+def set_git_backend(name):
+    """ Select the backend that runs git.
+
+    :param string name: the name of the backend (subprocess or gitpython).
+    :raise: RuntimeError if the backend does not exist.
+    """
+    global _git_backend  # pylint: disable=global-statement
+    if name not in GIT_BACKENDS:
+        msg = "Unknown git backend {}. The backends are {}.".format(name, ', '.join(sorted(GIT_BACKENDS)))
+        logger.error(msg)
+        raise RuntimeError(msg)
+    _git_backend = GIT_BACKENDS[name]()
+
+
+def run_git_command(folder, *args, capture=True):
+    """Run a git command inside the given folder with the selected backend.
+
+    :param string folder: the folder where to execute the command.
+    :param args: the arguments given to git.
+    :param bool capture: If False, the standard output is discarded.
+    :return: the return code of the command, and its standard output (followed by its error output if it failed).
+    :rtype: Tuple[int, bytes]
+    """
+    return get_git_backend().run(folder, args, capture=capture)
+
+
+def run_git(folder, *args):
+    """Run a git command inside the given folder.
+
+    :param string folder: the folder where to execute the command.
+    :param args: the arguments given to git.
+    :return: the stdout of the command.
+    :rtype: string
+    :raise: RuntimeError if the command fails.
+    """
+    return_code, stream_data = run_git_command(folder, *args)
+    if return_code:
+        msg = "Git command failed: {}. Error: {}".format(' '.join(('git',) + args), stream_data)
+        logger.error(msg)
+        raise RuntimeError(msg)
+    return stream_data.decode()
 
 
 class Patch(object):
 
-    def __init__(self, url, branch, commit):
+    def __init__(self, url, branch, commit=''):
         """ Init
 
         :param string url: url where the add-on lives.
         :param string branch: the branch to check out.
-        :param string commit: Optional commit sha.
+        :param string commit: Optional commit sha. If not given, the tip of the branch is merged.
         """
         self.url = parse_url(url)
         self.branch = branch
@@ -224,21 +1458,27 @@ class Patch(object):
         :param string folder: path of the folder where is the git repo cloned at.
         :raise: RuntimeError if the patch could not be applied.
         """
-        logger.info("Apply Patch %s@%s (commit %s)", self.url, self.branch, self.commit)
-        remote_name = 'patch'
-        commands = [
-            "git remote add {} {}".format(remote_name, self.url),
-            "git fetch {} {}".format(remote_name, self.branch),
-            'git merge {} -m "patch"'.format(self.commit),
-            "git remote remove {}".format(remote_name),
-        ]
-        for command in commands:
-            return_code, stream_data = _run_command_inside_folder(command, folder)
-            if return_code:
-                msg = "Could not apply patch from {}@{}: {}. Error: {}".format(
-                    self.url, self.branch, command, stream_data)
-                logger.error(msg)
-                raise RuntimeError(msg)
+        pipeline = PatchPipeline([self])
+        pipeline.fetch(folder)
+        pipeline.apply(folder)
+
+    def signature(self):
+        """ Describe the patch for the result cache.
+
+        :return: the signature, or None if the patch is not pinned to a commit sha.
+        :rtype: dict
+        """
+        if not is_commit_sha(self.commit):
+            return None
+        return {'url': strip_credentials(self.url), 'commit': self.commit}
+
+    def describe(self, revision=None):
+        """ Describe the patch once applied.
+
+        :param string revision: Optional sha merged, for a patch from a branch.
+        :rtype: dict
+        """
+        return {'url': strip_credentials(self.url), 'branch': self.branch, 'commit': revision or self.commit}
 
 
 class FilePatch(object):
@@ -249,6 +1489,7 @@ class FilePatch(object):
         :param string file: the relative path to the patch file.
         :param string work_directory: the path to the directory of the yaml file.
         """
+        self.file = file
         self.file_path = os.path.join(work_directory, file)
 
     def apply(self, folder):
@@ -258,27 +1499,287 @@ class FilePatch(object):
         :raise: RuntimeError if the patch could not be applied.
         """
         logger.info("Apply Patch File %s", self.file_path)
-        command = "git apply {}".format(self.file_path)
-        return_code, stream_data = _run_command_inside_folder(command, folder)
+        with metrics.phase('patch'):
+            return_code, stream_data = run_git_command(folder, 'apply', self.file_path)
 
         if return_code:
             msg = "Could not apply patch file at {}. Error: {}".format(self.file_path, stream_data)
             logger.error(msg)
             raise RuntimeError(msg)
 
+    def signature(self):
+        """ Describe the patch for the result cache.
+
+        :return: the signature, made of the hash of the patch file.
+        :rtype: dict
+        """
+        with open(self.file_path, 'rb') as patch_file:
+            return {'file_sha256': hashlib.sha256(patch_file.read()).hexdigest()}
+
+    def describe(self, revision=None):  # pylint: disable=unused-argument
+        """ Describe the patch once applied.
+
+        The path is the one of the conf file, so that the description does not depend on the work directory.
+
+        :rtype: dict
+        """
+        return dict(self.signature(), file=self.file)
+
+    def touched_paths(self):
+        """ List the files modified by the patch file.
+
+        :rtype: list
+        """
+        paths = set()
+        with open(self.file_path, 'r') as patch_file:
+            for line in patch_file:
+                if line.startswith(('--- ', '+++ ')):
+                    path = line[4:].rstrip('\n').split('\t')[0]
+                    if path != '/dev/null':
+                        paths.add(path[2:] if path.startswith(('a/', 'b/')) else path)
+        return sorted(paths)
+
+
+class PatchPipeline(object):
+    """ Apply a list of patches with as few git processes as possible.
+
+    The branches are fetched with a single git fetch per remote url.
+    The merges are then done in order and each run of consecutive patch files
+    is applied with a single git apply. Every patch is committed, so that HEAD
+    contains the patched tree.
+
+    With a cache of mirrors, the branches are fetched from the mirror of each remote.
+    The mirror of a fork borrows the objects of the mirror of the patched repository.
+    """
+
+    def __init__(self, patches, cache=None, reference=None):
+        """ Init
+
+        :param list patches: list of Patch and FilePatch objects.
+        :param MirrorCache cache: Optional cache of mirrors to fetch the branches from.
+        :param string reference: Optional url of the patched repository, whose mirror shares its objects with forks.
+        """
+        self.patches = patches
+        self.cache = cache
+        self.reference = reference
+        self._revisions = {}
+
+    def _iter_remotes(self):
+        """ Group the patches from a branch by remote url.
+
+        :return: yield the url and the patches of each remote, in the order of their first patch
+        """
+        remotes = {}
+        for patch in self.patches:
+            if isinstance(patch, Patch):
+                remotes.setdefault(patch.url, []).append(patch)
+        yield from remotes.items()
+
+    def revision(self, patch):
+        """ Get the sha merged for a patch from a branch, once fetched.
+
+        :param Patch patch: the patch.
+        :rtype: string
+        """
+        return self._revisions.get(patch)
+
+    @staticmethod
+    def _local_ref(index, branch):
+        return 'refs/gitoo/patch-{}/{}'.format(index, branch)
+
+    def fetch(self, folder):
+        """ Fetch the branches of every patch.
+
+        :param string folder: path of the folder where is the git repo cloned at.
+        """
+        with metrics.phase('patch_fetch'):
+            self._fetch(folder)
+
+    def _fetch(self, folder):
+        depth = ['--depth', '1'] if self.patches and _is_shallow(folder) else []
+        unpinned = []
+        for index, (url, patches) in enumerate(self._iter_remotes()):
+            branches = sorted({patch.branch for patch in patches})
+            logger.info("Fetch %s patch branch(es) from %s", len(branches), url)
+            refspecs = ['+refs/heads/{}:{}'.format(branch, self._local_ref(index, branch)) for branch in branches]
+            if self.cache is not None:
+                with self.cache.mirror(url, reference=self.reference) as mirror:
+                    run_git(folder, 'fetch', '--quiet', mirror, *refspecs)
+            else:
+                run_git(folder, 'fetch', '--quiet', *depth, url, *refspecs)
+            for patch in patches:
+                if patch.commit:
+                    self._revisions[patch] = patch.commit
+                else:
+                    unpinned.append((patch, self._local_ref(index, patch.branch)))
+
+        if unpinned:
+            shas = run_git(folder, 'rev-parse', *[ref for _, ref in unpinned]).split()
+            for (patch, _), sha in zip(unpinned, shas):
+                self._revisions[patch] = sha
+
+    def touched_paths(self, folder, revision):
+        """ List the files modified by the patches, compared to the given revision.
+
+        For a patch from a branch, this includes every file that differs between both trees.
+
+        :param string folder: path of the folder where is the git repo cloned at.
+        :param string revision: the revision the patches will be applied on.
+        :rtype: set
+        """
+        paths = set()
+        for patch in self.patches:
+            if isinstance(patch, FilePatch):
+                paths.update(patch.touched_paths())
+            else:
+                diff = run_git(folder, 'diff', '-z', '--name-only', revision, self._revisions[patch])
+                paths.update(path for path in diff.split('\0') if path)
+        return paths
+
+    def apply(self, folder):
+        """ Apply the fetched patches in order.
+
+        :param string folder: path of the folder where is the git repo cloned at.
+        :raise: RuntimeError if a patch could not be applied.
+        """
+        start = time.monotonic()
+        with metrics.phase('patch'):
+            for patch_group in self._iter_groups():
+                if isinstance(patch_group[0], FilePatch):
+                    self._apply_files(folder, patch_group)
+                else:
+                    self._merge(folder, patch_group[0])
+
+        metrics.count('patches_applied', len(self.patches))
+        if self.patches:
+            logger.info("Patch stage: %s patch(es) applied in %.2fs", len(self.patches), time.monotonic() - start)
+
+    def _iter_groups(self):
+        """ Group the consecutive patch files together, keep the patches from a branch alone."""
+        group = []
+        for patch in self.patches:
+            if isinstance(patch, FilePatch) and group and isinstance(group[0], FilePatch):
+                group.append(patch)
+                continue
+            if group:
+                yield group
+            group = [patch]
+        if group:
+            yield group
+
+    def _merge(self, folder, patch):
+        revision = self._revisions[patch]
+        logger.info("Apply Patch %s@%s (commit %s)", patch.url, patch.branch, revision)
+        if _is_shallow(folder):
+            _deepen_until_merge_base(folder, revision, patch.url, patch.branch)
+        return_code, stream_data = run_git_command(
+            folder, *_PATCH_IDENTITY, 'merge', '--quiet', revision, '-m', 'patch')
+        if return_code:
+            msg = "Could not apply patch from {}@{}: git merge {}. Error: {}".format(
+                patch.url, patch.branch, revision, stream_data)
+            logger.error(msg)
+            raise RuntimeError(msg)
+
+    @staticmethod
+    def _apply_files(folder, patches):
+        """ Apply the patch files with a single git apply, then commit them.
+
+        git apply stops at the first patch file that does not apply. In that case,
+        the changes are reset and the patch files are applied one at a time,
+        to report the status of each one.
+        """
+        file_paths = [patch.file_path for patch in patches]
+        logger.info("Apply Patch Files %s", ', '.join(file_paths))
+        return_code, _ = run_git_command(folder, 'apply', '--index', *file_paths, capture=False)
+        if not return_code:
+            run_git(folder, *_PATCH_IDENTITY, 'commit', '--quiet', '--allow-empty', '--no-verify', '-m', 'patch files')
+            return
+
+        run_git(folder, 'reset', '--quiet', '--hard')
+        report = []
+        for file_path in file_paths:
+            return_code, stream_data = run_git_command(folder, 'apply', '--index', file_path)
+            report.append('{}: {}'.format(file_path, 'FAILED {}'.format(stream_data) if return_code else 'ok'))
+            if return_code:
+                break
+        report.extend('{}: not applied'.format(path) for path in file_paths[len(report):])
+        msg = "Could not apply patch files:\n{}".format('\n'.join(report))
+        logger.error(msg)
+        raise RuntimeError(msg)
+
+
+def list_tree_files(folder, revision):
+    """ List the files of a git tree, without checking it out.
+
+    :param string folder: path of the folder where is the git repo cloned at.
+    :param string revision: the revision of the tree.
+    :rtype: list
+    """
+    output = run_git(folder, 'ls-tree', '-r', '-z', '--name-only', revision)
+    return [path for path in output.split('\0') if path]
+
+
+def extract_member(archive, member, folder):
+    """ Extract a member of a tar archive, with the data filter when the python version supports it.
+
+    :param tarfile.TarFile archive: the archive.
+    :param tarfile.TarInfo member: the member to extract.
+    :param string folder: the folder where the member is extracted.
+    """
+    if hasattr(tarfile, 'data_filter'):
+        archive.extract(member, folder, filter='data')
+    else:
+        archive.extract(member, folder)
+
+
+def iter_tree_modules(files, directories):
+    """ Find the modules from the files of a git tree.
+
+    :param list files: the paths of the files in the git tree.
+    :param tuple directories: the folders that contain modules ('' for the root of the tree).
+    :return: yield the name and the path of each module
+    """
+    for path in files:
+        folder, _, file_name = path.rpartition('/')
+        if file_name == '__manifest__.py' and os.path.dirname(folder) in directories:
+            yield os.path.basename(folder), folder
+
 
 def iter_module_folders(directory):
-    for file in os.listdir(directory):
-        file_path = os.path.join(directory, file)
-        if _is_odoo_module(file_path):
-            yield file_path
+    for module in iter_folder_modules(directory):
+        yield module.path
+
 
+def signature_key(signature):
+    """ Compute a stable hash of the signature of an add-on.
+
+    :param dict signature: the inputs of the installation (see Addon.signature).
+    :rtype: string
+    """
+    data = json.dumps(signature, sort_keys=True).encode()
+    return hashlib.sha256(data).hexdigest()
+
+
+def is_commit_sha(revision):
+    """ Evaluate if the given revision is a full commit sha.
+
+    :param string revision: the revision to evaluate.
+    :rtype: bool
+    """
+    return bool(revision) and len(revision) == 40 and all(c in string.hexdigits for c in revision)
 
-def _is_odoo_module(file_path):
-    return (
-        os.path.isdir(file_path) and
-        '__manifest__.py' in os.listdir(file_path)
-    )
+
+def strip_credentials(url):
+    """ Remove the credentials (i.e. a token) from the given url.
+
+    :param string url: the url to clean.
+    :rtype: string
+    """
+    parts = urlsplit(url)
+    if '@' not in parts.netloc:
+        return url
+    netloc = parts.netloc.rsplit('@', 1)[1]
+    return urlunsplit((parts.scheme, netloc, parts.path, parts.query, parts.fragment))
 
 
 def parse_url(url):
@@ -295,6 +1796,13 @@ def parse_url(url):
     except NameError:
         url = url
 
+    if '{{' not in url:
+        return url
+
+    # pystache is imported only when needed, since it slows down the start of gitoo
+    import pystache  # pylint: disable=import-outside-toplevel
+    from pystache.parser import _EscapeNode  # pylint: disable=protected-access,import-outside-toplevel
+
     parsed = pystache.parse(url)
     # pylint: disable=protected-access
     variables = (element.key for element in parsed._parse_tree if isinstance(element, _EscapeNode))
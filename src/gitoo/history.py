@@ -0,0 +1,97 @@
+import os
+import json
+import logging
+import tempfile
+
+from .core import strip_credentials
+
+logger = logging.getLogger('gitoo-history')
+logger.setLevel(logging.INFO)
+
+HISTORY_FILE = 'history.json'
+HISTORY_VERSION = 1
+
+# The weight of the last run in the estimates, so that old runs are forgotten progressively
+_SMOOTHING = 0.5
+
+
+class History(object):
+    """ The durations and sizes of the past installations of each repository, kept in a JSON file.
+
+    The values are keyed by the url of the repository (without credentials) and smoothed over the runs,
+    so that a single slow run does not change the estimates too much.
+    """
+
+    def __init__(self, path):
+        """ Init
+
+        :param string path: the path of the history file.
+        """
+        self.path = path
+        self.repositories = {}
+        if os.path.exists(path):
+            with open(path, 'r') as history_file:
+                data = json.load(history_file)
+            if data.get('version') == HISTORY_VERSION:
+                self.repositories = data['repositories']
+            else:
+                logger.warning("The history file %s has an unknown version, it is ignored.", path)
+
+    def estimate(self, url):
+        """ Get the estimates of a repository.
+
+        :param string url: the url of the repository.
+        :return: the duration in seconds and the bytes fetched and written, or None if the repository is unknown.
+        :rtype: dict
+        """
+        return self.repositories.get(strip_credentials(url))
+
+    def record(self, url, seconds, bytes_fetched, bytes_written):
+        """ Add the measures of an installation of a repository to the history.
+
+        :param string url: the url of the repository.
+        :param float seconds: the duration of the preparation of the repository.
+        :param int bytes_fetched: the size of the cloned repository.
+        :param int bytes_written: the size of the installed modules.
+        """
+        measures = {'seconds': seconds, 'bytes_fetched': bytes_fetched, 'bytes_written': bytes_written}
+        previous = self.estimate(url)
+        if previous is not None:
+            measures = {
+                name: previous.get(name, value) * (1 - _SMOOTHING) + value * _SMOOTHING
+                for name, value in measures.items()
+            }
+        measures['runs'] = (previous or {}).get('runs', 0) + 1
+        self.repositories[strip_credentials(url)] = measures
+
+    def record_report(self, addons, report):
+        """ Add the measures of the add-ons prepared during an installation, taken from the metrics report.
+
+        The add-ons restored from the result cache are not recorded, since they do not use git.
+
+        :param list addons: the Addon objects installed.
+        :param dict report: the report of the metrics recorder (see metrics.Recorder.report).
+        """
+        entries = {entry['id']: entry for entry in report['entries']}
+        for addon in addons:
+            entry = entries.get(addon.metrics_id)
+            if entry is None or 'clone' not in entry['phases']:
+                continue
+            counters = entry['counters']
+            self.record(
+                addon.repo, entry['phases'].get('prepare', entry['wall_seconds']),
+                counters.get('bytes_fetched', 0), counters.get('bytes_written', 0))
+
+    def save(self):
+        """ Write the history file atomically. """
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        data = {'version': HISTORY_VERSION, 'repositories': self.repositories}
+        file_descriptor, tmp_path = tempfile.mkstemp(dir=directory, prefix='.gitoo-history-', suffix='.tmp')
+        try:
+            with os.fdopen(file_descriptor, 'w') as tmp_file:
+                json.dump(data, tmp_file, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
@@ -0,0 +1,153 @@
+import ast
+import os
+import logging
+
+logger = logging.getLogger('gitoo-index')
+logger.setLevel(logging.INFO)
+
+MANIFEST = '__manifest__.py'
+
+
+class Module(object):
+    """ An Odoo module found inside a folder.
+
+    The manifest is parsed the first time one of its values is read.
+    """
+
+    def __init__(self, name, path):
+        """ Init
+
+        :param string name: the name of the module (its folder name).
+        :param string path: the path of the module folder.
+        """
+        self.name = name
+        self.path = path
+        self._manifest = None
+
+    @property
+    def manifest(self):
+        if self._manifest is None:
+            self._manifest = read_manifest(os.path.join(self.path, MANIFEST))
+        return self._manifest
+
+    @property
+    def version(self):
+        return self.manifest.get('version', '')
+
+    @property
+    def depends(self):
+        return list(self.manifest.get('depends') or [])
+
+    @property
+    def installable(self):
+        return bool(self.manifest.get('installable', True))
+
+
+class ModuleIndex(object):
+    """ The Odoo modules contained in a set of folders, indexed by name.
+
+    The folders are scanned once, so that the index can be reused by every stage of an installation.
+    Iterating over the index yields every module found. When two folders contain a module
+    with the same name, the module of the last folder is the one found by name.
+    """
+
+    def __init__(self, modules=None):
+        """ Init
+
+        :param list modules: the Module objects of the index.
+        """
+        self._modules = []
+        self._modules_by_name = {}
+        for module in modules or []:
+            self.add(module)
+
+    @classmethod
+    def scan(cls, folder, directories=('',)):
+        """ Build the index of the modules contained in the given directories of a folder.
+
+        :param string folder: the root folder.
+        :param tuple directories: the directories that contain modules, relative to the folder.
+        :rtype: ModuleIndex
+        """
+        index = cls()
+        for directory in directories:
+            directory_path = os.path.join(folder, directory)
+            if os.path.isdir(directory_path):
+                for module in iter_folder_modules(directory_path):
+                    index.add(module)
+        return index
+
+    def add(self, module):
+        self._modules.append(module)
+        self._modules_by_name[module.name] = module
+
+    def update(self, other):
+        """ Add the modules of another index, which win over the modules with the same name.
+
+        :param ModuleIndex other: the other index.
+        """
+        for module in other:
+            self.add(module)
+
+    def __iter__(self):
+        return iter(list(self._modules))
+
+    def __contains__(self, name):
+        return name in self._modules_by_name
+
+    def get(self, name):
+        return self._modules_by_name.get(name)
+
+    def names(self):
+        return set(self._modules_by_name)
+
+    def dependency_closure(self, names):
+        """ Compute the given modules and all their dependencies, recursively.
+
+        :param iterable names: the names of the required modules.
+        :return: the names of the modules found in the index and the names of the missing ones.
+        :rtype: Tuple[set, set]
+        """
+        found = set()
+        missing = set()
+        to_visit = list(names)
+        while to_visit:
+            name = to_visit.pop()
+            if name in found or name in missing:
+                continue
+            module = self._modules_by_name.get(name)
+            if module is None:
+                missing.add(name)
+                continue
+            found.add(name)
+            to_visit.extend(module.depends)
+        return found, missing
+
+
+def iter_folder_modules(directory):
+    """ Find the modules of a directory with a single scan of the directory.
+
+    :param string directory: the directory that contains the modules.
+    :return: yield a Module object per module folder
+    """
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir() and os.path.isfile(os.path.join(entry.path, MANIFEST)):
+                yield Module(entry.name, entry.path)
+
+
+def read_manifest(path):
+    """ Parse the manifest of a module, without executing it.
+
+    :param string path: the path of the __manifest__.py file.
+    :return: the content of the manifest, or an empty dict if it could not be parsed.
+    :rtype: dict
+    """
+    with open(path, 'r', encoding='utf-8') as manifest_file:
+        content = manifest_file.read()
+    try:
+        manifest = ast.literal_eval(content)
+    except (SyntaxError, ValueError):
+        logger.warning("Could not parse the manifest %s", path)
+        return {}
+    return manifest if isinstance(manifest, dict) else {}
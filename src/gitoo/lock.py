@@ -0,0 +1,122 @@
+import logging
+from concurrent import futures
+
+from .core import run_git, parse_url
+
+logger = logging.getLogger('gitoo-lock')
+logger.setLevel(logging.INFO)
+
+MAX_JOBS = 32
+
+
+def resolve_ref(url, branch):
+    """ Find the sha of the tip of a branch, without cloning the repository.
+
+    :param string url: the url of the repository.
+    :param string branch: the name of the branch.
+    :rtype: string
+    :raise: RuntimeError if the branch does not exist.
+    """
+    output = run_git(None, 'ls-remote', parse_url(url), 'refs/heads/{}'.format(branch))
+    for line in output.splitlines():
+        sha, ref = line.split('\t')
+        if ref == 'refs/heads/{}'.format(branch):
+            return sha
+
+    msg = "Could not find the branch {} in {}".format(branch, url)
+    logger.error(msg)
+    raise RuntimeError(msg)
+
+
+def iter_refs(data):
+    """ Iterate over the refs of the config file: the entries and the patches from a branch.
+
+    :param list data: the content of the config file.
+    :return: yield the url, the branch and the commit (possibly empty) of each ref
+    """
+    for entry in data:
+        yield entry['url'], entry['branch'], entry.get('commit')
+        for patch in entry.get('patches') or []:
+            if 'file' not in patch:
+                yield patch['url'], patch['branch'], patch.get('commit')
+
+
+def lock(data, jobs=MAX_JOBS):
+    """ Pin every ref of the config file to a commit sha.
+
+    The refs without commit are resolved concurrently with git ls-remote.
+
+    When a ref appears both with and without commit in the config file,
+    the lock file contains the resolved sha.
+
+    :param list data: the content of the config file.
+    :param int jobs: the maximum number of refs resolved at the same time.
+    :return: the content of the lock file.
+    :rtype: list
+    """
+    pinned = {}
+    to_resolve = []
+    for url, branch, commit in iter_refs(data):
+        if commit:
+            pinned.setdefault((url, branch), commit)
+        elif (url, branch) not in to_resolve:
+            to_resolve.append((url, branch))
+
+    resolved = {}
+    if to_resolve:
+        logger.info("Resolving %s ref(s)", len(to_resolve))
+        with futures.ThreadPoolExecutor(max_workers=min(jobs, len(to_resolve))) as executor:
+            resolved = dict(zip(to_resolve, executor.map(lambda ref: resolve_ref(*ref), to_resolve)))
+
+    refs = []
+    for url, branch, _ in iter_refs(data):
+        ref = {'url': url, 'branch': branch, 'commit': resolved.get((url, branch)) or pinned[(url, branch)]}
+        if ref not in refs:
+            refs.append(ref)
+    return refs
+
+
+def apply_lock(data, refs):
+    """ Give a commit to every ref of the config file that does not have one.
+
+    :param list data: the content of the config file.
+    :param list refs: the content of the lock file.
+    :return: a copy of the config file content, with the commits.
+    :rtype: list
+    :raise: RuntimeError if a ref is missing from the lock file.
+    """
+    commits = {(ref['url'], ref['branch']): ref['commit'] for ref in refs}
+
+    def _pin(definition):
+        definition = dict(definition)
+        if not definition.get('commit'):
+            key = (definition['url'], definition['branch'])
+            if key not in commits:
+                msg = "The ref {}@{} is missing from the lock file. Run gitoo lock again.".format(*key)
+                logger.error(msg)
+                raise RuntimeError(msg)
+            definition['commit'] = commits[key]
+        return definition
+
+    locked = []
+    for entry in data:
+        entry = _pin(entry)
+        if entry.get('patches'):
+            entry['patches'] = [
+                patch if 'file' in patch else _pin(patch)
+                for patch in entry['patches']
+            ]
+        locked.append(entry)
+    return locked
+
+
+def read_lock_file(path):
+    import yaml  # pylint: disable=import-outside-toplevel
+    with open(path, 'r') as lock_file:
+        return yaml.safe_load(lock_file) or []
+
+
+def write_lock_file(path, refs):
+    import yaml  # pylint: disable=import-outside-toplevel
+    with open(path, 'w') as lock_file:
+        yaml.safe_dump(refs, lock_file, default_flow_style=False)
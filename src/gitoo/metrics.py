@@ -0,0 +1,205 @@
+import os
+import json
+import time
+import threading
+import contextlib
+
+_current = threading.local()
+
+
+class Recorder(object):
+    """ Record the duration of the phases and the counters of each entry of an installation.
+
+    The phases and counters are recorded for the entry of the current thread (see recording),
+    so that the functions of gitoo do not need to know about the recorder.
+
+    Each entry is recorded under the id given by register, since many entries may have the same name
+    (i.e. the same repository and branch with other includes, or in another destination).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+        self.started_at = time.time()
+        self._entries = {}
+        self._names = {}
+        self._spans = []
+
+    def register(self, name):
+        """ Give an id to an entry.
+
+        :param string name: the name of the entry in the report, i.e. its url and branch.
+        :return: the id under which the entry is recorded.
+        :rtype: int
+        """
+        with self._lock:
+            entry = len(self._names)
+            self._names[entry] = name
+            return entry
+
+    def _entry(self, entry):
+        if entry not in self._entries:
+            self._entries[entry] = {'phases': {}, 'counters': {}, 'start': None, 'end': None}
+        return self._entries[entry]
+
+    def add_phase(self, entry, phase, start, end):
+        """ Record a phase of an entry.
+
+        :param int entry: the id of the entry (see register).
+        :param string phase: the name of the phase.
+        :param float start: the start of the phase (time.perf_counter).
+        :param float end: the end of the phase (time.perf_counter).
+        """
+        with self._lock:
+            data = self._entry(entry)
+            data['phases'][phase] = data['phases'].get(phase, 0.0) + end - start
+            data['start'] = start if data['start'] is None else min(data['start'], start)
+            data['end'] = end if data['end'] is None else max(data['end'], end)
+            self._spans.append((entry, phase, start, end, threading.get_ident()))
+
+    def add_count(self, entry, counter, value):
+        """ Increment a counter of an entry.
+
+        :param int entry: the id of the entry (see register).
+        :param string counter: the name of the counter.
+        :param int value: the value to add.
+        """
+        with self._lock:
+            counters = self._entry(entry)['counters']
+            counters[counter] = counters.get(counter, 0) + value
+
+    def report(self):
+        """ Build the report of the installation.
+
+        :return: the total duration, the counters summed over the entries and the details of each entry,
+                 with its id and its name.
+        :rtype: dict
+        """
+        with self._lock:
+            entries = []
+            totals = {}
+            for entry, data in self._entries.items():
+                for counter, value in data['counters'].items():
+                    totals[counter] = totals.get(counter, 0) + value
+                entries.append({
+                    'id': entry,
+                    'entry': self._names.get(entry, entry),
+                    'wall_seconds': round(data['end'] - data['start'], 6) if data['start'] is not None else 0.0,
+                    'phases': {phase: round(seconds, 6) for phase, seconds in sorted(data['phases'].items())},
+                    'counters': dict(sorted(data['counters'].items())),
+                })
+
+        return {
+            'started_at': self.started_at,
+            'total_seconds': round(time.perf_counter() - self._origin, 6),
+            'counters': dict(sorted(totals.items())),
+            'entries': entries,
+        }
+
+    def trace(self):
+        """ Build a timeline of the phases, in the Chrome trace event format (chrome://tracing).
+
+        :rtype: dict
+        """
+        with self._lock:
+            spans = list(self._spans)
+            names = dict(self._names)
+        events = [
+            {
+                'name': phase,
+                'cat': 'gitoo',
+                'ph': 'X',
+                'ts': round((start - self._origin) * 1e6),
+                'dur': round((end - start) * 1e6),
+                'pid': os.getpid(),
+                'tid': thread_id,
+                'args': {'entry': names.get(entry, entry), 'id': entry},
+            }
+            for entry, phase, start, end, thread_id in spans
+        ]
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write(self, report_path=None, trace_path=None):
+        """ Write the report and the trace as JSON files.
+
+        :param string report_path: Optional path of the report.
+        :param string trace_path: Optional path of the Chrome trace.
+        """
+        for path, data in ((report_path, self.report), (trace_path, self.trace)):
+            if path:
+                with open(path, 'w') as json_file:
+                    json.dump(data(), json_file, indent=2)
+
+
+@contextlib.contextmanager
+def recording(recorder, entry):
+    """ Record the phases and counters of the current thread for the given entry.
+
+    :param Recorder recorder: the recorder, or None to record nothing.
+    :param int entry: the id of the entry (see Recorder.register).
+    """
+    previous = getattr(_current, 'target', None)
+    _current.target = (recorder, entry) if recorder is not None else None
+    try:
+        yield
+    finally:
+        _current.target = previous
+
+
+def is_recording():
+    """ Evaluate if the current thread records its metrics.
+
+    This allows to skip the computation of the counters that are costly.
+
+    :rtype: bool
+    """
+    return getattr(_current, 'target', None) is not None
+
+
+@contextlib.contextmanager
+def phase(name):
+    """ Record the duration of a phase for the entry of the current thread.
+
+    :param string name: the name of the phase.
+    """
+    target = getattr(_current, 'target', None)
+    if target is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        recorder, entry = target
+        recorder.add_phase(entry, name, start, time.perf_counter())
+
+
+def count(name, value=1):
+    """ Increment a counter for the entry of the current thread.
+
+    :param string name: the name of the counter.
+    :param int value: the value to add.
+    """
+    target = getattr(_current, 'target', None)
+    if target is not None and value:
+        recorder, entry = target
+        recorder.add_count(entry, name, value)
+
+
+def folder_size(path):
+    """ Count the files of a folder and their size, without following the symbolic links.
+
+    :param string path: the folder.
+    :return: the number of files and their size in bytes.
+    :rtype: Tuple[int, int]
+    """
+    files = 0
+    size = 0
+    for directory, _, file_names in os.walk(path):
+        for file_name in file_names:
+            file_path = os.path.join(directory, file_name)
+            if not os.path.islink(file_path):
+                files += 1
+                size += os.path.getsize(file_path)
+    return files, size
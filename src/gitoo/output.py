@@ -0,0 +1,130 @@
+import os
+import sys
+import gzip
+import tarfile
+import logging
+import contextlib
+
+from . import metrics
+
+logger = logging.getLogger('gitoo-output')
+logger.setLevel(logging.INFO)
+
+NO_COMPRESSION = 'none'
+GZIP = 'gzip'
+ZSTD = 'zstd'
+COMPRESSIONS = (NO_COMPRESSION, GZIP, ZSTD)
+
+STDOUT = '-'
+
+_SUFFIXES = (
+    ('.tar.gz', GZIP),
+    ('.tgz', GZIP),
+    ('.tar.zst', ZSTD),
+    ('.tzst', ZSTD),
+)
+
+
+class TarOutput(object):
+    """ A tar archive where the add-ons are streamed, instead of being installed in a destination folder.
+
+    The content of each staging folder is appended to the archive as soon as it is given,
+    so the archive has the layout of the destination folder. A folder that was already appended
+    can not be replaced anymore, so install_addons removes the folders replaced by a later add-on
+    before they are given: an add-on is given once it is prepared if the modules of the later add-ons
+    were listed from their mirrors, otherwise it is kept until the add-ons not listed are prepared.
+    A folder given twice anyway (i.e. added by a patch) is appended again and its files win when
+    the archive is extracted, but the files of the first folder are kept.
+    """
+
+    def __init__(self, archive):
+        """ Init
+
+        :param tarfile.TarFile archive: the archive opened for writing, in stream mode.
+        """
+        self.archive = archive
+        self.names = set()
+
+    def add(self, staging):
+        """ Append the content of a staging folder to the archive.
+
+        :param string staging: the folder prepared by Addon.prepare.
+        :return: the names of the folders appended.
+        :rtype: list
+        """
+        names = sorted(os.listdir(staging))
+        duplicates = self.names.intersection(names)
+        if duplicates:
+            logger.warning(
+                "Folders already written to the archive, both versions are kept: %s", ', '.join(sorted(duplicates)))
+
+        with metrics.phase('output'):
+            for name in names:
+                self.archive.add(os.path.join(staging, name), arcname=name, filter=_reset_owner)
+        self.names.update(names)
+        return names
+
+
+@contextlib.contextmanager
+def open_tar_output(path, compression=None, reproducible=False):
+    """ Open a tar archive for writing the add-ons, in stream mode.
+
+    :param string path: the path of the archive, or - for the standard output.
+    :param string compression: none, gzip or zstd. Default: guessed from the extension of the path.
+    :param bool reproducible: write the gzip header without the current time.
+    :return: yield the TarOutput object
+    :rtype: TarOutput
+    """
+    compression = compression or guess_compression(path)
+    if compression not in COMPRESSIONS:
+        raise RuntimeError("The compression should be one of {}.".format(', '.join(COMPRESSIONS)))
+
+    with contextlib.ExitStack() as stack:
+        if path == STDOUT:
+            stream = sys.stdout.buffer
+            stack.callback(stream.flush)
+        else:
+            stream = stack.enter_context(open(path, 'wb'))
+
+        if compression == ZSTD:
+            stream = stack.enter_context(_zstd_writer(stream))
+            mode = 'w|'
+        elif compression == GZIP and reproducible:
+            stream = stack.enter_context(gzip.GzipFile(filename='', fileobj=stream, mode='wb', mtime=0))
+            mode = 'w|'
+        elif compression == GZIP:
+            mode = 'w|gz'
+        else:
+            mode = 'w|'
+
+        archive = stack.enter_context(tarfile.open(fileobj=stream, mode=mode, format=tarfile.PAX_FORMAT))
+        yield TarOutput(archive)
+
+
+def guess_compression(path):
+    """ Guess the compression of an archive from its extension.
+
+    :param string path: the path of the archive.
+    :rtype: string
+    """
+    for suffix, compression in _SUFFIXES:
+        if path.endswith(suffix):
+            return compression
+    return NO_COMPRESSION
+
+
+def _zstd_writer(stream):
+    try:
+        import zstandard  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        msg = "The zstandard package is required to compress the archive with zstd (pip install zstandard)."
+        logger.error(msg)
+        raise RuntimeError(msg)
+    return zstandard.ZstdCompressor().stream_writer(stream, closefd=False)
+
+
+def _reset_owner(member):
+    """ Give the files of the archive to root, as for the files of a container image. """
+    member.uid = member.gid = 0
+    member.uname = member.gname = 'root'
+    return member
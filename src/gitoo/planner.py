@@ -0,0 +1,212 @@
+import os
+import heapq
+import shutil
+import logging
+import tempfile
+from concurrent import futures
+
+logger = logging.getLogger('gitoo-planner')
+logger.setLevel(logging.INFO)
+
+AUTO_JOBS = 'auto'
+MAX_AUTO_JOBS = 8
+
+RESULT_CACHE_HIT = 'result cache hit'
+MIRROR_HIT = 'mirror hit'
+MISS = 'miss'
+
+SHADOW_WARN = 'warn'
+SHADOW_ERROR = 'error'
+SHADOW_LAST_WINS = 'last-wins'
+SHADOW_POLICIES = (SHADOW_WARN, SHADOW_ERROR, SHADOW_LAST_WINS)
+
+# The share of the free disk space that the add-ons prepared at the same time may use
+_DISK_SHARE = 0.5
+
+
+class PlannedEntry(object):
+    """ The estimated cost of preparing an add-on, from the history of the past installations. """
+
+    def __init__(self, addon, status, seconds=0.0, bytes_fetched=0, bytes_written=0, known=False):
+        """ Init
+
+        :param Addon addon: the add-on.
+        :param string status: whether the add-on is found in the result cache or the mirror cache.
+        :param float seconds: the estimated duration of the preparation.
+        :param int bytes_fetched: the estimated size of the cloned repository.
+        :param int bytes_written: the estimated size of the installed modules.
+        :param bool known: whether the estimates come from the history.
+        """
+        self.addon = addon
+        self.status = status
+        self.seconds = seconds
+        self.bytes_fetched = bytes_fetched
+        self.bytes_written = bytes_written
+        self.known = known
+
+    @property
+    def disk_bytes(self):
+        """ The estimated disk space used while the add-on is prepared. """
+        return self.bytes_fetched + self.bytes_written
+
+
+def plan_addons(addons, history=None):
+    """ Estimate the cost of each add-on and order them longest first.
+
+    Starting the longest add-ons first (longest processing time first) gives the shortest installation
+    when they are prepared concurrently. The add-ons unknown to the history are given the average duration
+    of the known ones. The add-ons found in the result cache do not use git and come last.
+
+    :param list addons: the Addon objects.
+    :param History history: Optional history of the past installations.
+    :return: the PlannedEntry objects, longest first.
+    :rtype: list
+    """
+    entries = [_plan_addon(addon, history) for addon in addons]
+    known = [entry.seconds for entry in entries if entry.known and entry.status != RESULT_CACHE_HIT]
+    average = sum(known) / len(known) if known else 0.0
+    for entry in entries:
+        if not entry.known and entry.status != RESULT_CACHE_HIT:
+            entry.seconds = average
+    return sorted(entries, key=lambda entry: -entry.seconds)
+
+
+def _plan_addon(addon, history=None):
+    status = _cache_status(addon)
+    estimate = history.estimate(addon.repo) if history is not None else None
+    if status == RESULT_CACHE_HIT:
+        return PlannedEntry(addon, status, bytes_written=estimate['bytes_written'] if estimate else 0)
+    if estimate is None:
+        return PlannedEntry(addon, status)
+    return PlannedEntry(
+        addon, status, seconds=estimate['seconds'],
+        bytes_fetched=0 if status == MIRROR_HIT else estimate['bytes_fetched'],
+        bytes_written=estimate['bytes_written'], known=True)
+
+
+def _cache_status(addon):
+    """ Find out if the add-on is in the result cache or its repository in the mirror cache, without using git. """
+    signature = addon.signature() if addon.result_cache is not None else None
+    if signature and os.path.exists(addon.result_cache.archive_path(addon.result_cache.key(signature))):
+        return RESULT_CACHE_HIT
+    if addon.cache is not None and os.path.isdir(addon.cache.mirror_path(addon.repo)):
+        return MIRROR_HIT
+    return MISS
+
+
+def schedule(entries, jobs):
+    """ Simulate the preparation of the planned add-ons with the given number of jobs.
+
+    :param list entries: the PlannedEntry objects, in the order they start.
+    :param int jobs: the number of add-ons prepared at the same time.
+    :return: the job and the start time of each entry, and the estimated total duration.
+    :rtype: Tuple[list, float]
+    """
+    workers = [(0.0, job) for job in range(max(jobs, 1))]
+    starts = []
+    for entry in entries:
+        start, job = heapq.heappop(workers)
+        starts.append((entry, job, start))
+        heapq.heappush(workers, (start + entry.seconds, job))
+    return starts, max(end for end, _ in workers)
+
+
+def auto_jobs(entries, work_dir=None):
+    """ Choose the number of add-ons to prepare at the same time.
+
+    There is no more jobs than add-ons that use git, nor more than twice the number of processors,
+    since cloning and checking out is limited by the network and the disk.
+    The number is then reduced until the add-ons prepared at the same time fit in half of the free disk space.
+
+    :param list entries: the PlannedEntry objects.
+    :param string work_dir: Optional folder where the add-ons are prepared. Default: the system temp folder.
+    :rtype: int
+    """
+    with_git = [entry for entry in entries if entry.status != RESULT_CACHE_HIT]
+    jobs = max(1, min(len(with_git), 2 * (os.cpu_count() or 1), MAX_AUTO_JOBS))
+
+    free = shutil.disk_usage(work_dir or tempfile.gettempdir()).free
+    largest = sorted((entry.disk_bytes for entry in with_git), reverse=True)
+    while jobs > 1 and sum(largest[:jobs]) > free * _DISK_SHARE:
+        jobs -= 1
+
+    logger.info("Auto jobs: %s add-on(s) prepared at the same time", jobs)
+    return jobs
+
+
+def plan_precedence(addons, policy=SHADOW_WARN, jobs=1):
+    """ Find the modules that a later add-on replaces, so that the earlier copies are never prepared.
+
+    When two add-ons contain a module with the same name, the module of the last one is installed.
+    The modules of each add-on are listed from the git tree of its mirror, before anything is checked out.
+    The modules shadowed by a later add-on are then skipped like excluded modules: they are not
+    checked out (with --sparse or --export archive), pruned, stripped or moved.
+
+    The add-ons without a mirror, and the modules added by the patches, can not be listed in advance.
+    Their collisions are reported when the modules are installed (see core.install_addons).
+
+    :param list addons: the Addon objects, in the order of the config.
+    :param string policy: warn, error (raise before anything is installed) or last-wins (only logged).
+    :param int jobs: the number of add-ons listed at the same time, or auto.
+    :return: the shadowed module, the add-on that contains it and the add-on that replaces it.
+    :rtype: list
+    """
+    if len(addons) < 2:
+        return []
+    jobs = MAX_AUTO_JOBS if jobs == AUTO_JOBS else max(jobs, 1)
+    with futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        listings = list(executor.map(lambda addon: addon.tree_modules(), addons))
+
+    winners = {}
+    shadowed = []
+    for addon, modules in reversed(list(zip(addons, listings))):
+        addon.listed_modules = modules
+        if modules is None:
+            continue
+        addon.shadowed_modules = {name for name in modules if name in winners}
+        shadowed.extend((name, addon, winners[name]) for name in sorted(addon.shadowed_modules, reverse=True))
+        for name in modules:
+            winners.setdefault(name, addon)
+    shadowed.reverse()
+    report_shadowed(shadowed, policy)
+    return shadowed
+
+
+def report_shadowed(shadowed, policy=SHADOW_WARN, planned=True):
+    """ Report the modules replaced by a later add-on, according to the policy.
+
+    :param list shadowed: the module, the add-on that contains it and the add-on that replaces it.
+    :param string policy: warn, error or last-wins.
+    :param bool planned: whether the shadowed modules are skipped, or were installed before being replaced.
+    :raise: RuntimeError with the error policy, if a module is shadowed.
+    """
+    if not shadowed:
+        return
+    lines = [
+        "{} of {} is replaced by {}".format(name, addon.metrics_entry(), winner.metrics_entry())
+        for name, addon, winner in shadowed
+    ]
+    if policy == SHADOW_ERROR:
+        msg = "{} module(s) provided by many entries:\n{}".format(len(lines), '\n'.join(lines))
+        logger.error(msg)
+        raise RuntimeError(msg)
+    if policy == SHADOW_WARN:
+        for line in lines:
+            logger.warning("Shadowed module: %s", line)
+    if planned:
+        logger.info("Precedence: %s shadowed module(s) skipped", len(lines))
+    else:
+        logger.info("Precedence: %s folder(s) installed then replaced by a later entry", len(lines))
+
+
+def format_size(size):
+    """ Format a number of bytes for humans, i.e. 1.5 GB.
+
+    :param int size: the number of bytes.
+    :rtype: string
+    """
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024:
+            return '{:.1f} {}'.format(size, unit) if unit != 'B' else '{} B'.format(int(size))
+        size /= 1024
+    return '{:.1f} TB'.format(size)
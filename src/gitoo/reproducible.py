@@ -0,0 +1,137 @@
+import os
+import stat
+import hashlib
+import logging
+
+from .store import file_digest
+
+logger = logging.getLogger('gitoo-reproducible')
+logger.setLevel(logging.INFO)
+
+SOURCE_DATE_EPOCH = 'SOURCE_DATE_EPOCH'
+
+FILE_MODE = 0o644
+EXECUTABLE_MODE = 0o755
+FOLDER_MODE = 0o755
+
+# The files of the destination that do not depend only on the installed modules
+_NOT_DIGESTED = ('.gitoo-state.json',)
+
+
+class Normalizer(object):
+    """ Give the files of the staging folders the same metadata from one installation to another.
+
+    The modification times are set to SOURCE_DATE_EPOCH, or else to the time of the commit installed.
+    The permissions are set to 0644, or 0755 for the folders and the executable files.
+    The owner is the user that runs gitoo (the files of a tar output are given to root).
+    """
+
+    def __init__(self, epoch=None):
+        """ Init
+
+        :param int epoch: Optional modification time of every file. Default: the time of the commit of each add-on.
+        """
+        self.epoch = epoch
+
+    @classmethod
+    def from_environment(cls):
+        """ Build the normalizer, with the epoch given by the SOURCE_DATE_EPOCH variable if it is set.
+
+        :rtype: Normalizer
+        """
+        value = os.environ.get(SOURCE_DATE_EPOCH)
+        if not value:
+            return cls()
+        try:
+            return cls(int(value))
+        except ValueError:
+            msg = "{} should be a number of seconds, not {}".format(SOURCE_DATE_EPOCH, value)
+            logger.error(msg)
+            raise RuntimeError(msg)
+
+    def signature(self):
+        """ Describe the normalization for the result cache.
+
+        :rtype: dict
+        """
+        return {'epoch': self.epoch if self.epoch is not None else 'commit'}
+
+    def normalize_folder(self, folder, commit_time=None):
+        """ Normalize the modification times and the permissions of the content of a folder.
+
+        :param string folder: the folder, i.e. a staging folder.
+        :param int commit_time: the time of the commit the content comes from, used without epoch.
+        :return: the number of files normalized.
+        :rtype: int
+        """
+        mtime = self.epoch if self.epoch is not None else commit_time
+        count = 0
+        # Bottom up, so that the times of the folders are set after their content
+        for directory, directories, file_names in os.walk(folder, topdown=False):
+            for name in file_names + directories:
+                path = os.path.join(directory, name)
+                _normalize_path(path, mtime)
+                count += 1
+        return count
+
+    def normalize_root(self, destination):
+        """ Normalize the destination folder itself and the files of gitoo inside it (i.e. the modules index).
+
+        Without epoch, the time of the most recent module is used.
+
+        :param string destination: the folder where the add-ons are installed.
+        """
+        with os.scandir(destination) as entries:
+            entries = list(entries)
+        mtime = self.epoch
+        if mtime is None:
+            mtime = max((int(entry.stat(follow_symlinks=False).st_mtime) for entry in entries), default=None)
+        for entry in entries:
+            if not entry.is_dir(follow_symlinks=False):
+                _normalize_path(entry.path, mtime)
+        _normalize_path(destination, mtime)
+
+
+def tree_digest(folder):
+    """ Hash the content of a folder: the path, the content and the executable bit of every file.
+
+    The modification times and the owners are not part of the digest, nor the sync state.
+
+    :param string folder: the folder, i.e. a destination.
+    :return: the digest, as sha256:<hex>.
+    :rtype: string
+    """
+    digest = hashlib.sha256()
+    for directory, directories, file_names in os.walk(folder):
+        directories.sort()
+        relative_directory = os.path.relpath(directory, folder)
+        for name in sorted(file_names):
+            path = os.path.join(directory, name)
+            relative_path = name if relative_directory == '.' else os.path.join(relative_directory, name)
+            if relative_path in _NOT_DIGESTED:
+                continue
+            if os.path.islink(path):
+                entry = 'link {} {}'.format(relative_path, os.readlink(path))
+            else:
+                entry = 'file {} {}'.format(relative_path, file_digest(path, os.stat(path).st_mode))
+            digest.update(entry.encode('utf-8', 'surrogateescape') + b'\0')
+        for name in directories:
+            relative_path = name if relative_directory == '.' else os.path.join(relative_directory, name)
+            digest.update('folder {}'.format(relative_path).encode('utf-8', 'surrogateescape') + b'\0')
+    return 'sha256:' + digest.hexdigest()
+
+
+def _normalize_path(path, mtime=None):
+    path_stat = os.lstat(path)
+    if stat.S_ISLNK(path_stat.st_mode):
+        if mtime is not None and os.utime in os.supports_follow_symlinks:
+            os.utime(path, (mtime, mtime), follow_symlinks=False)
+        return
+    if stat.S_ISDIR(path_stat.st_mode):
+        mode = FOLDER_MODE
+    else:
+        mode = EXECUTABLE_MODE if path_stat.st_mode & stat.S_IXUSR else FILE_MODE
+    if stat.S_IMODE(path_stat.st_mode) != mode:
+        os.chmod(path, mode)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
@@ -0,0 +1,247 @@
+import os
+import json
+import socket
+import logging
+import threading
+import socketserver
+
+from . import api
+from . import core
+from . import cache as mirror_cache
+from . import history as run_history
+
+logger = logging.getLogger('gitoo-server')
+logger.setLevel(logging.INFO)
+
+DEFAULT_MAX_REQUESTS = 4
+
+# Only the user of the server may connect, since a request chooses the folders where the server writes
+SOCKET_MODE = 0o600
+
+# The options of api.install_many that a client may give. The caches of mirrors and the history belong to the server.
+INSTALL_OPTIONS = (
+    'lang', 'jobs', 'sparse', 'result_cache', 'export', 'store_dir', 'store_link', 'strip',
+    'metrics_file', 'trace_file', 'byte_compile', 'compile_optimize', 'compile_invalidation', 'modules_index',
+    'on_shadow', 'reproducible',
+)
+
+# The options that are paths. The server does not share the working directory of the client, so they must be absolute.
+PATH_OPTIONS = ('result_cache', 'store_dir', 'metrics_file', 'trace_file')
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """ Serve the installations of many clients on a Unix socket, with mirrors kept warm between them.
+
+    Every request goes through the same cache of mirrors, so that concurrent requests for the same
+    repository wait for a single fetch, and a pinned commit already mirrored is not fetched again.
+    The repositories of the prefetch list are fetched on a schedule, as well as the repositories
+    installed through the server.
+
+    The protocol is made of JSON lines: each request is a JSON object on a line,
+    answered by a JSON object on a line, with either a result or an error.
+
+    A request chooses the destination and the other folders where the server writes,
+    so the socket can only be used by the user that runs the server.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, cache_dir, prefetch_urls=(), interval=None, max_requests=DEFAULT_MAX_REQUESTS):
+        """ Init
+
+        :param string socket_path: the path of the Unix socket.
+        :param string cache_dir: the folder where the git mirrors are cached.
+        :param list prefetch_urls: the urls of the repositories to keep warm.
+        :param float interval: Optional number of seconds between two prefetches of the repositories.
+        :param int max_requests: the number of installations served at the same time.
+        """
+        _remove_stale_socket(socket_path)
+        self.socket_path = socket_path
+        self.cache_dir = cache_dir
+        self.mirrors = mirror_cache.MirrorCache(cache_dir)
+        self.history_file = os.path.join(cache_dir, run_history.HISTORY_FILE)
+        self.interval = interval
+        self.urls = {core.strip_credentials(url): url for url in prefetch_urls}
+        self._urls_lock = threading.Lock()
+        self._requests = threading.BoundedSemaphore(max_requests)
+        self._stopped = threading.Event()
+        socketserver.UnixStreamServer.__init__(self, socket_path, RequestHandler)
+
+    def server_bind(self):
+        """ Bind the socket, then restrict it to the user of the server before it listens. """
+        socketserver.UnixStreamServer.server_bind(self)
+        os.chmod(self.socket_path, SOCKET_MODE)
+
+    def serve(self):
+        """ Serve the requests until the server is shut down. """
+        prefetcher = threading.Thread(target=self._prefetch_loop, daemon=True)
+        prefetcher.start()
+        logger.info("Serving on %s, mirrors in %s", self.socket_path, self.cache_dir)
+        try:
+            self.serve_forever()
+        finally:
+            self._stopped.set()
+            self.server_close()
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+    def _prefetch_loop(self):
+        self.prefetch()
+        while self.interval and not self._stopped.wait(self.interval):
+            self.prefetch()
+
+    def prefetch(self):
+        """ Fetch the mirror of every repository to keep warm.
+
+        :return: the number of repositories fetched.
+        :rtype: int
+        """
+        with self._urls_lock:
+            urls = sorted(self.urls.values())
+        fetched = 0
+        for url in urls:
+            try:
+                with self.mirrors.mirror(url):
+                    fetched += 1
+            except RuntimeError as error:
+                logger.warning("Could not prefetch %s: %s", core.strip_credentials(url), error)
+        if urls:
+            logger.info("Prefetch: %s of %s repositor(ies) fetched", fetched, len(urls))
+        return fetched
+
+    def handle_request_data(self, request):
+        """ Answer a request.
+
+        :param dict request: the request, with a command (ping, install or prefetch) and its arguments.
+        :return: the answer.
+        :rtype: dict
+        """
+        command = request.get('command')
+        try:
+            if command == 'ping':
+                return {'result': 'pong'}
+            if command == 'prefetch':
+                return {'result': self.prefetch()}
+            if command == 'install':
+                return {'result': self._install(request)}
+            msg = "Unknown command {}".format(command)
+            logger.error(msg)
+            raise RuntimeError(msg)
+        except Exception as error:  # pylint: disable=broad-except
+            logger.exception("The request %s failed", command)
+            return {'error': str(error)}
+
+    def _install(self, request):
+        config = request['config']
+        options = request.get('options') or {}
+        unknown = sorted(set(options) - set(INSTALL_OPTIONS))
+        if unknown:
+            msg = "The options {} can not be given to the server.".format(', '.join(unknown))
+            logger.error(msg)
+            raise RuntimeError(msg)
+        paths = [request['destination'], request.get('work_directory')] + [options.get(name) for name in PATH_OPTIONS]
+        relative = sorted(path for path in paths if path and not os.path.isabs(path))
+        if relative:
+            msg = "The paths {} given to the server must be absolute.".format(', '.join(relative))
+            logger.error(msg)
+            raise RuntimeError(msg)
+
+        with self._urls_lock:
+            for url in api.iter_config_urls(config):
+                self.urls.setdefault(core.strip_credentials(url), url)
+        with self._requests:
+            result = api.install(
+                config, request['destination'], request.get('work_directory'),
+                mirrors=self.mirrors, history_file=self.history_file, **options)
+        return result.to_dict()
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """ Read the JSON lines of a client and answer each one. """
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line.decode())
+            except ValueError as error:
+                answer = {'error': 'Invalid request: {}'.format(error)}
+            else:
+                answer = self.server.handle_request_data(request)
+            self.wfile.write(json.dumps(answer).encode() + b'\n')
+            self.wfile.flush()
+
+
+def request(socket_path, data):
+    """ Send a request to the server and wait for its answer.
+
+    :param string socket_path: the path of the Unix socket of the server.
+    :param dict data: the request.
+    :return: the result of the request.
+    :raise: RuntimeError if the server can not be reached or if the request failed.
+    """
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.connect(socket_path)
+            with client.makefile('rwb') as stream:
+                stream.write(json.dumps(data).encode() + b'\n')
+                stream.flush()
+                line = stream.readline()
+    except OSError as error:
+        msg = "Could not reach the gitoo server at {}: {}".format(socket_path, error)
+        logger.error(msg)
+        raise RuntimeError(msg)
+
+    if not line:
+        msg = "The gitoo server at {} closed the connection.".format(socket_path)
+        logger.error(msg)
+        raise RuntimeError(msg)
+    answer = json.loads(line.decode())
+    if 'error' in answer:
+        msg = "The gitoo server could not serve the request: {}".format(answer['error'])
+        logger.error(msg)
+        raise RuntimeError(msg)
+    return answer['result']
+
+
+def install(socket_path, config, destination, work_directory=None, **options):
+    """ Install the add-ons of a config through the server.
+
+    :param string socket_path: the path of the Unix socket of the server.
+    :param list config: the entries of the conf file.
+    :param string destination: the folder where the add-ons should end up at.
+    :param string work_directory: Optional folder of the patch files.
+    :param options: the options of the installation (see INSTALL_OPTIONS).
+        The paths are relative to the working directory of the client.
+    :return: the result of the installation (see api.InstallResult.to_dict).
+    :rtype: dict
+    """
+    for name in PATH_OPTIONS:
+        if options.get(name):
+            options[name] = os.path.abspath(options[name])
+    return request(socket_path, {
+        'command': 'install',
+        'config': config,
+        'destination': os.path.abspath(destination),
+        'work_directory': os.path.abspath(work_directory) if work_directory else None,
+        'options': options,
+    })
+
+
+def _remove_stale_socket(socket_path):
+    """ Remove the socket file left by a server that stopped, refuse to replace a running server. """
+    if not os.path.exists(socket_path):
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+        try:
+            probe.connect(socket_path)
+        except OSError:
+            os.remove(socket_path)
+            return
+    msg = "A gitoo server is already running on {}".format(socket_path)
+    logger.error(msg)
+    raise RuntimeError(msg)
@@ -0,0 +1,211 @@
+import os
+import json
+import stat
+import errno
+import fcntl
+import hashlib
+import logging
+import tempfile
+import threading
+
+from . import metrics
+
+logger = logging.getLogger('gitoo-store')
+logger.setLevel(logging.INFO)
+
+HARDLINK = 'hardlink'
+REFLINK = 'reflink'
+LINK_MODES = (HARDLINK, REFLINK)
+
+# ioctl of linux/fs.h that clones the extents of a file (btrfs, xfs)
+_FICLONE = 0x40049409
+_CHUNK_SIZE = 1024 * 1024
+
+
+class FileStore(object):
+    """ A folder of files keyed by the hash of their content, shared by the destinations of gitoo.
+
+    The files of a staging folder are replaced by links to the files of the store,
+    so that a file contained in many destinations is written to the disk once.
+
+    With hard links, the files of the store are read-only, because they share their inode
+    with the files of the destinations. A file of the store that has no other link is not
+    referenced anymore.
+
+    With reflinks, the files of the destinations are independent copies that share the
+    blocks of the files of the store. The store keeps the list of the files used by each destination.
+    """
+
+    def __init__(self, path, link=HARDLINK):
+        """ Init
+
+        :param string path: the folder of the store.
+        :param string link: hardlink or reflink.
+        """
+        if link not in LINK_MODES:
+            raise RuntimeError("The link mode should be one of {}.".format(', '.join(LINK_MODES)))
+        self.path = os.path.abspath(path)
+        self.link = link
+        self.objects_path = os.path.join(self.path, 'objects')
+        self.roots_path = os.path.join(self.path, 'roots')
+        os.makedirs(self.objects_path, exist_ok=True)
+        os.makedirs(self.roots_path, exist_ok=True)
+        self._lock = threading.Lock()
+        self._reflink_supported = True
+        self._roots = {}
+
+    def blob_path(self, digest):
+        return os.path.join(self.objects_path, digest[:2], digest[2:])
+
+    def link_folder(self, folder, root=None):
+        """ Replace every file of the folder with a link to the file of the store with the same content.
+
+        If the folder is not on the file system of the store, the files are left untouched.
+
+        :param string folder: the folder, i.e. a staging folder.
+        :param string root: the destination where the folder will be installed (used with reflinks).
+        :return: the number of files linked.
+        :rtype: int
+        """
+        linked = 0
+        digests = set()
+        try:
+            for directory, _, file_names in os.walk(folder):
+                for file_name in file_names:
+                    file_path = os.path.join(directory, file_name)
+                    if os.path.islink(file_path) or not os.path.isfile(file_path):
+                        continue
+                    digests.add(self._link_file(file_path))
+                    linked += 1
+        except OSError as error:
+            if error.errno != errno.EXDEV:
+                raise
+            logger.warning(
+                "The store %s is not on the file system of %s, the files are not deduplicated.", self.path, folder)
+
+        if root and self.link == REFLINK:
+            with self._lock:
+                self._roots.setdefault(os.path.abspath(root), set()).update(digests)
+        metrics.count('store_files_linked', linked)
+        return linked
+
+    def _link_file(self, file_path):
+        file_stat = os.stat(file_path)
+        digest = file_digest(file_path, file_stat.st_mode)
+        blob_path = self.blob_path(digest)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        try:
+            os.link(file_path, blob_path)
+            os.chmod(blob_path, stat.S_IMODE(file_stat.st_mode) & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+        except FileExistsError:
+            metrics.count('store_bytes_deduplicated', file_stat.st_size)
+
+        if self.link == REFLINK and self._reflink_supported:
+            if self._replace_with_reflink(blob_path, file_path, file_stat):
+                return digest
+        if not os.path.samefile(blob_path, file_path):
+            _replace(file_path, lambda tmp_path: os.link(blob_path, tmp_path))
+        return digest
+
+    def _replace_with_reflink(self, blob_path, file_path, file_stat):
+        def reflink(tmp_path):
+            with open(blob_path, 'rb') as blob, open(tmp_path, 'wb') as target:
+                fcntl.ioctl(target.fileno(), _FICLONE, blob.fileno())
+            os.chmod(tmp_path, stat.S_IMODE(file_stat.st_mode))
+
+        try:
+            _replace(file_path, reflink)
+            return True
+        except OSError as error:
+            if error.errno not in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EXDEV):
+                raise
+            logger.warning("Reflinks are not supported by the file system of %s, hard links are used.", self.path)
+            self._reflink_supported = False
+            return False
+
+    def save_roots(self):
+        """ Record the files of the store used by each destination, for the files linked with reflinks. """
+        with self._lock:
+            roots = dict(self._roots)
+            self._roots = {}
+        for destination, digests in roots.items():
+            path = os.path.join(self.roots_path, hashlib.sha1(destination.encode()).hexdigest() + '.json')
+            if os.path.exists(path):
+                with open(path, 'r') as root_file:
+                    digests = digests | set(json.load(root_file)['digests'])
+            _write_json(path, {'destination': destination, 'digests': sorted(digests)})
+
+    def gc(self):
+        """ Delete the files of the store that are not used by any destination.
+
+        A file is used if it has another hard link, or if it is listed for a destination
+        that still exists (reflinks). The lists of the destinations that do not exist anymore are deleted.
+
+        :return: the number of files deleted and their size in bytes.
+        :rtype: Tuple[int, int]
+        """
+        referenced = self._referenced_digests()
+        removed = 0
+        freed = 0
+        for directory, _, file_names in os.walk(self.objects_path):
+            for file_name in file_names:
+                path = os.path.join(directory, file_name)
+                digest = os.path.basename(directory) + file_name
+                file_stat = os.lstat(path)
+                if file_stat.st_nlink == 1 and digest not in referenced:
+                    os.remove(path)
+                    removed += 1
+                    freed += file_stat.st_size
+
+        logger.info("File store: %s file(s) removed, %s byte(s) freed", removed, freed)
+        return removed, freed
+
+    def _referenced_digests(self):
+        referenced = set()
+        for file_name in os.listdir(self.roots_path):
+            path = os.path.join(self.roots_path, file_name)
+            with open(path, 'r') as root_file:
+                root = json.load(root_file)
+            if os.path.isdir(root['destination']):
+                referenced.update(root['digests'])
+            else:
+                os.remove(path)
+        return referenced
+
+
+def file_digest(path, mode):
+    """ Hash the content of a file, along with its executable bit.
+
+    :param string path: the path of the file.
+    :param int mode: the mode of the file.
+    :rtype: string
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as hashed_file:
+        for chunk in iter(lambda: hashed_file.read(_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    executable = 'x' if mode & stat.S_IXUSR else ''
+    return digest.hexdigest() + executable
+
+
+def _replace(path, write):
+    """ Replace a file atomically with a file written by the given function. """
+    directory, file_name = os.path.split(path)
+    tmp_path = os.path.join(directory, '.{}.gitoo-store'.format(file_name))
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _write_json(path, data):
+    file_descriptor, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(file_descriptor, 'w') as tmp_file:
+            json.dump(data, tmp_file)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
@@ -0,0 +1,133 @@
+import os
+import re
+import logging
+
+from . import metrics
+
+logger = logging.getLogger('gitoo-strip')
+logger.setLevel(logging.INFO)
+
+# The files removed by each profile, relative to the folder of a module.
+# A rule starting with ! keeps the files it matches.
+PROFILES = {
+    'tests': ('tests/**',),
+    'descriptions': ('static/description/**', '!static/description/icon.*'),
+    'pot': ('i18n/*.pot', 'i18n_extra/*.pot'),
+    'readme': ('README.rst', 'README.md', 'readme/**'),
+    'scss': ('static/src/**/*.scss',),
+    'pyc': ('*.pyc', '**/__pycache__/**'),
+}
+
+
+class StripRules(object):
+    """ The rules that select the files removed from the modules of an add-on.
+
+    A rule is either the name of a profile or a glob relative to the folder of a module.
+    In a glob, * and ? do not match a /, ** matches any number of folders and a glob
+    without / matches the files with that name in any folder of the module.
+    A glob starting with ! keeps the files it matches, even if they are selected by another rule.
+    """
+
+    def __init__(self, rules=()):
+        """ Init
+
+        :param list rules: the names of profiles and the globs.
+        """
+        self.rules = sorted(set(rules))
+        globs = []
+        for rule in self.rules:
+            globs.extend(PROFILES.get(rule, (rule,)))
+        self._removed = _compile([glob for glob in globs if not glob.startswith('!')])
+        self._kept = _compile([glob[1:] for glob in globs if glob.startswith('!')])
+
+    def __bool__(self):
+        return bool(self.rules)
+
+    def signature(self):
+        """ Describe the rules for the result cache.
+
+        :rtype: list
+        """
+        return self.rules
+
+    def matches(self, path):
+        """ Evaluate if a file of a module must be removed.
+
+        :param string path: the path of the file, relative to the folder of the module.
+            The path of a folder ends with a /.
+        :rtype: bool
+        """
+        return bool(self._removed and self._removed.match(path) and not (self._kept and self._kept.match(path)))
+
+    def strip_module(self, module_path):
+        """ Remove the files selected by the rules from the folder of a module.
+
+        The folders left empty are removed as well.
+
+        :param string module_path: the folder of the module.
+        :return: the number of files removed and their size in bytes.
+        :rtype: Tuple[int, int]
+        """
+        files = 0
+        size = 0
+        for directory, _, file_names in os.walk(module_path, topdown=False):
+            relative_directory = os.path.relpath(directory, module_path)
+            prefix = '' if relative_directory == '.' else relative_directory + '/'
+            for file_name in file_names:
+                if self.matches(prefix + file_name):
+                    file_path = os.path.join(directory, file_name)
+                    size += os.lstat(file_path).st_size
+                    os.remove(file_path)
+                    files += 1
+            if prefix and self.matches(prefix) and not os.listdir(directory):
+                os.rmdir(directory)
+
+        metrics.count('files_stripped', files)
+        metrics.count('bytes_stripped', size)
+        return files, size
+
+
+def parse_rules(value):
+    """ Parse the rules given on the command line (i.e. tests,descriptions,pot) or in the conf file.
+
+    :param value: the rules separated by commas, or a list of rules.
+    :rtype: list
+    :raise: RuntimeError if a rule is not a profile nor a glob.
+    """
+    if isinstance(value, str):
+        value = value.split(',')
+    rules = [rule.strip() for rule in value or [] if rule.strip()]
+    for rule in rules:
+        if rule not in PROFILES and not any(char in rule for char in '*?/.!'):
+            msg = "Unknown strip profile {}. The profiles are {}.".format(rule, ', '.join(sorted(PROFILES)))
+            logger.error(msg)
+            raise RuntimeError(msg)
+    return rules
+
+
+def _compile(globs):
+    if not globs:
+        return None
+    return re.compile('|'.join('(?:{})'.format(_glob_to_regex(glob)) for glob in globs))
+
+
+def _glob_to_regex(glob):
+    if '/' not in glob.rstrip('/'):
+        glob = '**/' + glob
+    parts = glob.split('/')
+    regex = ''
+    for index, part in enumerate(parts):
+        is_last = index == len(parts) - 1
+        if part == '**':
+            regex += '.*' if is_last else '(?:.*/)?'
+            continue
+        for char in part:
+            if char == '*':
+                regex += '[^/]*'
+            elif char == '?':
+                regex += '[^/]'
+            else:
+                regex += re.escape(char)
+        if not is_last:
+            regex += '/'
+    return regex + r'\Z'
@@ -0,0 +1,223 @@
+import os
+import json
+import uuid
+import shutil
+import logging
+import tempfile
+import functools
+
+from . import core
+
+logger = logging.getLogger('gitoo-sync')
+logger.setLevel(logging.INFO)
+
+STATE_FILE = '.gitoo-state.json'
+STATE_VERSION = 1
+
+
+class SyncState(object):
+    """ The add-ons installed inside a destination folder, kept in a state file inside the folder.
+
+    For each add-on, the state contains the key of its inputs, its resolved commit
+    and the folders it installed. It also records the add-on that installed each folder last,
+    so that a folder overwritten by another add-on is not considered installed anymore.
+    """
+
+    def __init__(self, path):
+        """ Init
+
+        :param string path: the path of the state file.
+        """
+        self.path = path
+        self.entries = {}
+        self.owners = {}
+        if os.path.exists(path):
+            with open(path, 'r') as state_file:
+                data = json.load(state_file)
+            if data.get('version') == STATE_VERSION:
+                self.entries = data['entries']
+                self.owners = data['owners']
+            else:
+                logger.warning("The state file %s has an unknown version, it is ignored.", path)
+
+    def is_installed(self, key, destination, shadowed=()):
+        """ Evaluate if the add-on with the given key is installed and none of its folders was replaced.
+
+        :param string key: the key of the inputs of the add-on.
+        :param string destination: the folder where the add-ons are installed.
+        :param set shadowed: the folders installed by the next add-ons, which may be replaced.
+        :rtype: bool
+        """
+        entry = self.entries.get(key)
+        return entry is not None and all(
+            name in shadowed or (
+                self.owners.get(name) == key and os.path.exists(os.path.join(destination, name)))
+            for name in entry['modules']
+        )
+
+    def modules(self, key):
+        """ The folders installed by the add-on with the given key, if it is known. """
+        entry = self.entries.get(key)
+        return entry['modules'] if entry else []
+
+    def record(self, key, addon, names):
+        """ Record that an add-on was installed, then save the state.
+
+        :param string key: the key of the inputs of the add-on.
+        :param Addon addon: the add-on.
+        :param list names: the folders installed by the add-on.
+        """
+        self.entries[key] = {
+            'url': core.strip_credentials(addon.repo),
+            'branch': addon.branch,
+            'commit': addon.commit,
+            'modules': sorted(names),
+        }
+        for name in names:
+            self.owners[name] = key
+        self.save()
+
+    def remove_stale(self, destination, keys):
+        """ Delete the folders installed by add-ons that are not part of the given keys anymore.
+
+        A folder is kept when one of the given add-ons installed it last.
+
+        :param string destination: the folder where the add-ons are installed.
+        :param list keys: the keys of the installed add-ons.
+        :return: the names of the deleted folders.
+        :rtype: list
+        """
+        keys = set(keys)
+        removed = []
+        for name, owner in sorted(self.owners.items()):
+            if owner in keys:
+                continue
+            path = os.path.join(destination, name)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            elif os.path.lexists(path):
+                os.remove(path)
+            del self.owners[name]
+            removed.append(name)
+
+        self.entries = {key: entry for key, entry in self.entries.items() if key in keys}
+        self.save()
+        return removed
+
+    def save(self):
+        """ Write the state file atomically, so that an interrupted run leaves a valid state. """
+        data = {'version': STATE_VERSION, 'entries': self.entries, 'owners': self.owners}
+        file_descriptor, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(self.path), prefix='.gitoo-state-', suffix='.tmp')
+        try:
+            with os.fdopen(file_descriptor, 'w') as tmp_file:
+                json.dump(data, tmp_file, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+def addon_key(addon):
+    """ Compute the key of the inputs of an add-on.
+
+    An add-on that is not pinned to commit shas gets a new key every time,
+    so that it is always installed.
+
+    :param Addon addon: the add-on.
+    :rtype: string
+    """
+    signature = addon.signature()
+    if signature is None:
+        return 'unpinned-{}'.format(uuid.uuid4().hex)
+    return core.signature_key(signature)
+
+
+def sync_addons(addons, destination, jobs=1, order=None):
+    """ Install the add-ons whose inputs changed since the last sync of the destination folder.
+
+    The add-ons are processed in order. An add-on is skipped when the state file shows that it was
+    installed with the same inputs and that none of its folders was replaced since. Once every add-on
+    is installed, the folders installed by add-ons that are not part of the given add-ons anymore,
+    and not installed again by one of them, are deleted.
+
+    The state file is saved after each add-on, so that a failed sync resumes where it stopped
+    and leaves the folders of the previous sync in place.
+
+    :param list addons: the Addon objects to install, pinned to commit shas.
+    :param string destination: the folder where the add-ons should end up at.
+    :param int jobs: the number of add-ons to prepare at the same time.
+    :param list order: Optional order in which the add-ons start to be prepared (see core.prepare_addons).
+    :return: the number of add-ons installed and skipped.
+    :rtype: Tuple[int, int]
+    """
+    if not os.path.isdir(destination):
+        msg = "The destination folder {} does not exist".format(destination)
+        logger.error(msg)
+        raise RuntimeError(msg)
+
+    core.remove_stale_temp_folders(destination)
+    state = SyncState(os.path.join(destination, STATE_FILE))
+    keys = [addon_key(addon) for addon in addons]
+
+    if any(addon.include_dependencies for addon in addons):
+        logger.info("Sync: includes_with_depends is used, every entry is installed")
+        for key, addon, names in zip(keys, addons, core.install_addons(addons, destination, jobs=jobs, order=order)):
+            state.record(key, addon, names)
+        _remove_stale(state, destination, keys)
+        return len(addons), 0
+
+    shadowed = _shadowed_modules(state, keys)
+    to_prepare = [
+        addon for addon, key, names in zip(addons, keys, shadowed)
+        if not state.is_installed(key, destination, names)
+    ]
+    installed = 0
+    try:
+        with core.prepare_addons(to_prepare, jobs, work_dir=destination, order=order) as wait_prepared:
+            for addon, key, names in zip(addons, keys, shadowed):
+                if state.is_installed(key, destination, names):
+                    logger.info("Sync: %s@%s is up to date", addon.repo, addon.commit)
+                    continue
+
+                prepared = wait_prepared(addon) if addon in to_prepare else addon.prepare(destination)
+                with prepared as staging:
+                    installed_names = core.install_prepared(
+                        addon, staging, functools.partial(core.install_staged, destination=destination))
+                state.record(key, addon, installed_names)
+                installed += 1
+    finally:
+        core.wait_background_deletions()
+    _remove_stale(state, destination, keys)
+
+    skipped = len(addons) - installed
+    logger.info("Sync: %s entr(ies) installed, %s up to date", installed, skipped)
+    return installed, skipped
+
+
+def _remove_stale(state, destination, keys):
+    """ Delete the folders not provided anymore, once every add-on is installed.
+
+    :param SyncState state: the state of the destination folder.
+    :param string destination: the folder where the add-ons are installed.
+    :param list keys: the keys of the installed add-ons.
+    """
+    removed = state.remove_stale(destination, keys)
+    if removed:
+        logger.info("Sync: %s folder(s) not provided anymore removed: %s", len(removed), ', '.join(removed))
+
+
+def _shadowed_modules(state, keys):
+    """ For each add-on, compute the folders known to be installed by the next add-ons.
+
+    :param SyncState state: the state of the destination folder.
+    :param list keys: the keys of the add-ons, in order.
+    :return: the set of folders for each add-on
+    :rtype: list
+    """
+    shadowed = []
+    names = set()
+    for key in reversed(keys):
+        shadowed.append(frozenset(names))
+        names.update(state.modules(key))
+    return list(reversed(shadowed))
@@ -0,0 +1,133 @@
+import os
+import random
+
+from ..common import commit_all, git, write_module
+
+LANGUAGES = (
+    'ar', 'de', 'es', 'es_MX', 'fr', 'fr_CA', 'it', 'ja', 'nl', 'pl',
+    'pt', 'pt_BR', 'ru', 'sv', 'th', 'tr', 'uk', 'vi', 'zh_CN', 'zh_TW',
+)
+
+
+class SyntheticRepo(object):
+    """A bare repository generated by make_repo."""
+
+    def __init__(self, url, branch, commit, modules, patch_branches):
+        """ Init
+
+        :param string url: the path of the bare repository.
+        :param string branch: the main branch.
+        :param string commit: the sha of the tip of the main branch.
+        :param list modules: the names of the modules.
+        :param dict patch_branches: the sha of the tip of each patch branch.
+        """
+        self.url = url
+        self.branch = branch
+        self.commit = commit
+        self.modules = modules
+        self.patch_branches = patch_branches
+
+    def entry(self, **kwargs):
+        """Build the entry of the repository in a gitoo config file."""
+        entry = {'url': self.url, 'branch': self.branch}
+        entry.update(kwargs)
+        return entry
+
+
+def make_repo(
+    folder, name, modules=10, languages=3, history=1, file_size=1024, patch_branches=0, base=False,
+    branch='12.0', seed=0,
+):
+    """ Generate a bare repository that contains Odoo modules.
+
+    :param string folder: the folder where the repository is generated.
+    :param string name: the name of the repository.
+    :param int modules: the number of modules.
+    :param int languages: the number of .po files per module.
+    :param int history: the number of commits of the main branch.
+    :param int file_size: the size of the python file of each module, in bytes.
+    :param int patch_branches: the number of branches that add a module, to be merged as patches.
+    :param bool base: generate a repository shaped like the source code of Odoo,
+                      with modules in addons and odoo/addons.
+    :param string branch: the main branch.
+    :param int seed: the seed of the generated content.
+    :rtype: SyntheticRepo
+    """
+    randomizer = random.Random(seed)
+    work_tree = os.path.join(folder, name + '-work')
+    os.makedirs(work_tree)
+    git(work_tree, 'init', '-q')
+    git(work_tree, 'symbolic-ref', 'HEAD', 'refs/heads/{}'.format(branch))
+
+    module_names = ['{}_module_{}'.format(name, index) for index in range(modules)]
+    for index, module in enumerate(module_names):
+        parent = work_tree
+        if base:
+            parent = os.path.join(work_tree, 'odoo', 'addons') if index % 2 else os.path.join(work_tree, 'addons')
+        write_module(parent, module, languages=LANGUAGES[:languages])
+        _write_file(os.path.join(parent, module, 'models.py'), file_size, randomizer)
+
+    if base:
+        for path in ('odoo/__init__.py', 'odoo/addons/__init__.py', 'odoo/release.py'):
+            _write_file(os.path.join(work_tree, path), 128, randomizer)
+        for index in range(10):
+            _write_file(os.path.join(work_tree, 'odoo', 'tools', 'tool_{}.py'.format(index)), file_size, randomizer)
+
+    with open(os.path.join(work_tree, 'README.md'), 'w') as readme:
+        readme.write('# {}\n'.format(name))
+    commit = commit_all(work_tree, 'initial commit')
+
+    history_file = os.path.join(work_tree, 'HISTORY.txt')
+    for index in range(1, history):
+        with open(history_file, 'a') as history_data:
+            history_data.write('change {}\n'.format(index))
+        commit = commit_all(work_tree, 'change {}'.format(index))
+
+    patches = {}
+    for index in range(patch_branches):
+        patch_branch = '{}-patch-{}'.format(branch, index)
+        git(work_tree, 'checkout', '-q', '-b', patch_branch, commit)
+        write_module(work_tree, '{}_patch_{}'.format(name, index), languages=LANGUAGES[:languages])
+        patches[patch_branch] = commit_all(work_tree, 'patch {}'.format(index))
+    git(work_tree, 'checkout', '-q', branch)
+
+    url = os.path.join(folder, name + '.git')
+    git(folder, 'clone', '-q', '--bare', work_tree, url)
+    return SyntheticRepo(url, branch, commit, module_names, patches)
+
+
+def write_patch_files(folder, repo, count):
+    """ Write patch files that each add a file to a module of the repository.
+
+    :param string folder: the folder where the patch files are written.
+    :param SyntheticRepo repo: the patched repository.
+    :param int count: the number of patch files.
+    :return: the names of the patch files, relative to the folder.
+    :rtype: list
+    """
+    names = []
+    for index in range(count):
+        module = repo.modules[index % len(repo.modules)]
+        name = 'patch_{}.patch'.format(index)
+        path = '{}/patch_{}.txt'.format(module, index)
+        with open(os.path.join(folder, name), 'w') as patch_file:
+            patch_file.write(
+                "diff --git a/{path} b/{path}\n"
+                "new file mode 100644\n"
+                "--- /dev/null\n"
+                "+++ b/{path}\n"
+                "@@ -0,0 +1 @@\n"
+                "+patch {index}\n".format(path=path, index=index))
+        names.append(name)
+    return names
+
+
+def _write_file(path, size, randomizer):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    line = '# {}\n'
+    with open(path, 'w') as generated_file:
+        written = 0
+        while written < size:
+            content = line.format(randomizer.getrandbits(128))
+            generated_file.write(content)
+            written += len(content)
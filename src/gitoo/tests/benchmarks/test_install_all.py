@@ -0,0 +1,92 @@
+import os
+import tempfile
+
+import pytest
+import yaml
+
+from ... import cli
+from .synthetic import make_repo, write_patch_files
+
+pytest.importorskip('pytest_benchmark')
+
+ROUNDS = int(os.environ.get('GITOO_BENCHMARK_ROUNDS', 3))
+
+
+@pytest.fixture(scope='module')
+def workspace(tmp_path_factory):
+    return str(tmp_path_factory.mktemp('gitoo-benchmarks'))
+
+
+@pytest.fixture(scope='module')
+def repos(workspace):
+    """The synthetic repositories shared by the scenarios."""
+    return {
+        'large': make_repo(workspace, 'large', modules=40, languages=3, history=50, file_size=16384),
+        'base': make_repo(workspace, 'base', modules=60, languages=3, base=True),
+        'translated': make_repo(workspace, 'translated', modules=20, languages=20),
+        'patched': make_repo(workspace, 'patched', modules=10, patch_branches=10),
+        'small': [make_repo(workspace, 'small_{}'.format(index), modules=5, seed=index) for index in range(20)],
+    }
+
+
+def _write_conf(workspace, name, entries):
+    conf_file = os.path.join(workspace, name + '.yml')
+    with open(conf_file, 'w') as conf_data:
+        yaml.safe_dump(entries, conf_data)
+    return conf_file
+
+
+def _run(benchmark, workspace, conf_file, **kwargs):
+    """Install the conf file inside a new destination at each round."""
+    def setup():
+        destination = tempfile.mkdtemp(dir=workspace, prefix='destination-')
+        return (), dict(kwargs, destination=destination, conf_file=conf_file)
+
+    benchmark.pedantic(cli._install_all, setup=setup, rounds=ROUNDS, iterations=1)
+
+
+def test_cold_install(benchmark, workspace, repos):
+    conf_file = _write_conf(workspace, 'cold', [repos['large'].entry(), repos['base'].entry(base=True)])
+    _run(benchmark, workspace, conf_file)
+
+
+def test_warm_install(benchmark, workspace, repos):
+    entries = [
+        repos['large'].entry(commit=repos['large'].commit),
+        repos['base'].entry(commit=repos['base'].commit, base=True),
+    ]
+    conf_file = _write_conf(workspace, 'warm', entries)
+    options = {
+        'cache_dir': os.path.join(workspace, 'mirrors'),
+        'result_cache': os.path.join(workspace, 'results'),
+    }
+    cli._install_all(destination=tempfile.mkdtemp(dir=workspace), conf_file=conf_file, **options)
+    _run(benchmark, workspace, conf_file, **options)
+
+
+def test_many_entries(benchmark, workspace, repos):
+    conf_file = _write_conf(workspace, 'many', [repo.entry() for repo in repos['small']])
+    _run(benchmark, workspace, conf_file, jobs=4)
+
+
+def test_language_pruning(benchmark, workspace, repos):
+    conf_file = _write_conf(workspace, 'lang', [repos['translated'].entry()])
+    _run(benchmark, workspace, conf_file, lang='fr,fr_CA')
+
+
+def test_many_patches(benchmark, workspace, repos):
+    repo = repos['patched']
+    patches = [
+        {'url': repo.url, 'branch': branch, 'commit': commit}
+        for branch, commit in sorted(repo.patch_branches.items())
+    ]
+    patches.extend({'file': name} for name in write_patch_files(workspace, repo, 10))
+    conf_file = _write_conf(workspace, 'patches', [repo.entry(patches=patches)])
+    _run(benchmark, workspace, conf_file)
+
+
+def test_sparse_base_install(benchmark, workspace, repos):
+    repo = repos['base']
+    includes = repo.modules[:4]
+    conf_file = _write_conf(workspace, 'sparse', [repo.entry(base=True, includes=includes)])
+    _run(benchmark, workspace, conf_file, sparse=True)
@@ -0,0 +1,47 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+import yaml
+
+from ... import cli
+from .synthetic import make_repo
+
+pytest.importorskip('pytest_benchmark')
+
+SRC = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+
+def _python(code):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([SRC, os.environ.get('PYTHONPATH', '')]))
+    subprocess.check_call([sys.executable, '-c', code], env=env)
+
+
+def test_import_cli(benchmark):
+    benchmark(_python, 'import gitoo.cli')
+
+
+def test_help(benchmark):
+    benchmark(_python, 'import sys; from gitoo.cli import entry_point; sys.argv = ["gitoo", "--help"]; entry_point()')
+
+
+def test_git_processes_per_entry(benchmark, tmp_path):
+    """Install a single entry and report the number of git processes it spawned."""
+    workspace = str(tmp_path)
+    repo = make_repo(workspace, 'processes', modules=5)
+    conf_file = os.path.join(workspace, 'conf.yml')
+    with open(conf_file, 'w') as conf_data:
+        yaml.safe_dump([repo.entry()], conf_data)
+    metrics_file = os.path.join(workspace, 'metrics.json')
+
+    def install():
+        destination = os.path.join(workspace, 'destination-{}'.format(len(os.listdir(workspace))))
+        os.makedirs(destination)
+        cli._install_all(destination=destination, conf_file=conf_file, metrics_file=metrics_file)
+
+    benchmark.pedantic(install, rounds=1, iterations=1)
+    with open(metrics_file) as metrics_data:
+        report = json.load(metrics_data)
+    benchmark.extra_info['git_processes'] = report['entries'][0]['counters']['git_processes']
@@ -0,0 +1,84 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+import yaml
+
+
+GIT_ENV = dict(
+    os.environ,
+    GIT_AUTHOR_NAME='gitoo',
+    GIT_AUTHOR_EMAIL='root@localhost',
+    GIT_COMMITTER_NAME='gitoo',
+    GIT_COMMITTER_EMAIL='root@localhost',
+)
+
+
+def git(folder, *args):
+    """Run a git command inside the given folder and return its output."""
+    return subprocess.check_output(('git',) + args, cwd=folder, env=GIT_ENV).decode().strip()
+
+
+def write_module(folder, name, languages=('fr', 'es'), depends=('base',)):
+    """Write a minimal Odoo module inside the given folder."""
+    module = os.path.join(folder, name)
+    os.makedirs(os.path.join(module, 'i18n'), exist_ok=True)
+    with open(os.path.join(module, '__manifest__.py'), 'w') as f:
+        f.write(repr({'name': name, 'version': '1.0.0', 'depends': list(depends)}))
+    with open(os.path.join(module, '__init__.py'), 'w') as f:
+        f.write('')
+    for lang in languages:
+        with open(os.path.join(module, 'i18n', '{}.po'.format(lang)), 'w') as f:
+            f.write('# {} translation of {}\n'.format(lang, name))
+
+
+def make_repo(folder, modules, branch='12.0'):
+    """Create a git repository that contains the given modules.
+
+    :return: the sha of the commit.
+    """
+    os.makedirs(folder, exist_ok=True)
+    git(folder, 'init', '-q')
+    git(folder, 'symbolic-ref', 'HEAD', 'refs/heads/{}'.format(branch))
+    for module in modules:
+        write_module(folder, module)
+    with open(os.path.join(folder, 'README.md'), 'w') as f:
+        f.write('# {}\n'.format(os.path.basename(folder)))
+    return commit_all(folder, 'initial commit')
+
+
+def commit_all(folder, message):
+    """Commit every change of the repository.
+
+    :return: the sha of the commit.
+    """
+    git(folder, 'add', '-A')
+    git(folder, 'commit', '-q', '-m', message)
+    return git(folder, 'rev-parse', 'HEAD')
+
+
+class LocalReposMixin(unittest.TestCase):
+    """Create the git repositories used by a test inside a temporary folder."""
+
+    def setUp(self):
+        super(LocalReposMixin, self).setUp()
+        self.root = tempfile.mkdtemp()
+        self.destination = os.path.join(self.root, 'destination')
+        os.makedirs(self.destination)
+        self.conf_file = os.path.join(self.root, 'gitoo.yml')
+
+    def tearDown(self):
+        super(LocalReposMixin, self).tearDown()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def make_repo(self, name, modules, branch='12.0'):
+        """Create a repository and return its url and the sha of its commit."""
+        folder = os.path.join(self.root, 'repos', name)
+        commit = make_repo(folder, modules, branch=branch)
+        return folder, commit
+
+    def write_conf(self, data):
+        with open(self.conf_file, 'w') as f:
+            yaml.dump(data, f)
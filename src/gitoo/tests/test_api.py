@@ -0,0 +1,70 @@
+import copy
+import json
+import os
+
+import gitoo
+from .common import LocalReposMixin, commit_all, git, write_module
+
+
+class TestInstall(LocalReposMixin):
+
+    def setUp(self):
+        super(TestInstall, self).setUp()
+        self.hr, self.hr_commit = self.make_repo('hr', ['hr_experience', 'hr_skill'])
+        self.fork = os.path.join(self.root, 'repos', 'hr-fork')
+        git(self.root, 'clone', '-q', self.hr, self.fork)
+        git(self.fork, 'checkout', '-q', '-b', '12.0-fix', self.hr_commit)
+        write_module(self.fork, 'hr_fix')
+        self.fix_commit = commit_all(self.fork, 'fix')
+        self.website, self.website_commit = self.make_repo('website', ['website_multi_theme'])
+        self.config = [
+            {'url': self.hr, 'branch': '12.0', 'patches': [{'url': self.fork, 'branch': '12.0-fix'}]},
+            {'url': self.website, 'branch': '12.0', 'commit': self.website_commit},
+        ]
+
+    def test_structured_result(self):
+        result = gitoo.install(self.config, self.destination, lang='fr', jobs=2)
+
+        hr, website = result.entries
+        self.assertEqual(hr.url, self.hr)
+        self.assertEqual(hr.commit, self.hr_commit)
+        self.assertEqual(hr.patches, [{'url': self.fork, 'branch': '12.0-fix', 'commit': self.fix_commit}])
+        self.assertEqual(sorted(hr.folders), ['hr_experience', 'hr_fix', 'hr_skill'])
+        self.assertIn({
+            'name': 'hr_fix', 'path': os.path.join(self.destination, 'hr_fix'),
+            'version': '1.0.0', 'depends': ['base'], 'installable': True,
+        }, hr.modules)
+        self.assertIn('clone', hr.phases)
+        self.assertGreater(hr.seconds, 0)
+        self.assertFalse(hr.result_cache_hit)
+        self.assertEqual(website.commit, self.website_commit)
+        self.assertEqual(website.patches, [])
+        self.assertEqual(set(result.modules), {'hr_experience', 'hr_skill', 'hr_fix', 'website_multi_theme'})
+        self.assertEqual(json.loads(json.dumps(result.to_dict()))['entries'][1]['commit'], self.website_commit)
+
+    def test_many_calls_from_the_same_process(self):
+        config = copy.deepcopy(self.config)
+        results = gitoo.install_many([(self.config, self.destination, None)])
+        other_destination = os.path.join(self.root, 'other')
+        os.makedirs(other_destination)
+        results.append(gitoo.install(self.config, other_destination))
+
+        self.assertEqual(self.config, config)
+        self.assertEqual(
+            [entry.commit for entry in results[0].entries], [entry.commit for entry in results[1].entries])
+        self.assertEqual(sorted(os.listdir(other_destination)), sorted(os.listdir(self.destination)))
+
+    def test_cache_hits(self):
+        options = {
+            'cache_dir': os.path.join(self.root, 'mirrors'),
+            'result_cache': os.path.join(self.root, 'results'),
+        }
+        config = [{'url': self.website, 'branch': '12.0', 'commit': self.website_commit}]
+        first = gitoo.install(config, self.destination, **options).entries[0]
+        second = gitoo.install(config, self.destination, **options).entries[0]
+
+        self.assertFalse(first.result_cache_hit)
+        self.assertEqual(first.mirror_hits, 0)
+        self.assertTrue(second.result_cache_hit)
+        self.assertEqual(second.commit, self.website_commit)
+        self.assertEqual(second.modules[0]['name'], 'website_multi_theme')
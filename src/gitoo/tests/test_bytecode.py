@@ -0,0 +1,112 @@
+import importlib.util
+import os
+
+import gitoo
+from .. import bytecode, core
+from .common import LocalReposMixin, commit_all
+
+
+def compiled_path(path, optimize=0):
+    return importlib.util.cache_from_source(path, optimization=optimize or '')
+
+
+class TestCompiler(LocalReposMixin):
+
+    def _write(self, path, content='VALUE = 1\n'):
+        path = os.path.join(self.root, 'folder', path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def test_syntax_errors_are_counted(self):
+        good = self._write('good.py')
+        bad = self._write('bad.py', 'def broken(:\n')
+        with bytecode.Compiler(jobs=1) as compiler:
+            self.assertEqual(compiler.compile_folder(os.path.join(self.root, 'folder')), 1)
+        self.assertTrue(os.path.exists(compiled_path(good)))
+        self.assertFalse(os.path.exists(compiled_path(bad)))
+        self.assertEqual((compiler.files, compiler.errors), (1, 1))
+
+    def test_pool_of_processes(self):
+        paths = [self._write('package_{}/module_{}.py'.format(index % 3, index)) for index in range(450)]
+        with bytecode.Compiler(jobs=2) as compiler:
+            self.assertEqual(compiler.compile_folder(os.path.join(self.root, 'folder')), 450)
+        self.assertTrue(all(os.path.exists(compiled_path(path)) for path in paths))
+
+    def test_invalid_options(self):
+        with self.assertRaises(RuntimeError):
+            bytecode.Compiler(invalidation='never')
+        with self.assertRaises(RuntimeError):
+            bytecode.Compiler(optimize=3)
+
+
+class TestCompileModules(LocalReposMixin):
+
+    def setUp(self):
+        super(TestCompileModules, self).setUp()
+        self.hr, _ = self.make_repo('hr', ['hr_experience'])
+        module = os.path.join(self.hr, 'hr_experience')
+        for path in ('models/hr.py', 'tests/test_hr.py', 'static/lib/build.py'):
+            os.makedirs(os.path.join(module, os.path.dirname(path)), exist_ok=True)
+            with open(os.path.join(module, path), 'w') as f:
+                f.write('"""{}"""\nVALUE = 1\n'.format(path))
+        self.commit = commit_all(self.hr, 'python files')
+        self.config = [{'url': self.hr, 'branch': '12.0'}]
+        self.module = os.path.join(self.destination, 'hr_experience')
+
+    def test_modules_are_compiled(self):
+        gitoo.install(self.config, self.destination, byte_compile=True)
+
+        self.assertTrue(os.path.exists(compiled_path(os.path.join(self.module, 'models', 'hr.py'))))
+        self.assertTrue(os.path.exists(compiled_path(os.path.join(self.module, '__init__.py'))))
+        self.assertFalse(os.path.exists(compiled_path(os.path.join(self.module, '__manifest__.py'))))
+        self.assertFalse(os.path.exists(compiled_path(os.path.join(self.module, 'static', 'lib', 'build.py'))))
+
+    def test_not_compiled_by_default(self):
+        gitoo.install(self.config, self.destination)
+        self.assertFalse(os.path.exists(os.path.join(self.module, 'models', '__pycache__')))
+
+    def test_stripped_files_are_not_compiled(self):
+        gitoo.install(self.config, self.destination, byte_compile=True, strip='tests')
+        self.assertFalse(os.path.exists(os.path.join(self.module, 'tests')))
+        self.assertTrue(os.path.exists(compiled_path(os.path.join(self.module, 'models', 'hr.py'))))
+
+    def test_compiled_files_are_reproducible(self):
+        other_destination = os.path.join(self.root, 'other')
+        os.makedirs(other_destination)
+        gitoo.install(self.config, self.destination, byte_compile=True)
+        gitoo.install(self.config, other_destination, byte_compile=True)
+
+        path = compiled_path(os.path.join('hr_experience', 'models', 'hr.py'))
+        with open(os.path.join(self.destination, path), 'rb') as f:
+            first = f.read()
+        with open(os.path.join(other_destination, path), 'rb') as f:
+            second = f.read()
+        self.assertEqual(first, second)
+        # The flags of a pyc checked against the hash of its source
+        self.assertEqual(int.from_bytes(first[4:8], 'little'), 0b11)
+
+    def test_optimization_level(self):
+        gitoo.install(self.config, self.destination, byte_compile=True, compile_optimize=2)
+        self.assertTrue(os.path.exists(compiled_path(os.path.join(self.module, 'models', 'hr.py'), 2)))
+
+    def test_compile_options_are_part_of_the_signature(self):
+        addon = core.Addon(self.hr, '12.0', self.commit)
+        compiled = core.Addon(self.hr, '12.0', self.commit, compiler=bytecode.Compiler())
+        optimized = core.Addon(self.hr, '12.0', self.commit, compiler=bytecode.Compiler(optimize=1))
+        self.assertEqual(len({
+            str(addon.signature()), str(compiled.signature()), str(optimized.signature()),
+        }), 3)
+
+    def test_result_cache_keeps_the_compiled_files(self):
+        config = [{'url': self.hr, 'branch': '12.0', 'commit': self.commit}]
+        options = {'result_cache': os.path.join(self.root, 'results'), 'byte_compile': True}
+        gitoo.install(config, self.destination, **options)
+        other_destination = os.path.join(self.root, 'other')
+        os.makedirs(other_destination)
+        entry = gitoo.install(config, other_destination, **options).entries[0]
+
+        self.assertTrue(entry.result_cache_hit)
+        self.assertTrue(os.path.exists(compiled_path(
+            os.path.join(other_destination, 'hr_experience', 'models', 'hr.py'))))
@@ -0,0 +1,291 @@
+import os
+import time
+import unittest
+import threading
+
+import mock
+import yaml
+
+from .. import cache, cli, core, history
+from .common import LocalReposMixin, commit_all, git, write_module
+
+
+class TestMirrorCache(LocalReposMixin):
+
+    def setUp(self):
+        super(TestMirrorCache, self).setUp()
+        self.repo, self.commit = self.make_repo('hr', ['hr_experience'])
+        self.cache = cache.MirrorCache(os.path.join(self.root, 'cache'))
+
+    def test_first_access_is_a_miss(self):
+        with self.cache.mirror(self.repo) as mirror:
+            self.assertEqual(self.commit, git(mirror, 'rev-parse', 'refs/heads/12.0'))
+        self.assertEqual((0, 1), (self.cache.hits, self.cache.misses))
+
+    def test_second_access_fetches_new_commits(self):
+        with self.cache.mirror(self.repo):
+            pass
+        write_module(self.repo, 'hr_family')
+        new_commit = commit_all(self.repo, 'add hr_family')
+        with self.cache.mirror(self.repo) as mirror:
+            self.assertEqual(new_commit, git(mirror, 'rev-parse', 'refs/heads/12.0'))
+        self.assertEqual((1, 1), (self.cache.hits, self.cache.misses))
+
+    def test_credentials_are_ignored_in_mirror_path(self):
+        self.assertEqual(
+            self.cache.mirror_path('https://github.com/OCA/hr'),
+            self.cache.mirror_path('https://token@github.com/OCA/hr'),
+        )
+
+    def test_temp_repo_clones_from_the_mirror(self):
+        with core.temp_repo(self.repo, '12.0', self.commit, cache=self.cache) as tmp:
+            self.assertEqual(self.commit, git(tmp, 'rev-parse', 'HEAD'))
+            self.assertTrue(os.path.exists(os.path.join(tmp, 'hr_experience', '__manifest__.py')))
+        self.assertTrue(os.path.isdir(self.cache.mirror_path(self.repo)))
+
+    def test_gc_evicts_least_recently_used_mirrors(self):
+        other_repo, _ = self.make_repo('website', ['website_multi_theme'])
+        with self.cache.mirror(self.repo):
+            pass
+        with self.cache.mirror(other_repo):
+            pass
+        os.utime(self.cache.mirror_path(self.repo) + '.lock', (0, 0))
+
+        evicted = self.cache.gc(max_size=1)
+
+        self.assertEqual(len(evicted), 2)
+        self.assertEqual(evicted[0], self.cache.mirror_path(self.repo))
+
+    def test_gc_keeps_the_reused_mirrors(self):
+        other_repo, _ = self.make_repo('website', ['website_multi_theme'])
+        with self.cache.mirror(self.repo):
+            pass
+        with self.cache.mirror(other_repo):
+            pass
+        os.utime(self.cache.mirror_path(self.repo) + '.lock', (0, 0))
+        os.utime(self.cache.mirror_path(other_repo) + '.lock', (1, 1))
+        with self.cache.mirror(self.repo, commit=self.commit):
+            pass
+        self.assertEqual(self.cache.reused, 1)
+
+        evicted = self.cache.gc(max_size=1)
+
+        self.assertEqual(evicted[0], self.cache.mirror_path(other_repo))
+
+    def test_gc_keeps_mirrors_under_the_max_size(self):
+        with self.cache.mirror(self.repo):
+            pass
+        self.assertEqual(self.cache.gc(max_size=cache.parse_size('1G')), [])
+
+    def test_install_all_with_cache_dir(self):
+        self.write_conf([{'url': self.repo, 'branch': '12.0'}])
+        cache_dir = os.path.join(self.root, 'cli-cache')
+        cli._install_all(destination=self.destination, conf_file=self.conf_file, cache_dir=cache_dir)
+        self.assertEqual(os.listdir(self.destination), ['hr_experience'])
+        # the mirror, its lock file and the history of the runs
+        self.assertEqual(len(os.listdir(cache_dir)), 3)
+        self.assertIn(history.HISTORY_FILE, os.listdir(cache_dir))
+
+    def test_fetch_once_reuses_the_mirror(self):
+        fetch_once_cache = cache.MirrorCache(os.path.join(self.root, 'session'), fetch_once=True)
+        with fetch_once_cache.mirror(self.repo):
+            pass
+        write_module(self.repo, 'hr_family')
+        commit_all(self.repo, 'add hr_family')
+        with fetch_once_cache.mirror(self.repo) as mirror:
+            self.assertEqual(self.commit, git(mirror, 'rev-parse', 'refs/heads/12.0'))
+        self.assertEqual((0, 1, 1), (fetch_once_cache.hits, fetch_once_cache.misses, fetch_once_cache.reused))
+
+    def test_mirror_fetched_once_is_shared(self):
+        fetch_once_cache = cache.MirrorCache(os.path.join(self.root, 'session'), fetch_once=True)
+        with fetch_once_cache.mirror(self.repo):
+            pass
+
+        def use_mirror_twice():
+            with fetch_once_cache.mirror(self.repo), fetch_once_cache.mirror(self.repo):
+                pass
+
+        # Both uses hold the mirror at the same time, without waiting for each other
+        thread = threading.Thread(target=use_mirror_twice, daemon=True)
+        thread.start()
+        thread.join(10)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(fetch_once_cache.reused, 2)
+
+    def test_fork_borrows_the_objects_of_its_upstream(self):
+        fork = self._make_fork()
+        with self.cache.mirror(self.repo):
+            pass
+        with self.cache.mirror(fork, reference=self.repo) as mirror:
+            with open(os.path.join(mirror, 'objects', 'info', 'alternates')) as f:
+                self.assertEqual(f.read().strip(), os.path.join(self.cache.mirror_path(self.repo), 'objects'))
+            self.assertEqual(git(fork, 'rev-parse', 'fix'), git(mirror, 'rev-parse', 'refs/heads/fix'))
+
+    def test_gc_keeps_mirrors_borrowed_by_forks(self):
+        fork = self._make_fork()
+        with self.cache.mirror(self.repo):
+            pass
+        with self.cache.mirror(fork, reference=self.repo):
+            pass
+        os.utime(self.cache.mirror_path(self.repo) + '.lock', (0, 0))
+
+        evicted = self.cache.gc(max_size=1)
+
+        self.assertEqual(evicted, [self.cache.mirror_path(fork)])
+        self.assertEqual(self.cache.gc(max_size=1), [self.cache.mirror_path(self.repo)])
+
+    def test_mirrored_commit_is_not_fetched_again(self):
+        with self.cache.mirror(self.repo, commit=self.commit):
+            pass
+        write_module(self.repo, 'hr_family')
+        new_commit = commit_all(self.repo, 'add hr_family')
+        with self.cache.mirror(self.repo, commit=self.commit) as mirror:
+            self.assertEqual(self.commit, git(mirror, 'rev-parse', 'refs/heads/12.0'))
+        with self.cache.mirror(self.repo, commit=new_commit) as mirror:
+            self.assertEqual(new_commit, git(mirror, 'rev-parse', 'refs/heads/12.0'))
+        self.assertEqual((1, 1, 1), (self.cache.hits, self.cache.misses, self.cache.reused))
+
+    def test_concurrent_requests_wait_for_the_fetch_in_flight(self):
+        fetching = threading.Event()
+        release = threading.Event()
+        run_git = cache.run_git
+
+        def slow_run_git(folder, *args):
+            if args[0] == 'fetch':
+                fetching.set()
+                release.wait(10)
+            return run_git(folder, *args)
+
+        with mock.patch.object(cache, 'run_git', side_effect=slow_run_git) as patched_run_git:
+            first = threading.Thread(target=self._use_mirror)
+            first.start()
+            fetching.wait(10)
+            second = threading.Thread(target=self._use_mirror)
+            second.start()
+            time.sleep(0.2)
+            release.set()
+            first.join()
+            second.join()
+
+        fetches = [call for call in patched_run_git.call_args_list if call[0][1] == 'fetch']
+        self.assertEqual(len(fetches), 1)
+        self.assertEqual((0, 1, 1), (self.cache.hits, self.cache.misses, self.cache.reused))
+
+    def _use_mirror(self):
+        with self.cache.mirror(self.repo):
+            pass
+
+    def _make_fork(self):
+        fork = os.path.join(self.root, 'repos', 'hr-fork')
+        git(self.root, 'clone', '--quiet', self.repo, fork)
+        git(fork, 'checkout', '--quiet', '-b', 'fix')
+        write_module(fork, 'hr_fix')
+        commit_all(fork, 'add hr_fix')
+        return fork
+
+
+class TestPlanMirrors(LocalReposMixin):
+
+    def setUp(self):
+        super(TestPlanMirrors, self).setUp()
+        self.repo, self.commit = self.make_repo('hr', ['hr_experience', 'hr_family'])
+        self.fork = os.path.join(self.root, 'repos', 'hr-fork')
+        git(self.root, 'clone', '--quiet', self.repo, self.fork)
+        git(self.fork, 'checkout', '--quiet', '-b', 'fix')
+        write_module(self.fork, 'hr_fix')
+        commit_all(self.fork, 'add hr_fix')
+        self.update = mock.patch.object(
+            cache.MirrorCache, '_update', autospec=True, side_effect=cache.MirrorCache._update)
+
+    def test_repository_fetched_once_for_many_entries(self):
+        self.write_conf([
+            {'url': self.repo, 'branch': '12.0', 'includes': ['hr_experience']},
+            {'url': self.repo, 'branch': '12.0', 'includes': ['hr_family'],
+             'patches': [{'url': self.fork, 'branch': 'fix'}]},
+        ])
+        with self.update as update:
+            cli._install_all(destination=self.destination, conf_file=self.conf_file, jobs=2)
+
+        fetched = sorted(call[0][1] for call in update.call_args_list)
+        self.assertEqual(fetched, sorted([self.repo, self.fork]))
+        self.assertEqual(set(os.listdir(self.destination)), {'hr_experience', 'hr_family'})
+
+    def test_unique_repositories_are_cloned_directly(self):
+        self.write_conf([{'url': self.repo, 'branch': '12.0'}])
+        with self.update as update:
+            cli._install_all(destination=self.destination, conf_file=self.conf_file)
+        update.assert_not_called()
+
+    def test_install_many(self):
+        other_conf = os.path.join(self.root, 'other.yml')
+        other_destination = os.path.join(self.root, 'other')
+        os.makedirs(other_destination)
+        self.write_conf([{'url': self.repo, 'branch': '12.0', 'includes': ['hr_experience']}])
+        with open(other_conf, 'w') as f:
+            yaml.dump([{'url': self.repo, 'branch': '12.0', 'includes': ['hr_family']}], f)
+
+        with self.update as update:
+            cli._install_many([(self.conf_file, self.destination), (other_conf, other_destination)])
+
+        self.assertEqual(update.call_count, 1)
+        self.assertEqual(os.listdir(self.destination), ['hr_experience'])
+        self.assertEqual(os.listdir(other_destination), ['hr_family'])
+
+
+class TestParseSize(unittest.TestCase):
+
+    def test_parse_size(self):
+        self.assertEqual(cache.parse_size('512'), 512)
+        self.assertEqual(cache.parse_size('2K'), 2048)
+        self.assertEqual(cache.parse_size('1.5G'), int(1.5 * 1024 ** 3))
+        self.assertEqual(cache.parse_size('10MB'), 10 * 1024 ** 2)
+
+
+class TestResultCache(LocalReposMixin):
+
+    def setUp(self):
+        super(TestResultCache, self).setUp()
+        self.repo, self.commit = self.make_repo('hr', ['hr_experience', 'hr_family'])
+        self.cache = cache.ResultCache(os.path.join(self.root, 'results'))
+
+    def _addon(self, **kwargs):
+        return core.Addon(self.repo, '12.0', self.commit, result_cache=self.cache, **kwargs)
+
+    def test_second_install_does_not_use_git(self):
+        self._addon(lang='fr').install(self.destination)
+        other_destination = os.path.join(self.root, 'other')
+        os.makedirs(other_destination)
+
+        with mock.patch.object(core, 'temp_repo') as temp_repo:
+            self._addon(lang='fr').install(other_destination)
+
+        temp_repo.assert_not_called()
+        self.assertEqual((1, 1), (self.cache.hits, self.cache.misses))
+        self.assertEqual(set(os.listdir(other_destination)), {'hr_experience', 'hr_family'})
+        self.assertEqual(os.listdir(os.path.join(other_destination, 'hr_family', 'i18n')), ['fr.po'])
+
+    def test_different_inputs_use_different_keys(self):
+        self.assertNotEqual(
+            self.cache.key(self._addon().signature()),
+            self.cache.key(self._addon(include_modules=['hr_family']).signature()),
+        )
+        self.assertNotEqual(
+            self.cache.key(self._addon().signature()),
+            self.cache.key(self._addon(lang='fr').signature()),
+        )
+
+    def test_branch_only_entries_bypass_the_cache(self):
+        addon = core.Addon(self.repo, '12.0', result_cache=self.cache)
+        self.assertIsNone(addon.signature())
+        addon.install(self.destination)
+        self.assertEqual((0, 0), (self.cache.hits, self.cache.misses))
+
+    def test_file_patch_hash_is_part_of_the_signature(self):
+        patch_file = os.path.join(self.root, 'fix.patch')
+        with open(patch_file, 'w') as f:
+            f.write('first version')
+        addon = self._addon(patches=[core.FilePatch('fix.patch', self.root)])
+        first_signature = addon.signature()
+        with open(patch_file, 'w') as f:
+            f.write('second version')
+        self.assertNotEqual(first_signature, addon.signature())
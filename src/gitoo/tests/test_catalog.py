@@ -0,0 +1,93 @@
+import os
+import sqlite3
+import tarfile
+
+from click.testing import CliRunner
+
+import gitoo
+from .. import catalog, cli
+from .common import LocalReposMixin, commit_all, write_module
+
+
+class TestModulesIndex(LocalReposMixin):
+
+    def setUp(self):
+        super(TestModulesIndex, self).setUp()
+        self.hr, self.hr_commit = self.make_repo('hr', ['hr'])
+        write_module(self.hr, 'hr_experience', depends=('hr',))
+        write_module(self.hr, 'hr_skill', depends=('hr', 'web'))
+        self.hr_commit = commit_all(self.hr, 'depends on hr')
+        self.website, _ = self.make_repo('website', ['website_multi_theme'])
+        self.conf = [
+            {'url': self.hr, 'branch': '12.0'},
+            {'url': self.website, 'branch': '12.0'},
+        ]
+        self.write_conf(self.conf)
+
+    def test_index_is_written(self):
+        gitoo.install(self.conf, self.destination, modules_index=catalog.JSON)
+
+        index = catalog.read_catalog(self.destination)
+        self.assertEqual(sorted(index.modules), ['hr', 'hr_experience', 'hr_skill', 'website_multi_theme'])
+        self.assertEqual(index.modules['hr_skill'], {
+            'name': 'hr_skill', 'path': 'hr_skill', 'version': '1.0.0', 'depends': ['hr', 'web'],
+            'installable': True, 'url': self.hr, 'branch': '12.0', 'commit': self.hr_commit, 'patches': [],
+        })
+        self.assertFalse(os.path.exists(os.path.join(self.destination, catalog.SQLITE_FILE)))
+
+    def test_no_index_by_default(self):
+        gitoo.install(self.conf, self.destination)
+        self.assertFalse(os.path.exists(os.path.join(self.destination, catalog.CATALOG_FILE)))
+        with self.assertRaises(RuntimeError):
+            gitoo.modules(self.destination)
+
+    def test_query(self):
+        gitoo.install(self.conf, self.destination, modules_index=catalog.JSON)
+
+        names = [module['name'] for module in gitoo.modules(self.destination, ['depends=hr'])]
+        self.assertEqual(names, ['hr_experience', 'hr_skill'])
+        names = [module['name'] for module in gitoo.modules(self.destination, ['depends=hr', 'name=*skill'])]
+        self.assertEqual(names, ['hr_skill'])
+        self.assertEqual(len(gitoo.modules(self.destination, ['installable=false'])), 0)
+        with self.assertRaises(RuntimeError):
+            gitoo.modules(self.destination, ['author=Numigi'])
+
+    def test_query_command(self):
+        cli._install_all(destination=self.destination, conf_file=self.conf_file, modules_index=catalog.JSON)
+        result = CliRunner().invoke(cli.entry_point, [
+            'modules', '--destination', self.destination, '--where', 'depends=hr',
+        ])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(result.output.split(), ['hr_experience', 'hr_skill'])
+
+    def test_sqlite(self):
+        gitoo.install(self.conf, self.destination, modules_index=catalog.SQLITE)
+
+        connection = sqlite3.connect(os.path.join(self.destination, catalog.SQLITE_FILE))
+        try:
+            rows = connection.execute(
+                'SELECT modules.name, modules.url FROM modules JOIN depends ON depends.module = modules.name '
+                'WHERE depends.name = ? ORDER BY modules.name', ('web',)).fetchall()
+        finally:
+            connection.close()
+        self.assertEqual(rows, [('hr_skill', self.hr)])
+        self.assertTrue(os.path.exists(os.path.join(self.destination, catalog.CATALOG_FILE)))
+
+    def test_sync_keeps_the_modules_up_to_date(self):
+        cli._sync(destination=self.destination, conf_file=self.conf_file, modules_index=catalog.JSON)
+        self.write_conf(self.conf[:1])
+        cli._sync(destination=self.destination, conf_file=self.conf_file, modules_index=catalog.JSON)
+
+        names = [module['name'] for module in gitoo.modules(self.destination)]
+        self.assertEqual(names, ['hr', 'hr_experience', 'hr_skill'])
+
+    def test_tar_output(self):
+        archive_path = os.path.join(self.root, 'addons.tar')
+        cli._install_all(
+            destination=self.destination, conf_file=self.conf_file, output_tar=archive_path,
+            modules_index=catalog.JSON)
+
+        with tarfile.open(archive_path) as archive:
+            self.assertIn(catalog.CATALOG_FILE, archive.getnames())
+            archive.extractall(self.destination)
+        self.assertEqual(len(gitoo.modules(self.destination)), 4)
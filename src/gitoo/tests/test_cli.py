@@ -1,10 +1,17 @@
 import yaml
 import os
+import sys
 import shutil
+import subprocess
 import tempfile
+import time
 import unittest
 
-from .. import cli
+import mock
+from click.testing import CliRunner
+
+from .. import cli, core
+from .common import LocalReposMixin, commit_all, write_module
 
 
 class TestInstallBase(unittest.TestCase):
@@ -199,3 +206,137 @@ class TestPatchUsingFile(ThirdPartyTestMixin):
         readme_file = os.path.join(self.destination, 'sentry', 'README.rst')
         readme_content = open(readme_file, 'r').read()
         self.assertIn('This is a patch.', readme_content)
+
+
+class TestInstallConcurrently(LocalReposMixin):
+
+    def setUp(self):
+        super(TestInstallConcurrently, self).setUp()
+        self.hr, _ = self.make_repo('hr', ['hr_experience', 'shared_module'])
+        self.website, _ = self.make_repo('website', ['website_multi_theme', 'shared_module'])
+        with open(os.path.join(self.website, 'shared_module', 'origin.txt'), 'w') as f:
+            f.write('website')
+        commit_all(self.website, 'mark the shared module')
+
+    def test_modules_of_all_entries_installed(self):
+        self.write_conf([
+            {'url': self.hr, 'branch': '12.0'},
+            {'url': self.website, 'branch': '12.0'},
+        ])
+        cli._install_all(destination=self.destination, conf_file=self.conf_file, jobs=2)
+        modules = os.listdir(self.destination)
+        self.assertEqual(set(modules), {'hr_experience', 'website_multi_theme', 'shared_module'})
+
+    def test_last_entry_wins(self):
+        self.write_conf([
+            {'url': self.hr, 'branch': '12.0'},
+            {'url': self.website, 'branch': '12.0'},
+        ])
+        cli._install_all(destination=self.destination, conf_file=self.conf_file, jobs=2)
+        origin_file = os.path.join(self.destination, 'shared_module', 'origin.txt')
+        self.assertTrue(os.path.exists(origin_file))
+
+    def test_failure_cleans_up_temp_folders(self):
+        self.write_conf([
+            {'url': self.hr, 'branch': '12.0'},
+            {'url': os.path.join(self.root, 'does-not-exist'), 'branch': '12.0'},
+            {'url': self.website, 'branch': '12.0'},
+        ])
+        created_folders = []
+        mkdtemp = tempfile.mkdtemp
+
+        def record_mkdtemp(*args, **kwargs):
+            folder = mkdtemp(*args, **kwargs)
+            created_folders.append(folder)
+            return folder
+
+        with mock.patch.object(tempfile, 'mkdtemp', side_effect=record_mkdtemp):
+            with self.assertRaises(RuntimeError):
+                cli._install_all(destination=self.destination, conf_file=self.conf_file, jobs=3)
+
+        self.assertTrue(created_folders)
+        for folder in created_folders:
+            self.assertFalse(os.path.exists(folder))
+
+    def test_failure_cancels_the_entries_not_started(self):
+        self.write_conf([
+            {'url': self.hr, 'branch': '12.0'},
+            {'url': os.path.join(self.root, 'does-not-exist'), 'branch': '12.0'},
+            {'url': self.website, 'branch': '12.0'},
+        ])
+        started = []
+        prepare = core.Addon.prepare
+
+        def slow_prepare(addon, work_dir=None):
+            started.append(addon.repo)
+            if addon.repo == self.hr:
+                time.sleep(0.5)
+            return prepare(addon, work_dir)
+
+        with mock.patch.object(core.Addon, 'prepare', autospec=True, side_effect=slow_prepare):
+            with self.assertRaises(RuntimeError):
+                cli._install_all(destination=self.destination, conf_file=self.conf_file, jobs=2)
+
+        self.assertNotIn(self.website, started)
+        self.assertEqual(os.listdir(self.destination), [])
+
+
+class TestIncludesWithDepends(LocalReposMixin):
+
+    def setUp(self):
+        super(TestIncludesWithDepends, self).setUp()
+        self.hr, _ = self.make_repo('hr', [])
+        write_module(self.hr, 'hr_base')
+        write_module(self.hr, 'hr_skill', depends=('hr_base',))
+        write_module(self.hr, 'hr_unused')
+        commit_all(self.hr, 'hr modules')
+        self.website, _ = self.make_repo('website', [])
+        write_module(self.website, 'website_hr_skill', depends=('hr_skill', 'website'))
+        write_module(self.website, 'website_unused')
+        commit_all(self.website, 'website modules')
+
+    def test_dependencies_pulled_across_entries(self):
+        self.write_conf([
+            {'url': self.hr, 'branch': '12.0', 'includes_with_depends': True, 'includes': []},
+            {'url': self.website, 'branch': '12.0', 'includes_with_depends': True,
+             'includes': ['website_hr_skill']},
+        ])
+        cli._install_all(destination=self.destination, conf_file=self.conf_file, jobs=2)
+        modules = os.listdir(self.destination)
+        self.assertEqual(set(modules), {'hr_base', 'hr_skill', 'website_hr_skill'})
+
+    def test_dependencies_of_entries_without_option(self):
+        self.write_conf([
+            {'url': self.hr, 'branch': '12.0', 'includes_with_depends': True, 'includes': []},
+            {'url': self.website, 'branch': '12.0', 'includes': ['website_hr_skill']},
+        ])
+        cli._install_all(destination=self.destination, conf_file=self.conf_file)
+        modules = os.listdir(self.destination)
+        self.assertEqual(set(modules), {'hr_base', 'hr_skill', 'website_hr_skill'})
+
+    def test_excludes_are_kept(self):
+        self.write_conf([
+            {'url': self.hr, 'branch': '12.0', 'includes_with_depends': True,
+             'includes': ['hr_skill'], 'excludes': ['hr_base']},
+        ])
+        cli._install_all(destination=self.destination, conf_file=self.conf_file)
+        self.assertEqual(os.listdir(self.destination), ['hr_skill'])
+
+
+class TestStartup(unittest.TestCase):
+
+    def test_heavy_packages_not_imported(self):
+        code = "import sys, gitoo.cli; print(','.join(m for m in ('git', 'yaml', 'pystache') if m in sys.modules))"
+        src = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join([src, os.environ.get('PYTHONPATH', '')]))
+        output = subprocess.check_output([sys.executable, '-c', code], env=env).decode().strip()
+        self.assertEqual(output, '')
+
+    def test_git_backend_option(self):
+        with mock.patch.object(core, 'set_git_backend') as set_git_backend:
+            result = CliRunner().invoke(cli.entry_point, ['--git-backend', 'gitpython', 'cache', '--help'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        set_git_backend.assert_called_once_with('gitpython')
+
+        result = CliRunner().invoke(cli.entry_point, ['--git-backend', 'libgit2', 'cache', '--help'])
+        self.assertNotEqual(result.exit_code, 0)
@@ -3,10 +3,12 @@ import unittest
 import git
 import functools
 import os
+import shutil
 
 import mock
 
 from .. import core
+from .common import LocalReposMixin, commit_all, git as run_git, write_module
 
 
 class TestTempRepo(unittest.TestCase):
@@ -162,3 +164,416 @@ class TestParseUrl(unittest.TestCase):
 
         with self.assertRaises(KeyError):
             self.func(url_template)
+
+
+class TestShallowTempRepo(LocalReposMixin):
+
+    def setUp(self):
+        super(TestShallowTempRepo, self).setUp()
+        folder, self.first_commit = self.make_repo('hr', ['hr_experience'])
+        write_module(folder, 'hr_family')
+        self.second_commit = commit_all(folder, 'add hr_family')
+        self.url = 'file://' + folder
+
+    def test_whenCommitGiven_thenOnlyTheCommitIsFetched(self):
+        with core.temp_repo(self.url, '12.0', self.first_commit, shallow=True) as tmp:
+            self.assertEqual(self.first_commit, run_git(tmp, 'rev-parse', 'HEAD'))
+            self.assertEqual('1', run_git(tmp, 'rev-list', '--count', 'HEAD'))
+            self.assertFalse(os.path.exists(os.path.join(tmp, 'hr_family')))
+
+    def test_whenCommitNotGiven_thenWeAreInTheBranch(self):
+        with core.temp_repo(self.url, '12.0', shallow=True) as tmp:
+            self.assertEqual('12.0', run_git(tmp, 'rev-parse', '--abbrev-ref', 'HEAD'))
+            self.assertEqual(self.second_commit, run_git(tmp, 'rev-parse', 'HEAD'))
+            self.assertEqual('1', run_git(tmp, 'rev-list', '--count', 'HEAD'))
+
+    def test_whenFetchBySha_isRefused_thenTheRepoIsCloned(self):
+        protocol_v0 = {
+            'GIT_CONFIG_COUNT': '1',
+            'GIT_CONFIG_KEY_0': 'protocol.version',
+            'GIT_CONFIG_VALUE_0': '0',
+        }
+        with mock.patch.dict(os.environ, protocol_v0):
+            with core.temp_repo(self.url, '12.0', self.first_commit, shallow=True) as tmp:
+                self.assertEqual(self.first_commit, run_git(tmp, 'rev-parse', 'HEAD'))
+                self.assertEqual('false', run_git(tmp, 'rev-parse', '--is-shallow-repository'))
+
+
+class TestShallowPatch(LocalReposMixin):
+
+    def setUp(self):
+        super(TestShallowPatch, self).setUp()
+        folder, base_commit = self.make_repo('hr', ['hr_experience'])
+        run_git(folder, 'checkout', '-q', '-b', 'feature')
+        write_module(folder, 'hr_patched')
+        self.patch_commit = commit_all(folder, 'add hr_patched')
+        run_git(folder, 'checkout', '-q', '12.0')
+        for index in range(20):
+            write_module(folder, 'hr_module_{}'.format(index))
+            self.commit = commit_all(folder, 'add module {}'.format(index))
+        self.url = 'file://' + folder
+
+    def test_history_is_deepened_to_merge_the_patch(self):
+        patch = core.Patch(self.url, 'feature', self.patch_commit)
+        with core.temp_repo(self.url, '12.0', self.commit, shallow=True) as tmp:
+            patch.apply(tmp)
+            self.assertTrue(os.path.exists(os.path.join(tmp, 'hr_patched', '__manifest__.py')))
+            self.assertTrue(os.path.exists(os.path.join(tmp, 'hr_module_19', '__manifest__.py')))
+
+
+def _checked_out_tree(addon, folder):
+    """Copy the working tree of the add-on to the given folder, as it is before the modules are moved."""
+    copy = os.path.join(folder, 'tree')
+
+    def copy_tree(temp_repo, staging, index=None):
+        shutil.copytree(temp_repo, copy)
+
+    with mock.patch.object(addon, '_move_modules', side_effect=copy_tree):
+        addon.install(folder)
+    return copy
+
+
+class TestSparseCheckout(LocalReposMixin):
+
+    def setUp(self):
+        super(TestSparseCheckout, self).setUp()
+        self.url, self.commit = self.make_repo('hr', ['hr_experience', 'hr_family', 'hr_skill'])
+
+    def _checked_out_modules(self, addon):
+        tree = _checked_out_tree(addon, self.root)
+        return {name for name in os.listdir(tree) if not name.startswith('.')} - {'README.md'}
+
+    def test_only_included_modules_are_checked_out(self):
+        addon = core.Addon(self.url, '12.0', self.commit, include_modules=['hr_family'], sparse=True)
+        self.assertEqual(self._checked_out_modules(addon), {'hr_family'})
+
+    def test_excluded_modules_are_not_checked_out(self):
+        addon = core.Addon(self.url, '12.0', exclude_modules=['hr_family'], sparse=True)
+        self.assertEqual(self._checked_out_modules(addon), {'hr_experience', 'hr_skill'})
+
+    def test_folders_added_by_patches_are_checked_out(self):
+        run_git(self.url, 'checkout', '-q', '-b', 'feature')
+        write_module(self.url, 'hr_patched')
+        patch_commit = commit_all(self.url, 'add hr_patched')
+        run_git(self.url, 'checkout', '-q', '12.0')
+        addon = core.Addon(
+            self.url, '12.0', self.commit, include_modules=['hr_family', 'hr_patched'], sparse=True,
+            patches=[core.Patch(self.url, 'feature', patch_commit)],
+        )
+        self.assertEqual(self._checked_out_modules(addon), {'hr_family', 'hr_patched'})
+
+    def test_sparse_with_shallow_fetch(self):
+        addon = core.Addon(
+            'file://' + self.url, '12.0', self.commit, include_modules=['hr_skill'], sparse=True, shallow=True)
+        self.assertEqual(self._checked_out_modules(addon), {'hr_skill'})
+
+
+class TestSparseCheckoutBase(LocalReposMixin):
+
+    def setUp(self):
+        super(TestSparseCheckoutBase, self).setUp()
+        self.url = os.path.join(self.root, 'odoo')
+        os.makedirs(os.path.join(self.url, 'odoo', 'tools'))
+        os.makedirs(os.path.join(self.url, 'odoo', 'addons'))
+        for path in ('odoo/__init__.py', 'odoo/addons/__init__.py', 'odoo/tools/misc.py'):
+            with open(os.path.join(self.url, path), 'a'):
+                pass
+        for module in ('account', 'hr'):
+            write_module(os.path.join(self.url, 'addons'), module)
+        for module in ('base', 'web'):
+            write_module(os.path.join(self.url, 'odoo', 'addons'), module)
+        run_git(self.url, 'init', '-q')
+        run_git(self.url, 'symbolic-ref', 'HEAD', 'refs/heads/12.0')
+        commit_all(self.url, 'odoo')
+
+    def test_framework_and_included_modules_are_checked_out(self):
+        addon = core.Base(self.url, '12.0', include_modules=['base', 'account'], sparse=True)
+        tree = _checked_out_tree(addon, self.root)
+        self.assertEqual(os.listdir(os.path.join(tree, 'addons')), ['account'])
+        self.assertEqual(
+            set(os.listdir(os.path.join(tree, 'odoo', 'addons'))), {'__init__.py', 'base'})
+        self.assertTrue(os.path.exists(os.path.join(tree, 'odoo', 'tools', 'misc.py')))
+
+    def test_only_included_modules_are_installed(self):
+        core.Base(self.url, '12.0', include_modules=['base', 'account']).install(self.destination)
+        modules = os.listdir(os.path.join(self.destination, 'odoo', 'addons'))
+        self.assertEqual(set(modules), {'__init__.py', 'base', 'account'})
+
+
+class TestFilePatchTouchedPaths(unittest.TestCase):
+
+    def test_touched_paths(self):
+        dir_path = os.path.dirname(os.path.realpath(__file__))
+        patch = core.FilePatch('server-tools-sentry-readme.patch', os.path.join(dir_path, 'patches'))
+        self.assertEqual(patch.touched_paths(), ['sentry/README.rst'])
+
+
+class TestPatchPipeline(LocalReposMixin):
+
+    def setUp(self):
+        super(TestPatchPipeline, self).setUp()
+        self.url, self.commit = self.make_repo('hr', ['hr_experience'])
+        self.fork = os.path.join(self.root, 'repos', 'hr-fork')
+        run_git(self.root, 'clone', '-q', self.url, self.fork)
+        self.fork_commits = {}
+        for branch in ('12.0-fix-a', '12.0-fix-b'):
+            run_git(self.fork, 'checkout', '-q', '-b', branch, self.commit)
+            write_module(self.fork, 'hr_{}'.format(branch[-1]))
+            self.fork_commits[branch] = commit_all(self.fork, branch)
+
+    def _write_patch(self, name, content):
+        path = os.path.join(self.root, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        return core.FilePatch(name, self.root)
+
+    def _readme_patch(self, name, old_line, new_line):
+        return self._write_patch(name, (
+            "diff --git a/README.md b/README.md\n"
+            "--- a/README.md\n"
+            "+++ b/README.md\n"
+            "@@ -1 +1 @@\n"
+            "-{}\n"
+            "+{}\n"
+        ).format(old_line, new_line))
+
+    def test_one_fetch_per_remote(self):
+        pipeline = core.PatchPipeline([
+            core.Patch(self.fork, '12.0-fix-a', self.fork_commits['12.0-fix-a']),
+            core.Patch(self.fork, '12.0-fix-b'),
+        ])
+        with core.temp_repo(self.url, '12.0', self.commit) as tmp:
+            with mock.patch.object(core, 'run_git', wraps=core.run_git) as run_git:
+                pipeline.fetch(tmp)
+            fetches = [call for call in run_git.call_args_list if call[0][1] == 'fetch']
+            self.assertEqual(len(fetches), 1)
+
+            pipeline.apply(tmp)
+            self.assertTrue(os.path.isdir(os.path.join(tmp, 'hr_a')))
+            self.assertTrue(os.path.isdir(os.path.join(tmp, 'hr_b')))
+
+    def test_patch_files_are_applied_in_order(self):
+        pipeline = core.PatchPipeline([
+            self._readme_patch('first.patch', '# hr', '# first'),
+            self._readme_patch('second.patch', '# first', '# second'),
+        ])
+        with core.temp_repo(self.url, '12.0', self.commit) as tmp:
+            pipeline.fetch(tmp)
+            pipeline.apply(tmp)
+            with open(os.path.join(tmp, 'README.md')) as f:
+                self.assertEqual(f.read(), '# second\n')
+
+    def test_patches_without_git_identity(self):
+        pipeline = core.PatchPipeline([
+            self._readme_patch('first.patch', '# hr', '# first'),
+            core.Patch(self.fork, '12.0-fix-a', self.fork_commits['12.0-fix-a']),
+        ])
+        home = os.path.join(self.root, 'home')
+        os.makedirs(home)
+        environ = {
+            key: value for key, value in os.environ.items()
+            if not key.startswith(('GIT_AUTHOR_', 'GIT_COMMITTER_', 'EMAIL'))
+        }
+        environ.update(HOME=home, XDG_CONFIG_HOME=home, GIT_CONFIG_NOSYSTEM='1')
+        with core.temp_repo(self.url, '12.0', self.commit) as tmp:
+            with mock.patch.dict(os.environ, environ, clear=True):
+                pipeline.fetch(tmp)
+                pipeline.apply(tmp)
+            with open(os.path.join(tmp, 'README.md')) as f:
+                self.assertEqual(f.read(), '# first\n')
+            self.assertTrue(os.path.isdir(os.path.join(tmp, 'hr_a')))
+
+    def test_failing_patch_file_is_reported(self):
+        pipeline = core.PatchPipeline([
+            self._readme_patch('first.patch', '# hr', '# first'),
+            self._readme_patch('broken.patch', '# unknown', '# broken'),
+            self._readme_patch('third.patch', '# broken', '# third'),
+        ])
+        with core.temp_repo(self.url, '12.0', self.commit) as tmp:
+            pipeline.fetch(tmp)
+            with self.assertRaises(RuntimeError) as context:
+                pipeline.apply(tmp)
+
+        message = str(context.exception)
+        self.assertIn('first.patch: ok', message)
+        self.assertIn('broken.patch: FAILED', message)
+        self.assertIn('third.patch: not applied', message)
+
+
+def _list_files(folder):
+    """List the files inside the given folder, relative to it."""
+    return sorted(
+        os.path.relpath(os.path.join(directory, file_name), folder)
+        for directory, _, files in os.walk(folder)
+        for file_name in files
+    )
+
+
+class TestArchiveExport(LocalReposMixin):
+
+    def setUp(self):
+        super(TestArchiveExport, self).setUp()
+        self.url, self.commit = self.make_repo('hr', ['hr_experience', 'hr_family', 'hr_skill'])
+        self.checkout_destination = os.path.join(self.root, 'checkout')
+        os.makedirs(self.checkout_destination)
+
+    def _assert_same_as_checkout(self, addon_cls=core.Addon, url=None, **kwargs):
+        url = url or self.url
+        addon_cls(url, '12.0', export=core.ARCHIVE, **kwargs).install(self.destination)
+        addon_cls(url, '12.0', **kwargs).install(self.checkout_destination)
+        files = _list_files(self.destination)
+        self.assertEqual(files, _list_files(self.checkout_destination))
+        return files
+
+    def test_archive_export_matches_checkout(self):
+        self._assert_same_as_checkout(exclude_modules=['hr_family'])
+
+    def test_unrequired_languages_are_not_exported(self):
+        files = self._assert_same_as_checkout(include_modules=['hr_skill'], lang='fr')
+        self.assertIn('hr_skill/i18n/fr.po', files)
+        self.assertNotIn('hr_skill/i18n/es.po', files)
+
+    def test_patches_are_exported(self):
+        run_git(self.url, 'checkout', '-q', '-b', 'feature')
+        write_module(self.url, 'hr_patched')
+        patch_commit = commit_all(self.url, 'add hr_patched')
+        run_git(self.url, 'checkout', '-q', '12.0')
+        files = self._assert_same_as_checkout(patches=[core.Patch(self.url, 'feature', patch_commit)])
+        self.assertIn('hr_patched/__manifest__.py', files)
+
+    def test_base_layout(self):
+        url = os.path.join(self.root, 'odoo')
+        os.makedirs(os.path.join(url, 'odoo', 'tools'))
+        os.makedirs(os.path.join(url, 'odoo', 'addons'))
+        for path in ('odoo/__init__.py', 'odoo/addons/__init__.py', 'odoo/tools/misc.py'):
+            with open(os.path.join(url, path), 'a'):
+                pass
+        for module in ('account', 'hr'):
+            write_module(os.path.join(url, 'addons'), module)
+        for module in ('base', 'web'):
+            write_module(os.path.join(url, 'odoo', 'addons'), module)
+        run_git(url, 'init', '-q')
+        run_git(url, 'symbolic-ref', 'HEAD', 'refs/heads/12.0')
+        commit_all(url, 'odoo')
+
+        files = self._assert_same_as_checkout(core.Base, url, exclude_modules=['web', 'hr'], lang='fr')
+        self.assertIn('odoo/tools/misc.py', files)
+        self.assertIn('odoo/addons/account/i18n/fr.po', files)
+        self.assertNotIn('odoo/addons/account/i18n/es.po', files)
+        self.assertFalse(any(path.startswith(('odoo/addons/web/', 'odoo/addons/hr/')) for path in files))
+
+    def test_fallback_to_checkout(self):
+        addon = core.Addon(self.url, '12.0', include_modules=['hr_skill'], export=core.ARCHIVE)
+        with mock.patch.object(addon, '_extract_archive', side_effect=RuntimeError('git archive failed')):
+            addon.install(self.destination)
+        self.assertEqual(os.listdir(self.destination), ['hr_skill'])
+
+    def test_unknown_export_mode(self):
+        with self.assertRaises(RuntimeError):
+            core.Addon(self.url, '12.0', export='zip')
+
+
+class TestForceMove(LocalReposMixin):
+
+    def _write_module(self, folder, content):
+        write_module(folder, 'hr_skill')
+        with open(os.path.join(folder, 'hr_skill', 'origin.txt'), 'w') as f:
+            f.write(content)
+
+    def _origin(self):
+        with open(os.path.join(self.destination, 'hr_skill', 'origin.txt')) as f:
+            return f.read()
+
+    def _assert_replaced(self):
+        source = os.path.join(self.root, 'source')
+        self._write_module(self.destination, 'old')
+        self._write_module(source, 'new')
+        core.force_move(os.path.join(source, 'hr_skill'), self.destination)
+        core.wait_background_deletions()
+        self.assertEqual(self._origin(), 'new')
+        self.assertEqual(os.listdir(self.destination), ['hr_skill'])
+        self.assertEqual(os.listdir(source), [])
+
+    def test_existing_folder_is_replaced(self):
+        self._assert_replaced()
+
+    def test_existing_folder_is_replaced_without_rename_exchange(self):
+        with mock.patch.object(core, '_rename_exchange', return_value=False):
+            self._assert_replaced()
+
+    def test_staging_folders_are_created_inside_the_destination(self):
+        url, _ = self.make_repo('hr', ['hr_skill'])
+        created_folders = []
+        mkdtemp = core.tempfile.mkdtemp
+
+        def record_mkdtemp(*args, **kwargs):
+            folder = mkdtemp(*args, **kwargs)
+            created_folders.append(folder)
+            return folder
+
+        with mock.patch.object(core.tempfile, 'mkdtemp', side_effect=record_mkdtemp):
+            core.install_addons([core.Addon(url, '12.0')], self.destination)
+
+        self.assertTrue(created_folders)
+        for folder in created_folders:
+            self.assertEqual(os.path.dirname(folder), self.destination)
+        self.assertEqual(os.listdir(self.destination), ['hr_skill'])
+
+    def test_folders_left_by_an_interrupted_installation_are_removed(self):
+        url, _ = self.make_repo('hr', ['hr_skill'])
+        for name in ('.gitoo-tmp-interrupted/.git', '.gitoo-trash-interrupted/old/hr_skill'):
+            os.makedirs(os.path.join(self.destination, name))
+
+        core.install_addons([core.Addon(url, '12.0')], self.destination)
+        self.assertEqual(os.listdir(self.destination), ['hr_skill'])
+
+        os.makedirs(os.path.join(self.destination, '.gitoo-tmp-interrupted'))
+        core.Addon(url, '12.0').install(self.destination)
+        self.assertEqual(os.listdir(self.destination), ['hr_skill'])
+
+
+class TestGitBackend(LocalReposMixin):
+
+    def tearDown(self):
+        core.set_git_backend(core.SubprocessBackend.name)
+        super(TestGitBackend, self).tearDown()
+
+    def test_subprocess_is_the_default(self):
+        core._git_backend = None
+        with mock.patch.dict(os.environ, {core.GIT_BACKEND_ENV: ''}):
+            self.assertIsInstance(core.get_git_backend(), core.SubprocessBackend)
+        core._git_backend = None
+        with mock.patch.dict(os.environ, {core.GIT_BACKEND_ENV: 'gitpython'}):
+            self.assertIsInstance(core.get_git_backend(), core.GitPythonBackend)
+
+    def test_unknown_backend(self):
+        with self.assertRaises(RuntimeError):
+            core.set_git_backend('libgit2')
+
+    def test_error_output_is_returned_on_failure(self):
+        repo, _ = self.make_repo('hr', ['hr_experience'])
+        for name in sorted(core.GIT_BACKENDS):
+            core.set_git_backend(name)
+            return_code, stream_data = core.run_git_command(repo, 'rev-parse', '--verify', 'missing-branch')
+            self.assertNotEqual(return_code, 0)
+            self.assertIn(b'fatal', stream_data)
+            self.assertEqual(core.run_git(repo, 'rev-parse', '--abbrev-ref', 'HEAD'), '12.0\n')
+
+    def test_stdout_is_discarded_without_capture(self):
+        repo, commit = self.make_repo('hr', ['hr_experience'])
+        self.assertEqual(core.run_git_command(repo, 'rev-parse', 'HEAD'), (0, commit.encode() + b'\n'))
+        self.assertEqual(core.run_git_command(repo, 'rev-parse', 'HEAD', capture=False), (0, b''))
+
+    def test_backends_install_the_same_modules(self):
+        repo, commit = self.make_repo('hr', ['hr_experience', 'hr_skill'])
+        for name in sorted(core.GIT_BACKENDS):
+            core.set_git_backend(name)
+            destination = os.path.join(self.root, name)
+            os.makedirs(destination)
+            core.Addon(repo, '12.0', commit).install(destination)
+            self.assertEqual(sorted(os.listdir(destination)), ['hr_experience', 'hr_skill'])
+
+    def test_clone_failure(self):
+        with core.temp_folder() as folder:
+            with self.assertRaises(RuntimeError):
+                core._clone(os.path.join(self.root, 'missing'), folder, '12.0')
@@ -0,0 +1,49 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from ..index import ModuleIndex, read_manifest
+from .common import write_module
+
+
+class TestModuleIndex(unittest.TestCase):
+
+    def setUp(self):
+        super(TestModuleIndex, self).setUp()
+        self.folder = tempfile.mkdtemp()
+        write_module(self.folder, 'hr_base')
+        write_module(self.folder, 'hr_skill', depends=('hr_base', 'mail'))
+        os.makedirs(os.path.join(self.folder, 'not_a_module'))
+        with open(os.path.join(self.folder, 'README.md'), 'w') as f:
+            f.write('# modules\n')
+
+    def tearDown(self):
+        super(TestModuleIndex, self).tearDown()
+        shutil.rmtree(self.folder)
+
+    def test_only_modules_are_indexed(self):
+        index = ModuleIndex.scan(self.folder)
+        self.assertEqual(index.names(), {'hr_base', 'hr_skill'})
+
+    def test_manifest_values(self):
+        module = ModuleIndex.scan(self.folder).get('hr_skill')
+        self.assertEqual(module.version, '1.0.0')
+        self.assertEqual(module.depends, ['hr_base', 'mail'])
+        self.assertTrue(module.installable)
+
+    def test_dependency_closure(self):
+        index = ModuleIndex.scan(self.folder)
+        self.assertEqual(index.dependency_closure(['hr_skill']), ({'hr_skill', 'hr_base'}, {'base', 'mail'}))
+
+    def test_last_directory_wins(self):
+        write_module(os.path.join(self.folder, 'addons'), 'hr_base', depends=())
+        index = ModuleIndex.scan(self.folder, ('', 'addons'))
+        self.assertEqual(len(list(index)), 3)
+        self.assertEqual(index.get('hr_base').depends, [])
+
+    def test_unparsable_manifest(self):
+        path = os.path.join(self.folder, 'hr_base', '__manifest__.py')
+        with open(path, 'w') as f:
+            f.write('{"name": compute_name()}')
+        self.assertEqual(read_manifest(path), {})
@@ -0,0 +1,87 @@
+import os
+import time
+
+import mock
+
+from .. import cli, lock
+from .common import LocalReposMixin, commit_all, git, write_module
+
+
+class TestLock(LocalReposMixin):
+
+    def setUp(self):
+        super(TestLock, self).setUp()
+        self.hr, self.hr_commit = self.make_repo('hr', ['hr_experience'])
+        self.fork = os.path.join(self.root, 'repos', 'hr-fork')
+        git(self.root, 'clone', '-q', self.hr, self.fork)
+        git(self.fork, 'checkout', '-q', '-b', '12.0-fix')
+        write_module(self.fork, 'hr_family')
+        self.fork_commit = commit_all(self.fork, 'add hr_family')
+        self.website, self.website_commit = self.make_repo('website', ['website_multi_theme'])
+        self.data = [
+            {
+                'url': self.hr,
+                'branch': '12.0',
+                'patches': [{'url': self.fork, 'branch': '12.0-fix'}],
+            },
+            {'url': self.website, 'branch': '12.0', 'commit': 'pinned'},
+        ]
+
+    def test_resolve_ref(self):
+        self.assertEqual(self.hr_commit, lock.resolve_ref(self.hr, '12.0'))
+
+    def test_resolve_missing_ref(self):
+        with self.assertRaises(RuntimeError):
+            lock.resolve_ref(self.hr, '13.0')
+
+    def test_every_ref_is_pinned(self):
+        refs = lock.lock(self.data)
+        self.assertEqual(refs, [
+            {'url': self.hr, 'branch': '12.0', 'commit': self.hr_commit},
+            {'url': self.fork, 'branch': '12.0-fix', 'commit': self.fork_commit},
+            {'url': self.website, 'branch': '12.0', 'commit': 'pinned'},
+        ])
+
+    def test_refs_are_resolved_concurrently(self):
+        data = [{'url': 'repo-{}'.format(index), 'branch': '12.0'} for index in range(20)]
+
+        def slow_resolve(url, branch):
+            time.sleep(0.2)
+            return url
+
+        start = time.time()
+        with mock.patch.object(lock, 'resolve_ref', side_effect=slow_resolve):
+            refs = lock.lock(data)
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(len(refs), 20)
+
+    def test_apply_lock(self):
+        locked = lock.apply_lock(self.data, lock.lock(self.data))
+        self.assertEqual(locked[0]['commit'], self.hr_commit)
+        self.assertEqual(locked[0]['patches'][0]['commit'], self.fork_commit)
+        self.assertEqual(locked[1]['commit'], 'pinned')
+        self.assertNotIn('commit', self.data[0])
+
+    def test_apply_lock_with_missing_ref(self):
+        with self.assertRaises(RuntimeError):
+            lock.apply_lock(self.data, [])
+
+    def test_install_all_locked(self):
+        self.write_conf([{'url': self.hr, 'branch': '12.0'}])
+        cli._lock(conf_file=self.conf_file)
+        self.assertTrue(os.path.exists(os.path.join(self.root, 'gitoo.lock')))
+
+        write_module(self.hr, 'hr_skill')
+        commit_all(self.hr, 'add hr_skill')
+        cli._install_all(destination=self.destination, conf_file=self.conf_file, locked=True)
+
+        self.assertEqual(os.listdir(self.destination), ['hr_experience'])
+
+    def test_patch_from_branch_tip(self):
+        self.write_conf([{
+            'url': self.hr,
+            'branch': '12.0',
+            'patches': [{'url': self.fork, 'branch': '12.0-fix'}],
+        }])
+        cli._install_all(destination=self.destination, conf_file=self.conf_file)
+        self.assertEqual(set(os.listdir(self.destination)), {'hr_experience', 'hr_family'})
@@ -0,0 +1,66 @@
+import json
+import os
+
+import gitoo
+from .. import cli
+from .common import LocalReposMixin
+
+
+class TestMetrics(LocalReposMixin):
+
+    def setUp(self):
+        super(TestMetrics, self).setUp()
+        self.hr, _ = self.make_repo('hr', ['hr_experience', 'hr_skill'])
+        self.website, _ = self.make_repo('website', ['website_multi_theme'])
+        self.write_conf([
+            {'url': self.hr, 'branch': '12.0'},
+            {'url': self.website, 'branch': '12.0'},
+        ])
+        self.metrics_file = os.path.join(self.root, 'metrics.json')
+        self.trace_file = os.path.join(self.root, 'trace.json')
+
+    def _install(self, **kwargs):
+        cli._install_all(
+            destination=self.destination, conf_file=self.conf_file,
+            metrics_file=self.metrics_file, trace_file=self.trace_file, **kwargs)
+        with open(self.metrics_file) as f:
+            return json.load(f)
+
+    def test_report_per_entry(self):
+        report = self._install(lang='fr', jobs=2)
+        entries = {entry['entry']: entry for entry in report['entries']}
+        self.assertEqual(set(entries), {self.hr + '@12.0', self.website + '@12.0'})
+
+        hr = entries[self.hr + '@12.0']
+        self.assertTrue({'prepare', 'clone', 'checkout', 'patch', 'languages', 'stage', 'install'} <= set(hr['phases']))
+        self.assertEqual(hr['counters']['modules_moved'], 2)
+        self.assertEqual(hr['counters']['po_files_removed'], 2)
+        self.assertGreater(hr['counters']['bytes_fetched'], 0)
+        self.assertGreater(hr['counters']['files_written'], 0)
+        self.assertGreater(hr['counters']['git_processes'], 0)
+        self.assertEqual(report['counters']['modules_moved'], 3)
+
+    def test_entries_of_the_same_repository(self):
+        config = [
+            {'url': self.hr, 'branch': '12.0', 'includes': ['hr_experience']},
+            {'url': self.hr, 'branch': '12.0', 'includes': ['hr_skill']},
+        ]
+        result = gitoo.install(config, self.destination, jobs=2, metrics_file=self.metrics_file)
+
+        self.assertEqual([entry.counters['modules_moved'] for entry in result.entries], [1, 1])
+        with open(self.metrics_file) as f:
+            report = json.load(f)
+        self.assertEqual([entry['entry'] for entry in report['entries']], [self.hr + '@12.0'] * 2)
+        self.assertEqual(len({entry['id'] for entry in report['entries']}), 2)
+
+    def test_chrome_trace(self):
+        self._install()
+        with open(self.trace_file) as f:
+            trace = json.load(f)
+        phases = {event['name'] for event in trace['traceEvents']}
+        self.assertIn('clone', phases)
+        self.assertTrue(all(event['ph'] == 'X' and event['dur'] >= 0 for event in trace['traceEvents']))
+
+    def test_no_recording_without_option(self):
+        cli._install_all(destination=self.destination, conf_file=self.conf_file)
+        self.assertFalse(os.path.exists(self.metrics_file))
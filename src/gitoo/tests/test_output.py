@@ -0,0 +1,145 @@
+import io
+import os
+import tarfile
+import unittest
+import zlib
+
+import mock
+
+from .. import cli, core, output, planner
+from .common import LocalReposMixin, commit_all, git, write_module
+
+
+class TestTarOutput(LocalReposMixin):
+
+    def setUp(self):
+        super(TestTarOutput, self).setUp()
+        self.odoo = os.path.join(self.root, 'repos', 'odoo')
+        os.makedirs(os.path.join(self.odoo, 'odoo', 'addons'))
+        for path in ('odoo/__init__.py', 'odoo/addons/__init__.py'):
+            with open(os.path.join(self.odoo, path), 'a'):
+                pass
+        write_module(os.path.join(self.odoo, 'addons'), 'account')
+        write_module(os.path.join(self.odoo, 'odoo', 'addons'), 'base')
+        git(self.odoo, 'init', '-q')
+        git(self.odoo, 'symbolic-ref', 'HEAD', 'refs/heads/12.0')
+        commit_all(self.odoo, 'odoo')
+        self.hr, _ = self.make_repo('hr', ['hr_experience', 'shared_module'])
+        self.website, _ = self.make_repo('website', ['website_multi_theme', 'shared_module'])
+        self.archive_path = os.path.join(self.root, 'addons.tar.gz')
+
+    def _members(self, path=None):
+        with tarfile.open(path or self.archive_path, 'r:*') as archive:
+            return {member.name: member for member in archive.getmembers()}
+
+    def test_archive_has_the_layout_of_the_destination(self):
+        self.write_conf([
+            {'url': self.odoo, 'branch': '12.0', 'base': True, 'excludes': ['account']},
+            {'url': self.hr, 'branch': '12.0'},
+        ])
+        cli._install_all(destination=self.destination, conf_file=self.conf_file, output_tar=self.archive_path)
+
+        members = self._members()
+        self.assertIn('odoo/addons/base/__manifest__.py', members)
+        self.assertIn('hr_experience/i18n/fr.po', members)
+        self.assertNotIn('odoo/addons/account', members)
+        self.assertEqual(members['hr_experience/__init__.py'].uname, 'root')
+
+    def test_destination_is_not_used(self):
+        self.write_conf([{'url': self.hr, 'branch': '12.0'}])
+        destination = os.path.join(self.root, 'does-not-exist')
+        cli._install_all(destination=destination, conf_file=self.conf_file, output_tar=self.archive_path)
+        self.assertFalse(os.path.exists(destination))
+        self.assertEqual(os.listdir(self.destination), [])
+
+    def test_only_the_last_version_of_a_folder_is_written(self):
+        with open(os.path.join(self.hr, 'shared_module', 'old.py'), 'w') as f:
+            f.write('')
+        commit_all(self.hr, 'old file')
+        self.write_conf([
+            {'url': self.hr, 'branch': '12.0'},
+            {'url': self.website, 'branch': '12.0'},
+        ])
+        with self.assertLogs('gitoo-planner', 'WARNING') as logs:
+            cli._install_all(
+                destination=self.destination, conf_file=self.conf_file, output_tar=self.archive_path, jobs=2)
+        self.assertIn('shared_module', logs.output[0])
+
+        with tarfile.open(self.archive_path, 'r:*') as archive:
+            names = archive.getnames()
+        self.assertEqual(names.count('shared_module'), 1)
+        self.assertNotIn('shared_module/old.py', names)
+        self.assertIn('hr_experience', names)
+
+    def test_duplicate_folders_with_the_error_policy(self):
+        self.write_conf([
+            {'url': self.hr, 'branch': '12.0'},
+            {'url': self.website, 'branch': '12.0'},
+        ])
+        with self.assertRaises(RuntimeError):
+            cli._install_all(
+                destination=self.destination, conf_file=self.conf_file, output_tar=self.archive_path,
+                on_shadow=planner.SHADOW_ERROR)
+        with open(self.archive_path, 'rb') as archive:
+            # The archive is not closed properly, so it is decompressed as far as it goes
+            content = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(archive.read())
+        self.assertNotIn(b'hr_experience', content)
+
+    def _install_events(self, **kwargs):
+        events = []
+        prepare, add = core.Addon.prepare, output.TarOutput.add
+
+        def record_prepare(addon, *args, **kwargs):
+            events.append('prepare')
+            return prepare(addon, *args, **kwargs)
+
+        def record_add(tar_output, staging):
+            events.append('add')
+            return add(tar_output, staging)
+
+        with mock.patch.object(core.Addon, 'prepare', record_prepare), \
+                mock.patch.object(output.TarOutput, 'add', record_add):
+            cli._install_all(
+                destination=self.destination, conf_file=self.conf_file, output_tar=self.archive_path, **kwargs)
+        return events
+
+    def test_listed_entries_are_written_as_soon_as_prepared(self):
+        self.write_conf([
+            {'url': self.hr, 'branch': '12.0'},
+            {'url': self.website, 'branch': '12.0'},
+        ])
+        events = self._install_events(cache_dir=os.path.join(self.root, 'cache'), on_shadow=planner.SHADOW_LAST_WINS)
+        self.assertEqual(events, ['prepare', 'add', 'prepare', 'add'])
+        with tarfile.open(self.archive_path, 'r:*') as archive:
+            self.assertEqual(archive.getnames().count('shared_module'), 1)
+
+    def test_entries_followed_by_an_entry_not_listed_are_kept(self):
+        self.write_conf([
+            {'url': self.hr, 'branch': '12.0'},
+            {'url': self.website, 'branch': '12.0'},
+        ])
+        with mock.patch.object(core.Addon, 'tree_modules', return_value=None):
+            events = self._install_events(on_shadow=planner.SHADOW_LAST_WINS)
+        self.assertEqual(events, ['prepare', 'prepare', 'add', 'add'])
+        with tarfile.open(self.archive_path, 'r:*') as archive:
+            self.assertEqual(archive.getnames().count('shared_module'), 1)
+
+    def test_stream_to_stdout(self):
+        self.write_conf([{'url': self.hr, 'branch': '12.0'}])
+        stdout = io.TextIOWrapper(io.BytesIO())
+        with mock.patch('sys.stdout', stdout):
+            cli._install_all(
+                destination=self.destination, conf_file=self.conf_file, output_tar=output.STDOUT,
+                output_compression=output.GZIP)
+        stdout.buffer.seek(0)
+        with tarfile.open(fileobj=stdout.buffer, mode='r:gz') as archive:
+            self.assertIn('hr_experience/__manifest__.py', archive.getnames())
+
+
+class TestGuessCompression(unittest.TestCase):
+
+    def test_guess_compression(self):
+        self.assertEqual(output.guess_compression('addons.tar.gz'), output.GZIP)
+        self.assertEqual(output.guess_compression('addons.tar.zst'), output.ZSTD)
+        self.assertEqual(output.guess_compression('addons.tar'), output.NO_COMPRESSION)
+        self.assertEqual(output.guess_compression('-'), output.NO_COMPRESSION)
@@ -0,0 +1,195 @@
+import os
+import unittest
+
+import click
+import mock
+from click.testing import CliRunner
+
+import gitoo
+from .. import cli, core, planner
+from ..cache import MirrorCache, ResultCache
+from ..history import History
+from .common import LocalReposMixin, commit_all
+
+
+class TestHistory(LocalReposMixin):
+
+    def test_measures_are_smoothed(self):
+        history = History(os.path.join(self.root, 'history.json'))
+        history.record('https://token@github.com/OCA/hr', 10.0, 1000, 100)
+        history.record('https://github.com/OCA/hr', 20.0, 3000, 100)
+        history.save()
+
+        estimate = History(history.path).estimate('https://github.com/OCA/hr')
+        self.assertEqual(estimate['seconds'], 15.0)
+        self.assertEqual(estimate['bytes_fetched'], 2000)
+        self.assertEqual(estimate['runs'], 2)
+
+    def test_install_records_the_history(self):
+        hr, _ = self.make_repo('hr', ['hr_experience'])
+        self.write_conf([{'url': hr, 'branch': '12.0'}])
+        history_file = os.path.join(self.root, 'history.json')
+        cli._install_all(destination=self.destination, conf_file=self.conf_file, history_file=history_file)
+
+        estimate = History(history_file).estimate(hr)
+        self.assertEqual(estimate['runs'], 1)
+        self.assertGreater(estimate['seconds'], 0)
+        self.assertGreater(estimate['bytes_fetched'], 0)
+        self.assertGreater(estimate['bytes_written'], 0)
+
+
+class TestPlanner(LocalReposMixin):
+
+    def setUp(self):
+        super(TestPlanner, self).setUp()
+        self.history = History(os.path.join(self.root, 'history.json'))
+        self.history.record('https://github.com/odoo/odoo', 300.0, 2000, 1000)
+        self.history.record('https://github.com/OCA/hr', 10.0, 20, 10)
+        self.history.record('https://github.com/OCA/website', 30.0, 40, 10)
+
+    def _addon(self, name, **kwargs):
+        return core.Addon('https://github.com/{}'.format(name), '12.0', 'a' * 40, **kwargs)
+
+    def test_longest_first(self):
+        hr, website, odoo = self._addon('OCA/hr'), self._addon('OCA/website'), self._addon('odoo/odoo')
+        entries = planner.plan_addons([hr, website, odoo], self.history)
+        self.assertEqual([entry.addon for entry in entries], [odoo, website, hr])
+
+    def test_unknown_entries_get_the_average_duration(self):
+        unknown = self._addon('OCA/server-tools')
+        entries = planner.plan_addons([self._addon('OCA/hr'), unknown, self._addon('OCA/website')], self.history)
+        self.assertEqual(entries[1].addon, unknown)
+        self.assertEqual(entries[1].seconds, 20.0)
+        self.assertFalse(entries[1].known)
+
+    def test_result_cache_hits_come_last(self):
+        results = ResultCache(os.path.join(self.root, 'results'))
+        odoo = self._addon('odoo/odoo', result_cache=results)
+        path = results.archive_path(results.key(odoo.signature()))
+        os.makedirs(os.path.dirname(path))
+        open(path, 'w').close()
+
+        entries = planner.plan_addons([odoo, self._addon('OCA/hr')], self.history)
+        self.assertEqual(entries[-1].addon, odoo)
+        self.assertEqual(entries[-1].status, planner.RESULT_CACHE_HIT)
+        self.assertEqual(entries[-1].seconds, 0.0)
+
+    def test_schedule(self):
+        entries = planner.plan_addons(
+            [self._addon('OCA/hr'), self._addon('OCA/website'), self._addon('odoo/odoo')], self.history)
+        starts, total = planner.schedule(entries, 2)
+        self.assertEqual(total, 300.0)
+        self.assertEqual([(job, start) for _, job, start in starts], [(0, 0.0), (1, 0.0), (1, 30.0)])
+
+    def test_auto_jobs_limited_by_disk_space(self):
+        entries = planner.plan_addons(
+            [self._addon('OCA/hr'), self._addon('OCA/website'), self._addon('odoo/odoo')], self.history)
+        with mock.patch('os.cpu_count', return_value=4):
+            with mock.patch('shutil.disk_usage', return_value=mock.Mock(free=10 ** 9)):
+                self.assertEqual(planner.auto_jobs(entries), 3)
+            with mock.patch('shutil.disk_usage', return_value=mock.Mock(free=6000)):
+                self.assertEqual(planner.auto_jobs(entries), 1)
+
+    def test_prepare_order(self):
+        hr, website, odoo = self._addon('OCA/hr'), self._addon('OCA/website'), self._addon('odoo/odoo')
+        self.assertEqual(core._ordered([hr, website, odoo], [odoo, hr]), [odoo, hr, website])
+
+
+class TestPlanCommand(LocalReposMixin):
+
+    def test_plan_does_not_install_anything(self):
+        hr, _ = self.make_repo('hr', ['hr_experience'])
+        self.write_conf([{'url': hr, 'branch': '12.0'}])
+        history_file = os.path.join(self.root, 'history.json')
+        cli._install_all(destination=self.destination, conf_file=self.conf_file, history_file=history_file)
+        other_destination = os.path.join(self.root, 'other')
+        os.makedirs(other_destination)
+
+        result = CliRunner().invoke(cli.entry_point, [
+            'plan', '--conf_file', self.conf_file, '--destination', other_destination,
+            '--history-file', history_file, '--jobs', 'auto',
+        ])
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('1 entr(ies), 1 job(s)', result.output)
+        self.assertIn('{}@12.0'.format(hr), result.output)
+        self.assertEqual(os.listdir(other_destination), [])
+
+
+class TestPrecedence(LocalReposMixin):
+
+    def setUp(self):
+        super(TestPrecedence, self).setUp()
+        self.oca, self.oca_commit = self.make_repo('oca', ['hr_experience', 'shared_module'])
+        self.fork, _ = self.make_repo('fork', ['customer_module', 'shared_module'])
+        with open(os.path.join(self.fork, 'shared_module', 'origin.txt'), 'w') as f:
+            f.write('fork')
+        self.fork_commit = commit_all(self.fork, 'mark the fork')
+        self.config = [{'url': self.oca, 'branch': '12.0'}, {'url': self.fork, 'branch': '12.0'}]
+        self.cache_dir = os.path.join(self.root, 'mirrors')
+
+    def _origin(self, module):
+        path = os.path.join(self.destination, module, 'origin.txt')
+        return open(path).read() if os.path.exists(path) else None
+
+    def test_shadowed_modules_are_not_prepared(self):
+        with self.assertLogs('gitoo-planner', 'WARNING') as logs:
+            result = gitoo.install(self.config, self.destination, cache_dir=self.cache_dir, jobs=2)
+
+        oca, fork = result.entries
+        self.assertEqual([module['name'] for module in oca.modules], ['hr_experience'])
+        self.assertIn('shared_module', [module['name'] for module in fork.modules])
+        self.assertEqual(self._origin('shared_module'), 'fork')
+        self.assertIn('shared_module', logs.output[0])
+
+    def test_error_policy(self):
+        with self.assertRaises(RuntimeError):
+            gitoo.install(self.config, self.destination, cache_dir=self.cache_dir, on_shadow=planner.SHADOW_ERROR)
+        self.assertEqual(os.listdir(self.destination), [])
+
+    def test_includes_of_the_later_entry(self):
+        self.config[1]['includes'] = ['customer_module']
+        gitoo.install(self.config, self.destination, cache_dir=self.cache_dir, on_shadow=planner.SHADOW_ERROR)
+        self.assertIsNone(self._origin('shared_module'))
+
+    def test_includes_with_depends_of_the_later_entry(self):
+        self.config[0]['includes'] = ['shared_module']
+        self.config[1].update({'includes': ['customer_module'], 'includes_with_depends': True})
+        gitoo.install(self.config, self.destination, cache_dir=self.cache_dir)
+        without_cache = os.path.join(self.root, 'without_cache')
+        os.makedirs(without_cache)
+        gitoo.install(self.config, without_cache)
+
+        self.assertEqual(sorted(os.listdir(self.destination)), ['customer_module', 'shared_module'])
+        self.assertEqual(sorted(os.listdir(self.destination)), sorted(os.listdir(without_cache)))
+
+    def test_plan_precedence(self):
+        cache = MirrorCache(self.cache_dir, fetch_once=True)
+        oca = core.Addon(self.oca, '12.0', self.oca_commit, cache=cache)
+        fork = core.Addon(self.fork, '12.0', cache=cache)
+        signature = oca.signature()
+        shadowed = planner.plan_precedence([oca, fork], planner.SHADOW_LAST_WINS)
+
+        self.assertEqual(shadowed, [('shared_module', oca, fork)])
+        self.assertEqual(oca.shadowed_modules, {'shared_module'})
+        self.assertEqual(fork.shadowed_modules, set())
+        self.assertEqual(oca.tree_modules(), {'hr_experience'})
+        self.assertNotEqual(oca.signature(), signature)
+
+    def test_collisions_without_mirrors_are_reported_when_installed(self):
+        with self.assertRaises(RuntimeError):
+            gitoo.install(self.config, self.destination, on_shadow=planner.SHADOW_ERROR)
+        self.assertIsNone(self._origin('shared_module'))
+
+        gitoo.install(self.config, self.destination, on_shadow=planner.SHADOW_LAST_WINS)
+        self.assertEqual(self._origin('shared_module'), 'fork')
+
+
+class TestJobsType(unittest.TestCase):
+
+    def test_convert(self):
+        jobs_type = cli.JobsType()
+        self.assertEqual(jobs_type.convert('auto', None, None), planner.AUTO_JOBS)
+        self.assertEqual(jobs_type.convert('3', None, None), 3)
+        with self.assertRaises(click.BadParameter):
+            jobs_type.convert('0', None, None)
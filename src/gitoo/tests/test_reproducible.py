@@ -0,0 +1,127 @@
+import os
+import stat
+import subprocess
+
+import mock
+from click.testing import CliRunner
+
+import gitoo
+from .. import catalog, cli, core, reproducible
+from .common import GIT_ENV, LocalReposMixin, write_module
+
+COMMIT_TIME = 1577836800  # 2020-01-01
+
+
+class TestReproducible(LocalReposMixin):
+
+    def setUp(self):
+        super(TestReproducible, self).setUp()
+        self.hr = os.path.join(self.root, 'repos', 'hr')
+        os.makedirs(self.hr)
+        self._git('init', '-q')
+        self._git('symbolic-ref', 'HEAD', 'refs/heads/12.0')
+        write_module(self.hr, 'hr_experience')
+        script = os.path.join(self.hr, 'hr_experience', 'migrate.sh')
+        with open(script, 'w') as f:
+            f.write('#!/bin/sh\n')
+        os.chmod(script, 0o775)
+        self.commit = self._commit('initial commit')
+        self.config = [{'url': self.hr, 'branch': '12.0'}]
+        self.other_destination = os.path.join(self.root, 'other')
+        os.makedirs(self.other_destination)
+
+    def _git(self, *args):
+        env = dict(GIT_ENV, GIT_AUTHOR_DATE=str(COMMIT_TIME), GIT_COMMITTER_DATE='@{}'.format(COMMIT_TIME))
+        return subprocess.check_output(('git',) + args, cwd=self.hr, env=env).decode().strip()
+
+    def _commit(self, message):
+        self._git('add', '-A')
+        self._git('commit', '-q', '-m', message)
+        return self._git('rev-parse', 'HEAD')
+
+    def _stat(self, destination, path):
+        return os.lstat(os.path.join(destination, 'hr_experience', path))
+
+    def test_files_are_normalized(self):
+        os.chmod(os.path.join(self.hr, 'hr_experience', '__manifest__.py'), 0o600)
+        gitoo.install(self.config, self.destination, reproducible=True)
+
+        manifest = self._stat(self.destination, '__manifest__.py')
+        self.assertEqual(manifest.st_mtime, COMMIT_TIME)
+        self.assertEqual(stat.S_IMODE(manifest.st_mode), 0o644)
+        self.assertEqual(stat.S_IMODE(self._stat(self.destination, 'migrate.sh').st_mode), 0o755)
+        self.assertEqual(self._stat(self.destination, 'i18n').st_mtime, COMMIT_TIME)
+        self.assertEqual(os.stat(self.destination).st_mtime, COMMIT_TIME)
+
+    def test_source_date_epoch(self):
+        with mock.patch.dict(os.environ, {reproducible.SOURCE_DATE_EPOCH: '1000'}):
+            gitoo.install(self.config, self.destination, reproducible=True)
+        self.assertEqual(self._stat(self.destination, '__manifest__.py').st_mtime, 1000)
+
+        with mock.patch.dict(os.environ, {reproducible.SOURCE_DATE_EPOCH: 'yesterday'}):
+            with self.assertRaises(RuntimeError):
+                gitoo.install(self.config, self.destination, reproducible=True)
+
+    def test_digest(self):
+        first = gitoo.install(self.config, self.destination, reproducible=True).digest
+        second = gitoo.install(self.config, self.other_destination, reproducible=True).digest
+        self.assertTrue(first.startswith('sha256:'))
+        self.assertEqual(first, second)
+        self.assertIsNone(gitoo.install(self.config, self.other_destination).digest)
+
+        write_module(self.hr, 'hr_skill')
+        self._commit('add hr_skill')
+        third = gitoo.install(self.config, self.other_destination, reproducible=True).digest
+        self.assertNotEqual(first, third)
+
+    def test_digest_does_not_depend_on_the_work_directory(self):
+        config = [{'url': self.hr, 'branch': '12.0', 'patches': [{'file': 'notes.patch'}]}]
+        digests = []
+        for destination in (self.destination, self.other_destination):
+            work_directory = destination + '-conf'
+            os.makedirs(work_directory)
+            with open(os.path.join(work_directory, 'notes.patch'), 'w') as f:
+                f.write("diff --git a/NOTES.md b/NOTES.md\nnew file mode 100644\n--- /dev/null\n+++ b/NOTES.md\n"
+                        "@@ -0,0 +1 @@\n+notes\n")
+            result = gitoo.install(
+                config, destination, work_directory, reproducible=True, modules_index=catalog.JSON)
+            digests.append(result.digest)
+        self.assertEqual(result.entries[0].patches[0]['file'], 'notes.patch')
+        self.assertEqual(digests[0], digests[1])
+
+    def test_result_cache_hit_is_normalized(self):
+        config = [{'url': self.hr, 'branch': '12.0', 'commit': self.commit}]
+        options = {'result_cache': os.path.join(self.root, 'results'), 'reproducible': True}
+        first = gitoo.install(config, self.destination, **options)
+        second = gitoo.install(config, self.other_destination, **options)
+
+        self.assertTrue(second.entries[0].result_cache_hit)
+        self.assertEqual(first.digest, second.digest)
+        self.assertEqual(self._stat(self.other_destination, '__manifest__.py').st_mtime, COMMIT_TIME)
+
+    def test_normalization_is_part_of_the_signature(self):
+        addon = core.Addon(self.hr, '12.0', self.commit)
+        normalized = core.Addon(self.hr, '12.0', self.commit, normalizer=reproducible.Normalizer())
+        with_epoch = core.Addon(self.hr, '12.0', self.commit, normalizer=reproducible.Normalizer(1000))
+        self.assertEqual(len({
+            str(addon.signature()), str(normalized.signature()), str(with_epoch.signature()),
+        }), 3)
+
+    def test_tar_output_is_the_same(self):
+        self.write_conf(self.config)
+        archives = []
+        for name in ('first.tar.gz', 'second.tar.gz'):
+            path = os.path.join(self.root, name)
+            cli._install_all(conf_file=self.conf_file, output_tar=path, reproducible=True)
+            with open(path, 'rb') as archive:
+                archives.append(archive.read())
+        self.assertEqual(archives[0], archives[1])
+
+    def test_digest_is_printed(self):
+        self.write_conf(self.config)
+        result = CliRunner().invoke(cli.entry_point, [
+            'install-all', '--conf_file', self.conf_file, '--destination', self.destination, '--reproducible',
+        ])
+        self.assertEqual(result.exit_code, 0, result.output)
+        digest = reproducible.tree_digest(self.destination)
+        self.assertIn('{}  {}'.format(digest, self.destination), result.output)
@@ -0,0 +1,102 @@
+import os
+import socket
+import stat
+import threading
+
+from .. import cli, server
+from .common import LocalReposMixin
+
+
+class TestServer(LocalReposMixin):
+
+    def setUp(self):
+        super(TestServer, self).setUp()
+        self.hr, self.hr_commit = self.make_repo('hr', ['hr_experience'])
+        self.website, _ = self.make_repo('website', ['website_multi_theme'])
+        self.socket_path = os.path.join(self.root, 'gitoo.sock')
+        self.cache_dir = os.path.join(self.root, 'mirrors')
+        self.server = server.Server(self.socket_path, self.cache_dir, prefetch_urls=[self.website])
+        self.thread = threading.Thread(target=self.server.serve)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        super(TestServer, self).tearDown()
+
+    def test_install_through_the_server(self):
+        self.write_conf([{'url': self.hr, 'branch': '12.0'}])
+        result = cli._install_all(destination=self.destination, conf_file=self.conf_file, server=self.socket_path)
+
+        self.assertEqual(os.listdir(self.destination), ['hr_experience'])
+        self.assertEqual(result['entries'][0]['commit'], self.hr_commit)
+        self.assertTrue(os.path.isdir(self.server.mirrors.mirror_path(self.hr)))
+        self.assertIn(self.hr, self.server.urls.values())
+
+    def test_socket_is_private(self):
+        self.assertEqual(stat.S_IMODE(os.stat(self.socket_path).st_mode), server.SOCKET_MODE)
+
+    def test_concurrent_requests(self):
+        self.write_conf([{'url': self.hr, 'branch': '12.0', 'commit': self.hr_commit}])
+        destinations = [os.path.join(self.root, 'destination-{}'.format(index)) for index in range(4)]
+        errors = []
+
+        def install(destination):
+            os.makedirs(destination)
+            try:
+                cli._install_all(destination=destination, conf_file=self.conf_file, server=self.socket_path)
+            except RuntimeError as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=install, args=(destination,)) for destination in destinations]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        for destination in destinations:
+            self.assertEqual(os.listdir(destination), ['hr_experience'])
+        # a single fetch of the repository, the other requests use the commit already mirrored
+        self.assertEqual(self.server.mirrors.hits, 0)
+        self.assertEqual(self.server.mirrors.reused, 3)
+
+    def test_prefetch(self):
+        self.assertEqual(server.request(self.socket_path, {'command': 'prefetch'}), 1)
+        self.assertTrue(os.path.isdir(self.server.mirrors.mirror_path(self.website)))
+
+    def test_errors_are_sent_to_the_client(self):
+        with self.assertRaises(RuntimeError):
+            server.install(self.socket_path, [{'url': self.hr, 'branch': '12.0'}], self.destination, shallow=True)
+        with self.assertRaises(RuntimeError):
+            server.request(self.socket_path, {'command': 'unknown'})
+        self.assertEqual(server.request(self.socket_path, {'command': 'ping'}), 'pong')
+
+    def test_paths_are_absolute(self):
+        config = [{'url': self.hr, 'branch': '12.0'}]
+        with self.assertRaises(RuntimeError):
+            server.request(self.socket_path, {
+                'command': 'install', 'config': config, 'destination': self.destination,
+                'options': {'metrics_file': 'metrics.json'},
+            })
+
+        cwd = os.getcwd()
+        os.chdir(self.root)
+        self.addCleanup(os.chdir, cwd)
+        server.install(self.socket_path, config, 'destination', metrics_file='metrics.json')
+        self.assertTrue(os.path.isfile(os.path.join(self.root, 'metrics.json')))
+
+    def test_only_one_server_per_socket(self):
+        with self.assertRaises(RuntimeError):
+            server.Server(self.socket_path, self.cache_dir)
+
+
+class TestStaleSocket(LocalReposMixin):
+
+    def test_stale_socket_is_replaced(self):
+        socket_path = os.path.join(self.root, 'gitoo.sock')
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as stale:
+            stale.bind(socket_path)
+        gitoo_server = server.Server(socket_path, os.path.join(self.root, 'mirrors'))
+        gitoo_server.server_close()
+        self.assertFalse(os.path.exists(socket_path))
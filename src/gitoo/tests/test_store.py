@@ -0,0 +1,54 @@
+import os
+import shutil
+import stat
+
+from .. import cli
+from ..store import FileStore
+from .common import LocalReposMixin
+
+
+class TestFileStore(LocalReposMixin):
+
+    def setUp(self):
+        super(TestFileStore, self).setUp()
+        self.hr, _ = self.make_repo('hr', ['hr_experience', 'hr_skill'])
+        self.write_conf([{'url': self.hr, 'branch': '12.0'}])
+        self.store_dir = os.path.join(self.root, 'store')
+        self.other_destination = os.path.join(self.root, 'other')
+        os.makedirs(self.other_destination)
+
+    def _install(self, destination):
+        cli._install_all(destination=destination, conf_file=self.conf_file, store_dir=self.store_dir)
+
+    def test_destinations_share_files(self):
+        self._install(self.destination)
+        self._install(self.other_destination)
+        manifest = os.path.join('hr_skill', '__manifest__.py')
+        first = os.stat(os.path.join(self.destination, manifest))
+        second = os.stat(os.path.join(self.other_destination, manifest))
+        self.assertEqual(first.st_ino, second.st_ino)
+        self.assertEqual(first.st_nlink, 3)
+
+    def test_content_intact(self):
+        self._install(self.destination)
+        with open(os.path.join(self.destination, 'hr_skill', 'i18n', 'fr.po')) as f:
+            self.assertEqual(f.read(), '# fr translation of hr_skill\n')
+
+    def test_files_read_only(self):
+        self._install(self.destination)
+        mode = os.stat(os.path.join(self.destination, 'hr_skill', '__manifest__.py')).st_mode
+        self.assertFalse(mode & stat.S_IWUSR)
+
+    def test_gc_keeps_linked_files(self):
+        self._install(self.destination)
+        self.assertEqual(FileStore(self.store_dir).gc(), (0, 0))
+
+    def test_gc_removes_files_of_deleted_destinations(self):
+        self._install(self.destination)
+        self._install(self.other_destination)
+        shutil.rmtree(self.destination)
+        self.assertEqual(FileStore(self.store_dir).gc()[0], 0)
+        shutil.rmtree(self.other_destination)
+        removed, freed = FileStore(self.store_dir).gc()
+        self.assertTrue(removed)
+        self.assertTrue(freed)
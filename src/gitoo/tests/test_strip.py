@@ -0,0 +1,91 @@
+import os
+import unittest
+
+from .. import cli, core
+from ..strip import StripRules, parse_rules
+from .common import LocalReposMixin, commit_all
+
+
+class TestStripRules(unittest.TestCase):
+
+    def test_profiles(self):
+        rules = StripRules(['tests', 'descriptions', 'pot', 'pyc'])
+        self.assertTrue(rules.matches('tests/test_hr.py'))
+        self.assertTrue(rules.matches('tests/'))
+        self.assertTrue(rules.matches('static/description/screenshot.png'))
+        self.assertFalse(rules.matches('static/description/icon.png'))
+        self.assertTrue(rules.matches('i18n/hr.pot'))
+        self.assertFalse(rules.matches('i18n/fr.po'))
+        self.assertTrue(rules.matches('models/__pycache__/hr.cpython-36.pyc'))
+        self.assertTrue(rules.matches('models/__pycache__/'))
+        self.assertFalse(rules.matches('models/hr.py'))
+
+    def test_globs(self):
+        rules = StripRules(['static/src/**/*.scss', '*.md'])
+        self.assertTrue(rules.matches('static/src/scss/main.scss'))
+        self.assertTrue(rules.matches('static/src/main.scss'))
+        self.assertFalse(rules.matches('static/lib/main.scss'))
+        self.assertTrue(rules.matches('doc/CHANGES.md'))
+        self.assertFalse(StripRules().matches('tests/test_hr.py'))
+
+    def test_unknown_profile(self):
+        self.assertEqual(parse_rules('tests, pot'), ['tests', 'pot'])
+        with self.assertRaises(RuntimeError):
+            parse_rules('test')
+
+
+class TestStripModules(LocalReposMixin):
+
+    def setUp(self):
+        super(TestStripModules, self).setUp()
+        self.repo, self.commit = self.make_repo('hr', ['hr_experience'])
+        module = os.path.join(self.repo, 'hr_experience')
+        for path in (
+            'tests/__init__.py', 'tests/test_experience.py', 'static/description/icon.png',
+            'static/description/screenshot.png', 'i18n/hr_experience.pot', 'README.rst',
+        ):
+            os.makedirs(os.path.join(module, os.path.dirname(path)), exist_ok=True)
+            with open(os.path.join(module, path), 'w') as f:
+                f.write('content of {}\n'.format(path))
+        commit_all(self.repo, 'add module files')
+
+    def _installed_files(self, **kwargs):
+        addon = core.Addon(self.repo, '12.0', strip=StripRules(['tests', 'descriptions', 'pot', 'readme']), **kwargs)
+        addon.install(self.destination)
+        return {
+            os.path.relpath(os.path.join(directory, file_name), self.destination)
+            for directory, _, file_names in os.walk(self.destination) for file_name in file_names
+        }
+
+    def test_checkout(self):
+        files = self._installed_files()
+        self.assertEqual(files, {
+            'hr_experience/__init__.py',
+            'hr_experience/__manifest__.py',
+            'hr_experience/i18n/es.po',
+            'hr_experience/i18n/fr.po',
+            'hr_experience/static/description/icon.png',
+        })
+        self.assertFalse(os.path.exists(os.path.join(self.destination, 'hr_experience', 'tests')))
+
+    def test_archive_export_is_the_same(self):
+        checkout_files = self._installed_files()
+        for name in os.listdir(self.destination):
+            core.delete_in_background(os.path.join(self.destination, name))
+        core.wait_background_deletions()
+        self.assertEqual(self._installed_files(export=core.ARCHIVE), checkout_files)
+        self.assertFalse(os.path.exists(os.path.join(self.destination, 'hr_experience', 'tests')))
+
+    def test_rules_are_part_of_the_signature(self):
+        addon = core.Addon(self.repo, '12.0', self.commit)
+        stripped_addon = core.Addon(self.repo, '12.0', self.commit, strip=StripRules(['tests']))
+        self.assertNotIn('strip', addon.signature())
+        self.assertNotEqual(addon.signature(), stripped_addon.signature())
+
+    def test_conf_file_rules_added_to_cli_rules(self):
+        self.write_conf([{'url': self.repo, 'branch': '12.0', 'strip': ['static/description/*.png']}])
+        cli._install_all(destination=self.destination, conf_file=self.conf_file, strip='tests')
+        module = os.path.join(self.destination, 'hr_experience')
+        self.assertFalse(os.path.exists(os.path.join(module, 'tests')))
+        self.assertEqual(os.listdir(os.path.join(module, 'static', 'description')), [])
+        self.assertTrue(os.path.exists(os.path.join(module, 'README.rst')))
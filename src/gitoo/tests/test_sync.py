@@ -0,0 +1,94 @@
+import json
+import os
+
+from .. import cli
+from ..sync import STATE_FILE
+from .common import LocalReposMixin, commit_all
+
+
+class TestSync(LocalReposMixin):
+
+    def setUp(self):
+        super(TestSync, self).setUp()
+        self.hr, _ = self.make_repo('hr', ['hr_experience', 'shared_module'])
+        self.website, _ = self.make_repo('website', ['website_multi_theme', 'shared_module'])
+        self.conf = [
+            {'url': self.hr, 'branch': '12.0'},
+            {'url': self.website, 'branch': '12.0'},
+        ]
+        self.write_conf(self.conf)
+
+    def _sync(self, **kwargs):
+        return cli._sync(destination=self.destination, conf_file=self.conf_file, **kwargs)
+
+    def _origin(self, module):
+        with open(os.path.join(self.destination, module, 'origin.txt')) as f:
+            return f.read()
+
+    def _mark_module(self, repo, module):
+        with open(os.path.join(repo, module, 'origin.txt'), 'w') as f:
+            f.write(os.path.basename(repo))
+        return commit_all(repo, 'mark {}'.format(module))
+
+    def test_unchanged_entries_are_skipped(self):
+        self.assertEqual(self._sync(), (2, 0))
+        self.assertEqual(self._sync(jobs=2), (0, 2))
+        modules = set(os.listdir(self.destination)) - {STATE_FILE}
+        self.assertEqual(modules, {'hr_experience', 'website_multi_theme', 'shared_module'})
+
+    def test_state_file(self):
+        self._sync()
+        with open(os.path.join(self.destination, STATE_FILE)) as f:
+            state = json.load(f)
+        self.assertEqual(state['owners']['shared_module'], state['owners']['website_multi_theme'])
+        self.assertEqual(
+            sorted(entry['url'] for entry in state['entries'].values()), sorted([self.hr, self.website]))
+
+    def test_changed_entry_is_reinstalled(self):
+        self.conf[0]['excludes'] = ['shared_module']
+        self.write_conf(self.conf)
+        self._sync()
+        self._mark_module(self.website, 'website_multi_theme')
+        self.assertEqual(self._sync(), (1, 1))
+        self.assertEqual(self._origin('website_multi_theme'), 'website')
+
+    def test_later_entry_overlapping_a_changed_entry_is_reinstalled(self):
+        self._mark_module(self.website, 'shared_module')
+        self._sync()
+        self._mark_module(self.hr, 'shared_module')
+        self.assertEqual(self._sync(), (2, 0))
+        self.assertEqual(self._origin('shared_module'), 'website')
+
+    def test_modules_not_provided_anymore_are_removed(self):
+        self._sync()
+        self.write_conf(self.conf[:1])
+        self.assertEqual(self._sync(), (1, 0))
+        modules = set(os.listdir(self.destination)) - {STATE_FILE}
+        self.assertEqual(modules, {'hr_experience', 'shared_module'})
+
+    def test_failed_sync_resumes(self):
+        patch_file = os.path.join(self.root, 'broken.patch')
+        with open(patch_file, 'w') as f:
+            f.write("diff --git a/README.md b/README.md\n--- a/README.md\n+++ b/README.md\n@@ -1 +1 @@\n-# unknown\n+# x\n")
+        self.conf[1]['patches'] = [{'file': 'broken.patch'}]
+        self.write_conf(self.conf)
+        with self.assertRaises(RuntimeError):
+            self._sync()
+        self.assertTrue(os.path.isdir(os.path.join(self.destination, 'hr_experience')))
+
+        with open(patch_file, 'w') as f:
+            f.write("diff --git a/README.md b/README.md\n--- a/README.md\n+++ b/README.md\n@@ -1 +1 @@\n-# website\n+# x\n")
+        self.assertEqual(self._sync(), (1, 1))
+
+    def test_failed_changed_entry_keeps_the_previous_modules(self):
+        self._sync()
+        self._mark_module(self.website, 'website_multi_theme')
+        with open(os.path.join(self.root, 'broken.patch'), 'w') as f:
+            f.write("diff --git a/README.md b/README.md\n--- a/README.md\n+++ b/README.md\n@@ -1 +1 @@\n-# unknown\n+# x\n")
+        self.conf[1]['patches'] = [{'file': 'broken.patch'}]
+        self.write_conf(self.conf)
+        with self.assertRaises(RuntimeError):
+            self._sync()
+        modules = set(os.listdir(self.destination)) - {STATE_FILE}
+        self.assertEqual(modules, {'hr_experience', 'website_multi_theme', 'shared_module'})
+        self.assertFalse(os.path.exists(os.path.join(self.destination, 'website_multi_theme', 'origin.txt')))